@@ -0,0 +1,167 @@
+import os
+import sys
+
+import cv2 as cv
+import numpy as np
+
+from frame_timestamps import read_timestamps
+from segmented_video import SegmentedVideoWriter, open_video
+
+# One record per circle drawn on a frame, `frame` being the index of the frame
+# in the recorded raw stream
+OVERLAY_DTYPE = np.dtype(
+    [
+        ("frame", "<i8"),
+        ("track", "<i4"),
+        ("x", "<f4"),
+        ("y", "<f4"),
+        ("r", "<f4"),
+        ("estimate", "u1"),
+    ]
+)
+
+
+def overlay_path(video_path: str) -> str:
+    """
+    Returns the overlay sidecar path belonging to `video_path`
+    """
+    return os.path.splitext(video_path)[0] + ".overlay"
+
+
+class AnalysisRecorder:
+    """
+    Records the analysis thread's output in a single pass: the raw frames go to a
+    segmented video and the circles found in them to a compact vector sidecar.
+
+    Annotated video is only rendered on export with `render_annotated()`.
+    """
+
+    def __init__(
+        self, directory: str, fps: float, frame_size: tuple[int, int], is_color: bool
+    ) -> None:
+        self.out = SegmentedVideoWriter(directory, fps, frame_size, is_color=is_color)
+        self.overlay = open(overlay_path(self.out.manifest_path), "wb")
+
+    @property
+    def manifest_path(self) -> str:
+        return self.out.manifest_path
+
+    def write_frame(self, frame: np.ndarray, timestamp: float) -> int:
+        """
+        Writes a raw frame and returns its index in the recording
+        """
+        frame_idx = self.out.frame_count
+        self.out.write(frame, timestamp)
+        return frame_idx
+
+    def write_overlay(self, frame_idx: int, circles: dict, frame_pos: float) -> None:
+        """
+        Stores the circles tracked at `frame_pos` for the frame at `frame_idx`
+        """
+        if self.overlay.closed:
+            return
+        current = [
+            (idx, circle.history[-1])
+            for idx, circle in circles.items()
+            if len(circle.history) > 0 and circle.history[-1][0] == frame_pos
+        ]
+        if len(current) == 0:
+            return
+
+        records = np.zeros(len(current), dtype=OVERLAY_DTYPE)
+        records["frame"] = frame_idx
+        records["track"] = [idx for idx, _ in current]
+        records["x"] = [entry[1] for _, entry in current]
+        records["y"] = [entry[2] for _, entry in current]
+        records["r"] = [entry[3] for _, entry in current]
+        records["estimate"] = [entry[-1] == "estimate" for _, entry in current]
+        records.tofile(self.overlay)
+
+    def release(self) -> None:
+        self.out.release()
+        if not self.overlay.closed:
+            self.overlay.close()
+
+
+def read_overlays(video_path: str) -> np.ndarray:
+    """
+    Loads the overlay records stored for `video_path`, empty if there are none
+    """
+    path = overlay_path(video_path)
+    if not os.path.exists(path):
+        return np.zeros(0, dtype=OVERLAY_DTYPE)
+    return np.fromfile(path, dtype=OVERLAY_DTYPE)
+
+
+def draw_overlay(frame: np.ndarray, records: np.ndarray) -> None:
+    """
+    Draws overlay `records` onto a BGR `frame` the same way `frame_analysis` does
+    """
+    for record in records:
+        center = (int(record["x"]), int(record["y"]))
+        cv.circle(frame, center, int(record["r"]), (173, 216, 230), 2)
+        cv.circle(frame, center, 2, (0, 255, 0), 1)
+        cv.putText(
+            frame,
+            str(int(record["track"])),
+            (center[0] + int(record["r"]) + 2, center[1]),
+            cv.FONT_HERSHEY_SIMPLEX,
+            0.5,
+            (0, 255, 0),
+            1,
+            cv.LINE_AA,
+        )
+
+
+def render_annotated(video_path: str, output_path: str) -> None:
+    """
+    Renders the annotated version of a recording made by `AnalysisRecorder`
+    """
+    cap = open_video(video_path)
+    if not cap.isOpened():
+        print(f"Could not open {video_path}")
+        return
+
+    records = read_overlays(video_path)
+    # Records are written in frame order, so each frame is a contiguous slice
+    frames = records["frame"]
+    timestamps = read_timestamps(video_path)
+    fps = cap.get(cv.CAP_PROP_FPS) or 30
+    out = None
+    frame_idx = 0
+
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if frame.ndim == 2:
+            frame = cv.cvtColor(frame, cv.COLOR_GRAY2BGR)
+        if out is None:
+            h, w = frame.shape[:2]
+            out = SegmentedVideoWriter(
+                output_path, fps, (w, h), is_color=True, max_seconds=None, max_mb=None
+            )
+
+        start, end = np.searchsorted(frames, [frame_idx, frame_idx + 1])
+        draw_overlay(frame, records[start:end])
+        if timestamps is not None and frame_idx < len(timestamps):
+            timestamp = float(timestamps[frame_idx])
+        else:
+            timestamp = frame_idx / fps
+        out.write(frame, timestamp)
+        frame_idx += 1
+
+    cap.release()
+    if out:
+        out.release()
+
+
+if __name__ == "__main__":
+    # usage: python src/analysis_recording.py <recording>/manifest.json [output_dir]
+    manifest = sys.argv[1]
+    if len(sys.argv) > 2:
+        output_dir = sys.argv[2]
+    else:
+        output_dir = os.path.join(os.path.dirname(manifest), "annotated")
+    os.makedirs(output_dir, exist_ok=True)
+    render_annotated(manifest, output_dir)
@@ -0,0 +1,86 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+class BitplaneCache:
+    """
+    LRU cache of packed 1-bit DLP frames, ready to be passed to `SeqPut`.
+
+    Entries are keyed by a hash of the source content (an image array or the raw
+    bytes of a bitmask file), so reloading the same mask skips decoding, padding
+    and packing entirely.
+    """
+
+    def __init__(
+        self, size_x: int = 1024, size_y: int = 768, max_entries: int = 64
+    ) -> None:
+        self.size_x = size_x
+        self.size_y = size_y
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        # Full-size boolean frame reused by every `pack()` call
+        self.scratch = np.zeros((size_y, size_x), dtype=bool)
+
+    @staticmethod
+    def key(data: bytes | np.ndarray) -> str:
+        """
+        Returns the content hash of `data` without copying it
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        if isinstance(data, np.ndarray):
+            digest.update(f"{data.shape}{data.dtype}".encode())
+            data = np.ascontiguousarray(data)
+        digest.update(data)
+        return digest.hexdigest()
+
+    def get(self, key: str) -> np.ndarray | None:
+        packed = self.entries.get(key)
+        if packed is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return packed
+
+    def put(self, key: str, packed: np.ndarray) -> None:
+        self.entries[key] = packed
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def fits(self, img: np.ndarray) -> bool:
+        return (
+            img.ndim == 2 and img.shape[0] <= self.size_y and img.shape[1] <= self.size_x
+        )
+
+    def pack(self, img: np.ndarray) -> np.ndarray:
+        """
+        Centers `img` on the DMD and packs it to 8 pixels per byte, top row first
+
+        Nonzero pixels are turned on. The packed frame (size_y, size_x / 8) is the
+        only allocation, thresholding writes straight into the reused scratch frame.
+        """
+        h, w = img.shape
+        row = (self.size_y - h) // 2
+        col = (self.size_x - w) // 2
+
+        self.scratch.fill(False)
+        np.not_equal(img, 0, out=self.scratch[row : row + h, col : col + w])
+        return np.packbits(self.scratch, axis=-1)
+
+    def get_or_pack(self, img: np.ndarray, key: str | None = None) -> np.ndarray:
+        """
+        Returns the packed frame for `img`, packing and caching it on a miss
+        """
+        if key is None:
+            key = self.key(img)
+        packed = self.get(key)
+        if packed is None:
+            packed = self.pack(img)
+            self.put(key, packed)
+        return packed
@@ -0,0 +1,444 @@
+import argparse
+import itertools
+import time
+from collections import deque
+
+import cv2 as cv
+import numpy as np
+
+from control_loop import ControlLoop
+from frame_analysis import frame_analysis
+from pid_bank import PidBank
+
+# Analysis settings of a fresh GUI session (main.py)
+ANALYSIS_SETTINGS = {
+    "blur": 7,
+    "adapt_area": 61,
+    "adapt_c": 13,
+    "min_area": 70,
+    "min_pos_err": 5,
+    "blur_on": True,
+    "thresh_on": True,
+    "contour_on": True,
+    "tracking_on": True,
+    "selection_on": False,
+    "filters_on": False,
+    "pid_on": True,
+    "fps": 0,
+}
+
+# `frame_analysis()` gives the bubbles of the first frame this setpoint
+SETPOINT = 100.0
+
+
+class BubblePlant:
+    """
+    Radius dynamics of microbubbles under a PWM driven actuator.
+
+    While the drive is on, a bubble grows by `growth` px/s (rectified
+    diffusion). It always dissolves by `dissolution / r` px/s, faster the
+    smaller it is, so above the radius the drive can hold it at, it grows on
+    its own. `radius` holds one element per bubble, and radii stay between
+    `min_radius` and `max_radius`. `noise` adds a random walk in px/sqrt(s).
+    """
+
+    def __init__(
+        self,
+        radius,
+        growth: float = 60.0,
+        dissolution: float = 1000.0,
+        min_radius: float = 5.0,
+        max_radius: float = 200.0,
+        noise: float = 0.0,
+        seed: int | None = None,
+    ) -> None:
+        self.radius = np.array(radius, dtype=np.float64, ndmin=1)
+        self.growth = growth
+        self.dissolution = dissolution
+        self.min_radius = min_radius
+        self.max_radius = max_radius
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+
+    def step(self, on, dt: float) -> np.ndarray:
+        """
+        Advances the radii by `dt` seconds with the drive of each bubble `on`
+        """
+        rate = np.where(on, self.growth, 0.0) - self.dissolution / self.radius
+        radius = self.radius + rate * dt
+        if self.noise > 0:
+            radius += self.rng.normal(0.0, self.noise * np.sqrt(dt), len(radius))
+        self.radius = np.clip(radius, self.min_radius, self.max_radius)
+        return self.radius
+
+
+def pwm_on(t: float, on_time, cycle_time) -> np.ndarray:
+    """
+    Returns whether PWM outputs with `on_time` out of `cycle_time`
+    milliseconds are on at `t` seconds
+    """
+    cycle_time = np.asarray(cycle_time, dtype=np.float64)
+    phase = np.mod(t * 1000, np.maximum(cycle_time, 1e-9))
+    return (phase < on_time) & (cycle_time > 0)
+
+
+def render_frame(
+    shape: tuple[int, int],
+    bubbles,
+    noise: float = 4.0,
+    rng: np.random.Generator | None = None,
+) -> np.ndarray:
+    """
+    Draws `bubbles` ((x, y, r) in px) as dark rings of outer radius `r` on a
+    light background, with sub-pixel radii and Gaussian pixel noise of `noise`
+    gray levels
+    """
+    frame = np.full(shape, 200, dtype=np.uint8)
+    thickness = 4
+    shift = 4
+    scale = 1 << shift
+    for x, y, r in bubbles:
+        cv.circle(
+            frame,
+            (round(x * scale), round(y * scale)),
+            round(max(r - thickness / 2, 0) * scale),
+            60,
+            thickness,
+            cv.LINE_AA,
+            shift,
+        )
+    if noise > 0:
+        rng = rng or np.random.default_rng()
+        noisy = frame + rng.normal(0.0, noise, shape)
+        frame = np.clip(noisy, 0, 255).astype(np.uint8)
+    return frame
+
+
+class SimulatedActuator:
+    """
+    Stands in for `PwmActuator` on a simulated clock. A submitted PWM cycle
+    takes effect `latency` seconds after `now` and switches the plant on for
+    the first `on_time` of every cycle.
+    """
+
+    def __init__(self, latency: float = 0.002) -> None:
+        self.latency = latency
+        # Simulated time in seconds, set by the simulation
+        self.now = 0.0
+        # (effective time, [on_time, off_time]) of the cycles not applied yet
+        self.pending: deque[tuple[float, list[float]]] = deque()
+        self.pwm_cycle = [0.0, 100.0]
+        self.sent = 0
+
+    def submit(self, pwm_cycle: list[float], frame_id: int | None = None) -> None:
+        self.pending.append((self.now + self.latency, list(pwm_cycle)))
+        self.sent += 1
+
+    def on(self, t: float) -> bool:
+        while self.pending and self.pending[0][0] <= t:
+            self.pwm_cycle = self.pending.popleft()[1]
+        on_time, off_time = self.pwm_cycle
+        return bool(pwm_on(t, on_time, on_time + off_time))
+
+    @property
+    def duty(self) -> float:
+        on_time, off_time = self.pwm_cycle
+        cycle_time = on_time + off_time
+        return on_time / cycle_time if cycle_time > 0 else 0.0
+
+
+class BubbleSimulation:
+    """
+    Closes the loop around one simulated bubble through the code used with
+    the hardware: frames are rendered from `plant` every `1 / fps` seconds
+    and go through `frame_analysis()`, its `CirclePID` (or a `ControlLoop`
+    at `control_loop_rate`, like `control_loop_on`) and a `SimulatedActuator`
+    back to the plant.
+
+    Time is simulated in steps of `step` seconds, so runs go as fast as the
+    analysis allows. Each frame's PID output reaches the actuator after
+    `analysis_latency` seconds, or after the analysis' own compute time if
+    `None`, plus the actuator's `actuation_latency`.
+    """
+
+    def __init__(
+        self,
+        plant: BubblePlant | None = None,
+        fps: float = 30.0,
+        shape: tuple[int, int] = (512, 512),
+        analysis_latency: float | None = None,
+        actuation_latency: float = 0.002,
+        control_loop_rate: float | None = None,
+        pixel_noise: float = 4.0,
+        step: float = 1e-3,
+        seed: int | None = None,
+    ) -> None:
+        self.plant = plant or BubblePlant([50.0], seed=seed)
+        self.fps = fps
+        self.shape = shape
+        self.analysis_latency = analysis_latency
+        self.actuator = SimulatedActuator(actuation_latency)
+        self.control_loop: ControlLoop | None = None
+        if control_loop_rate:
+            self.control_loop = ControlLoop(control_loop_rate, setpoint=SETPOINT)
+            self.control_loop.actuator = self.actuator
+        self.pixel_noise = pixel_noise
+        self.step = step
+        self.rng = np.random.default_rng(seed)
+        self.center = (shape[1] / 2, shape[0] / 2)
+
+        # Seconds of wall time `frame_analysis()` took per frame
+        self.analysis_times: list[float] = []
+
+    def run(self, duration: float) -> dict[str, np.ndarray]:
+        """
+        Simulates `duration` seconds and returns the exposure time, true and
+        measured radius and applied duty ratio of every frame
+        """
+        settings = ANALYSIS_SETTINGS.copy()
+        settings["fps"] = self.fps
+        if self.control_loop is not None:
+            # The control loop runs the PID itself, from the posted radii
+            settings["pid_on"] = False
+            control_period = 1.0 / self.control_loop.rate
+        circles = {}
+        frame_pos = frame_start = 1
+        # (time the analysis result is out, (x, y, r) measurement or PWM cycle)
+        outputs: deque[tuple[float, object]] = deque()
+        history = {"time": [], "radius": [], "measured": [], "duty": []}
+
+        t = 0.0
+        next_frame = 0.0
+        next_control = 0.0
+        while t < duration:
+            if t >= next_frame:
+                radius = float(self.plant.radius[0])
+                frame = render_frame(
+                    self.shape,
+                    [(*self.center, radius)],
+                    self.pixel_noise,
+                    self.rng,
+                )
+                start = time.perf_counter()
+                _, circles = frame_analysis(
+                    frame, settings, circles, [], frame_pos, frame_start, 1
+                )
+                elapsed = time.perf_counter() - start
+                self.analysis_times.append(elapsed)
+                latency = elapsed if self.analysis_latency is None else self.analysis_latency
+
+                measured = np.nan
+                radii = {
+                    idx: circle.history[-1][3]
+                    for idx, circle in circles.items()
+                    if len(circle.history) > 0 and circle.history[-1][0] == frame_pos
+                }
+                if 1 in radii:
+                    measured = radii[1]
+                if self.control_loop is not None:
+                    outputs.append((t + latency, (t, t + latency, radii, None)))
+                elif 1 in circles and circles[1].pid is not None:
+                    outputs.append((t + latency, circles[1].pid.pwm_cycle))
+
+                history["time"].append(t)
+                history["radius"].append(radius)
+                history["measured"].append(measured)
+                history["duty"].append(self.actuator.duty)
+                frame_pos += 1
+                next_frame += 1.0 / self.fps
+
+            self.actuator.now = t
+            while outputs and outputs[0][0] <= t:
+                output = outputs.popleft()[1]
+                if self.control_loop is not None:
+                    self.control_loop.mailbox.post(output)
+                else:
+                    self.actuator.submit(output)
+            if self.control_loop is not None and t >= next_control:
+                self.control_loop.step(t)
+                next_control += control_period
+
+            self.plant.step(self.actuator.on(t), self.step)
+            t += self.step
+
+        return {name: np.array(values) for name, values in history.items()}
+
+
+def response_metrics(
+    times: np.ndarray,
+    radius: np.ndarray,
+    setpoint: float = SETPOINT,
+    band: float = 0.05,
+) -> dict[str, np.ndarray]:
+    """
+    Returns the integrated absolute error (px s), overshoot (px), settling
+    time into +-`band` of the setpoint (s, inf if never) and mean absolute
+    error over the last second (px) of radius traces `radius` (samples x
+    runs) taken at `times`
+    """
+    radius = radius.reshape(len(times), -1)
+    error = np.abs(setpoint - radius)
+    dt = np.diff(times, append=times[-1])[:, None]
+    outside = error > band * setpoint
+    # Settled at the sample after the last one outside the band
+    last_outside = len(times) - 1 - np.argmax(outside[::-1], axis=0)
+    settling_time = times[np.minimum(last_outside + 1, len(times) - 1)]
+    settling_time = np.where(outside.any(axis=0), settling_time, times[0])
+    settling_time = np.where(outside[-1], np.inf, settling_time)
+    tail = times >= times[-1] - 1.0
+    return {
+        "iae": (error * dt).sum(axis=0),
+        "overshoot": np.maximum(radius.max(axis=0) - setpoint, 0.0),
+        "settling_time": settling_time,
+        "final_error": error[tail].mean(axis=0),
+    }
+
+
+def sweep(
+    kps,
+    kis,
+    kds,
+    latencies=(0.0,),
+    duration: float = 10.0,
+    fps: float = 30.0,
+    initial_radius: float = 50.0,
+    measurement_noise: float = 0.5,
+    step: float = 1e-3,
+    seed: int | None = None,
+    **plant_params,
+) -> dict[str, np.ndarray]:
+    """
+    Simulates one bubble per combination of gains and latency budget, all
+    together, and returns the gains, latency and `response_metrics()` of each.
+
+    Frames are not rendered: each frame measures the radius with Gaussian
+    `measurement_noise` px, the `PidBank` updates every run at once, and each
+    run's output takes effect `latency` seconds after the exposure.
+    """
+    configs = np.array(list(itertools.product(kps, kis, kds, latencies)), ndmin=2)
+    count = len(configs)
+    rng = np.random.default_rng(seed)
+    plant = BubblePlant(np.full(count, initial_radius), seed=seed, **plant_params)
+    bank = PidBank(capacity=count, setpoint=SETPOINT)
+    for track_id, (kp, ki, kd, _) in enumerate(configs):
+        bank.add(track_id, kp=kp, ki=ki, kd=kd)
+    track_ids = list(range(count))
+    out_max = bank.out_max[[bank.slots[t] for t in track_ids]]
+    latency = configs[:, 3]
+    cycle_time = bank.cycle_time
+
+    on_time = np.zeros(count)
+    # (exposure time, on times) of the outputs some runs have not applied yet
+    outputs: deque[tuple[float, np.ndarray]] = deque()
+    times, radii = [], []
+    t = 0.0
+    next_frame = 0.0
+    while t < duration:
+        if t >= next_frame:
+            measured = plant.radius + rng.normal(0.0, measurement_noise, count)
+            output = bank.update(track_ids, measured, 1.0 / fps)
+            outputs.append((t, output / out_max * cycle_time))
+            times.append(t)
+            radii.append(plant.radius.copy())
+            next_frame += 1.0 / fps
+
+        for exposure, pending in outputs:
+            due = exposure + latency <= t
+            on_time[due] = pending[due]
+        # Drop outputs every run is past
+        while len(outputs) > 1 and outputs[1][0] + latency.max() <= t:
+            outputs.popleft()
+
+        plant.step(pwm_on(t, on_time, cycle_time), step)
+        t += step
+
+    results = {
+        "kp": configs[:, 0],
+        "ki": configs[:, 1],
+        "kd": configs[:, 2],
+        "latency": latency,
+    }
+    results.update(response_metrics(np.array(times), np.array(radii)))
+    return results
+
+
+def gain_range(text: str) -> np.ndarray:
+    """
+    Parses "start:stop:count" into evenly spaced values, or a single value
+    """
+    parts = [float(p) for p in text.split(":")]
+    if len(parts) == 1:
+        return np.array(parts)
+    return np.linspace(parts[0], parts[1], int(parts[2]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Simulates the bubble PID loop without the camera or actuator"
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = sub.add_parser("run", help="closed loop through frame_analysis()")
+    run_parser.add_argument("--duration", type=float, default=10.0)
+    run_parser.add_argument("--fps", type=float, default=30.0)
+    run_parser.add_argument("--analysis-latency", type=float, default=None)
+    run_parser.add_argument("--actuation-latency", type=float, default=0.002)
+    run_parser.add_argument(
+        "--control-loop-rate",
+        type=float,
+        default=None,
+        help="run the PID in a ControlLoop at this rate instead of per frame",
+    )
+    run_parser.add_argument("--seed", type=int, default=0)
+
+    sweep_parser = sub.add_parser("sweep", help="gain and latency sweep")
+    sweep_parser.add_argument("--kp", type=gain_range, default="0.1:2:20")
+    sweep_parser.add_argument("--ki", type=gain_range, default="0:1:11")
+    sweep_parser.add_argument("--kd", type=gain_range, default="0:0.3:4")
+    sweep_parser.add_argument("--latency", type=gain_range, default="0:0.1:3")
+    sweep_parser.add_argument("--duration", type=float, default=10.0)
+    sweep_parser.add_argument("--fps", type=float, default=30.0)
+    sweep_parser.add_argument("--top", type=int, default=10)
+    sweep_parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == "run":
+        simulation = BubbleSimulation(
+            fps=args.fps,
+            analysis_latency=args.analysis_latency,
+            actuation_latency=args.actuation_latency,
+            control_loop_rate=args.control_loop_rate,
+            seed=args.seed,
+        )
+        history = simulation.run(args.duration)
+        elapsed = time.perf_counter() - start
+        metrics = response_metrics(history["time"], history["radius"])
+        print({name: float(values[0]) for name, values in metrics.items()})
+        print(
+            f"final radius {history['radius'][-1]:.1f} px, "
+            f"analysis {np.median(simulation.analysis_times) * 1000:.2f} ms/frame"
+        )
+    else:
+        results = sweep(
+            args.kp,
+            args.ki,
+            args.kd,
+            args.latency,
+            duration=args.duration,
+            fps=args.fps,
+            seed=args.seed,
+        )
+        elapsed = time.perf_counter() - start
+        order = np.argsort(results["iae"])
+        print(f"{'kp':>6} {'ki':>6} {'kd':>6} {'latency':>8} {'iae':>9} "
+              f"{'overshoot':>9} {'settling':>9} {'final':>7}")
+        for i in order[: args.top]:
+            print(
+                f"{results['kp'][i]:6.2f} {results['ki'][i]:6.2f} "
+                f"{results['kd'][i]:6.2f} {results['latency'][i]:8.3f} "
+                f"{results['iae'][i]:9.1f} {results['overshoot'][i]:9.2f} "
+                f"{results['settling_time'][i]:9.2f} {results['final_error'][i]:7.2f}"
+            )
+        print(f"{len(order)} configurations")
+    print(f"simulated {args.duration:.0f} s in {elapsed:.2f} s")
@@ -3,7 +3,10 @@ import numpy as np
 from PySide6.QtCore import QThread, Signal
 from pypylon import pylon
 from pypylon.pylon import GrabResult, InstantCamera, RuntimeException
-import cv2
+
+from segmented_video import SegmentedVideoWriter, new_recording_dir
+from ring_recorder import RingRecorder
+from latency_trace import LatencyTracer
 
 
 class CameraThread(QThread):
@@ -14,18 +17,28 @@ class CameraThread(QThread):
     timestamp = Signal(float)
     display_out = Signal(tuple)
     frame_out = Signal(tuple)
+    # Emitted with the video writer to release after the frames already sent
+    release_out = Signal(object)
 
     def __init__(self, desired_fps=100) -> None:
         super().__init__()
         self.recording: bool = False
 
         # If `None`, there is no video writer
-        self.out: cv2.VideoWriter | None = None
+        self.out: SegmentedVideoWriter | None = None
+        # Recordings rotate to a new segment after this much capture time or size
+        self.segment_seconds = 60
+        self.segment_max_mb = 2048
+
+        # If `None`, frames are not kept in the pre-trigger ring buffer
+        self.ring: RingRecorder | None = None
 
         self.desired_fps = desired_fps
 
         # If `None`, there is no Basler connection
         self.basler: InstantCamera | None = None
+        # If `None`, the frames sent for analysis are not latency traced
+        self.tracer: LatencyTracer | None = None
         self.running = False
 
     def start_grabbing(self) -> None:
@@ -49,14 +62,15 @@ class CameraThread(QThread):
         print("starting capture")
         self.start_time = time.time()
         if self.basler:
-            fourcc = cv2.VideoWriter.fourcc(*"mp4v")
-            output_filename = "unfiltered_output.mp4"
-            self.out = cv2.VideoWriter(
-                output_filename,
-                fourcc,
-                30,
+            # The container frame rate is only nominal, real frame timing is kept
+            # in the timestamp sidecar
+            self.out = SegmentedVideoWriter(
+                new_recording_dir("unfiltered"),
+                self.desired_fps,
                 (1280, 1024),
-                isColor=False,
+                is_color=False,
+                max_seconds=self.segment_seconds,
+                max_mb=self.segment_max_mb,
             )
         self.recording = True
 
@@ -66,7 +80,8 @@ class CameraThread(QThread):
         """
         self.recording = False
         if self.out:
-            self.out.release()
+            # Released by the writer, so frames still queued for it are kept
+            self.release_out.emit(self.out)
             self.out = None
             self.wait()
 
@@ -85,8 +100,11 @@ class CameraThread(QThread):
                 grab_result: GrabResult = self.basler.RetrieveResult(
                     5000, pylon.TimeoutHandling_ThrowException
                 )
+                grab_time = time.perf_counter_ns()
                 if grab_result.GrabSucceeded():
                     accumulator += acc_ratio
+                    # Camera tick counter in nanoseconds, taken at exposure
+                    capture_time = grab_result.TimeStamp * 1e-9
 
                     img = self.converter.Convert(grab_result)
                     frame = img.GetArray()
@@ -102,19 +120,34 @@ class CameraThread(QThread):
                     else:
                         previous_frame = frame.copy()
 
+                    if self.ring:
+                        self.ring.push(frame, capture_time)
+
                     if self.recording and self.out and self.out.isOpened():
                         try:
-                            self.frame_out.emit([frame, self.out])
+                            self.frame_out.emit(
+                                [frame, self.out, capture_time]
+                            )
                         except Exception as e:
                             print(f"Error emitting write frame: {e}")
                         self.timestamp.emit(time.time() - self.start_time)
 
                     if accumulator >= 1.0:
+                        frame_id = None
+                        if self.tracer:
+                            frame_id = self.tracer.new_frame(grab_time)
                         try:
                             exposure = self.basler.ExposureTime.Value
                             current_fps = self.basler.ResultingFrameRate.Value
                             self.display_out.emit(
-                                [frame, current_fps, exposure, self.recording]
+                                [
+                                    frame,
+                                    current_fps,
+                                    exposure,
+                                    self.recording,
+                                    capture_time,
+                                    frame_id,
+                                ]
                             )
                         except Exception as e:
                             print(f"Error emitting display frame: {e}")
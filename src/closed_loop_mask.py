@@ -0,0 +1,272 @@
+import time
+from collections import deque
+
+import numpy as np
+
+from bitplane_cache import BitplaneCache
+
+MASK_MODES = ("disc", "annulus", "exclusion")
+
+
+def centered_homography(
+    frame_shape: tuple[int, ...], size_x: int = 1024, size_y: int = 768
+) -> np.ndarray:
+    """
+    Returns the camera to DLP mapping that centers the camera frame on the DMD
+    one pixel per mirror, the same way `DlpThread.pad_img_centered` does
+    """
+    h, w = frame_shape[:2]
+    return np.array(
+        [[1, 0, (size_x - w) // 2], [0, 1, (size_y - h) // 2], [0, 0, 1]],
+        dtype=np.float64,
+    )
+
+
+class MaskRasterizer:
+    """
+    Rasterizes discs straight into packed 1-bit DLP frames.
+
+    Each disc or ring becomes one or two horizontal spans per row, and the pixels
+    of all spans are set with a single flat index assignment, so no per-disc or
+    per-pixel Python loop is involved.
+    """
+
+    def __init__(
+        self, size_x: int = 1024, size_y: int = 768, homography: np.ndarray | None = None
+    ) -> None:
+        self.size_x = size_x
+        self.size_y = size_y
+        # Maps camera pixels (x, y, 1) to DLP mirrors
+        self.homography = np.eye(3) if homography is None else homography
+        self.mask = np.zeros((size_y, size_x), dtype=bool)
+
+    def to_dlp(self, discs: np.ndarray) -> np.ndarray:
+        """
+        Maps (n, 3) camera discs `x, y, r` to DLP coordinates
+        """
+        if len(discs) == 0:
+            return discs
+        points = np.column_stack((discs[:, :2], np.ones(len(discs))))
+        mapped = points @ self.homography.T
+        scale = np.sqrt(np.abs(np.linalg.det(self.homography[:2, :2])))
+        return np.column_stack(
+            (mapped[:, :2] / mapped[:, 2:], discs[:, 2] * scale / mapped[:, 2])
+        )
+
+    def disc_rows(
+        self, y: np.ndarray, r: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns the disc index, row and squared distance to the center of every
+        on-screen row covered by the discs centered on `y` with radii `r`
+        """
+        y0 = np.maximum(np.ceil(y - r), 0).astype(np.intp)
+        y1 = np.minimum(np.floor(y + r), self.size_y - 1).astype(np.intp)
+        counts = np.maximum(y1 - y0 + 1, 0)
+        disc = np.repeat(np.arange(len(y)), counts)
+        rows = np.arange(len(disc)) - np.repeat(np.cumsum(counts) - counts, counts)
+        rows += y0[disc]
+        return disc, rows, (rows - y[disc]) ** 2
+
+    def fill(
+        self, rows: np.ndarray, x0: np.ndarray, x1: np.ndarray, value: bool
+    ) -> None:
+        """
+        Sets the pixels from column `x0` up to `x1` of each row in `rows`
+        """
+        x0 = np.clip(x0, 0, self.size_x).astype(np.intp)
+        x1 = np.clip(x1, 0, self.size_x).astype(np.intp)
+        lengths = np.maximum(x1 - x0, 0)
+        offsets = rows * self.size_x + x0 - (np.cumsum(lengths) - lengths)
+        idx = np.arange(int(lengths.sum())) + np.repeat(offsets, lengths)
+        self.mask.reshape(-1)[idx] = value
+
+    def rasterize(
+        self,
+        discs: np.ndarray,
+        mode: str = "disc",
+        margin: float = 0.0,
+        width: float = 4.0,
+    ) -> np.ndarray:
+        """
+        Returns the (size_y, size_x) boolean mask of (n, 3) DLP discs `x, y, r`
+
+        `disc` turns on each bubble grown by `margin`, `annulus` a ring `width`
+        wide around it and `exclusion` everything but the grown bubbles. The
+        returned array is reused by the next call.
+        """
+        if mode not in MASK_MODES:
+            raise ValueError(f"Unknown mask mode {mode}, expected one of {MASK_MODES}")
+
+        self.mask.fill(mode == "exclusion")
+        if len(discs) == 0:
+            return self.mask
+
+        x, y = discs[:, 0], discs[:, 1]
+        r = discs[:, 2] + margin
+        outer = r + width if mode == "annulus" else r
+        disc, rows, dy2 = self.disc_rows(y, outer)
+        xd = x[disc]
+        half = np.sqrt(np.maximum(outer[disc] ** 2 - dy2, 0))
+        x0 = np.ceil(xd - half)
+        x1 = np.floor(xd + half) + 1
+
+        if mode == "annulus":
+            # Rows crossing the bubble are split into a left and a right span
+            inner = r[disc]
+            crossing = (inner > 0) & (dy2 <= inner**2)
+            half_in = np.sqrt(np.maximum(inner**2 - dy2, 0))
+            left_end = np.where(crossing, np.ceil(xd - half_in), x1)
+            right_start = np.where(crossing, np.floor(xd + half_in) + 1, x1)
+            self.fill(rows, x0, left_end, True)
+            self.fill(rows, right_start, x1, True)
+        else:
+            self.fill(rows, x0, x1, mode == "disc")
+        return self.mask
+
+    def pack(
+        self,
+        discs: np.ndarray,
+        mode: str = "disc",
+        margin: float = 0.0,
+        width: float = 4.0,
+    ) -> np.ndarray:
+        """
+        Rasterizes camera discs and returns the packed frame (size_y, size_x / 8)
+        """
+        mask = self.rasterize(self.to_dlp(discs), mode, margin, width)
+        return np.packbits(mask, axis=-1)
+
+
+class ClosedLoopMasker:
+    """
+    Projects masks generated from the tracked bubbles.
+
+    Every `every` analysed frames, the bubbles found in the frame are rasterized
+    and queued on a running `DlpThread`, which swaps to the new mask at the end
+    of the current one's `picture_time`. Identical consecutive masks are not
+    queued again.
+    """
+
+    def __init__(
+        self,
+        dlp,
+        every: int = 1,
+        mode: str = "disc",
+        margin: float = 0.0,
+        width: float = 4.0,
+        picture_time: int = 1000,
+    ) -> None:
+        self.dlp = dlp
+        self.every = every
+        self.mode = mode
+        self.margin = margin
+        self.width = width
+        # Short display time so a queued mask replaces the current one quickly
+        self.picture_time = picture_time
+
+        # Camera to DLP mapping, centered on the DMD unless set by calibration
+        self.homography: np.ndarray | None = None
+        self.rasterizer: MaskRasterizer | None = None
+        self.frame_shape: tuple[int, ...] | None = None
+
+        self.frames = 0
+        self.queued = 0
+        self.unchanged = 0
+        self.last_id: str | None = None
+        # Seconds spent rasterizing and packing each mask
+        self.raster_times: deque[float] = deque(maxlen=1000)
+        # Seconds from a frame reaching the analysis thread to its mask being
+        # submitted to the ALP, and to it being on the DMD, which includes the
+        # rest of the previous mask's picture time
+        self.submit_latencies: deque[float] = deque(maxlen=1000)
+        self.projection_latencies: deque[float] = deque(maxlen=1000)
+
+    def set_homography(self, homography: np.ndarray | None) -> None:
+        self.homography = homography
+        self.rasterizer = None
+
+    def update(
+        self,
+        circles: dict,
+        frame_pos: float,
+        frame_shape: tuple[int, ...],
+        received_at: float,
+    ) -> None:
+        """
+        Queues the mask of the bubbles tracked at `frame_pos`, `received_at` being
+        the `time.perf_counter()` time the frame was received
+        """
+        self.frames += 1
+        if self.frames % max(self.every, 1) != 0 or not self.dlp.isRunning():
+            return
+
+        start = time.perf_counter()
+        if self.rasterizer is None or self.frame_shape != frame_shape[:2]:
+            size_x, size_y = self.dlp.device.nSizeX, self.dlp.device.nSizeY
+            homography = self.homography
+            if homography is None:
+                homography = centered_homography(frame_shape, size_x, size_y)
+            self.rasterizer = MaskRasterizer(size_x, size_y, homography)
+            self.frame_shape = frame_shape[:2]
+
+        discs = np.array(
+            [
+                circle.history[-1][1:4]
+                for circle in circles.values()
+                if len(circle.history) > 0 and circle.history[-1][0] == frame_pos
+            ],
+            dtype=np.float64,
+        ).reshape(-1, 3)
+        packed = self.rasterizer.pack(discs, self.mode, self.margin, self.width)
+        pattern_id = "mask_" + BitplaneCache.key(packed)
+        self.raster_times.append(time.perf_counter() - start)
+
+        if pattern_id == self.last_id:
+            self.unchanged += 1
+            return
+        self.last_id = pattern_id
+        self.queued += 1
+        self.dlp.queue_packed(
+            packed[np.newaxis],
+            self.picture_time,
+            queued_at=received_at,
+            pattern_id=pattern_id,
+        )
+
+    def on_pattern_swapped(
+        self, pattern_id: str, submit_latency: float, latency: float
+    ) -> None:
+        if pattern_id.startswith("mask_"):
+            self.submit_latencies.append(submit_latency)
+            self.projection_latencies.append(latency)
+
+    def reset(self) -> None:
+        self.last_id = None
+
+    def stats(self) -> dict[str, float]:
+        """
+        Returns rasterization, camera to submission and camera to projection
+        times in milliseconds
+        """
+        stats = {
+            "frames": self.frames,
+            "queued": self.queued,
+            "unchanged": self.unchanged,
+            "projected": len(self.projection_latencies),
+        }
+        if len(self.raster_times) > 0:
+            times = np.array(self.raster_times) * 1000
+            stats["raster_mean_ms"] = float(times.mean())
+            stats["raster_p99_ms"] = float(np.percentile(times, 99))
+        for name, latencies in (
+            ("submit", self.submit_latencies),
+            ("projection", self.projection_latencies),
+        ):
+            if len(latencies) > 0:
+                times = np.array(latencies) * 1000
+                stats[f"{name}_mean_ms"] = float(times.mean())
+                stats[f"{name}_p50_ms"] = float(np.percentile(times, 50))
+                stats[f"{name}_p99_ms"] = float(np.percentile(times, 99))
+                stats[f"{name}_max_ms"] = float(times.max())
+        return stats
@@ -0,0 +1,207 @@
+import time
+from collections import deque
+
+import numpy as np
+from PySide6.QtCore import QThread
+
+from latency_trace import LatencyTracer
+from pid_bank import PidBank
+
+
+class Mailbox:
+    """
+    Single-slot mailbox holding the latest value posted by one writer thread.
+
+    `post()` replaces the slot with a single reference assignment, which is
+    atomic in CPython, so neither side takes a lock and a slow reader never
+    holds up the writer. Values posted faster than they are read overwrite
+    each other.
+    """
+
+    def __init__(self) -> None:
+        # (sequence number, value)
+        self.slot: tuple[int, object] = (0, None)
+
+    def post(self, value) -> None:
+        self.slot = (self.slot[0] + 1, value)
+
+    def latest(self) -> tuple[int, object]:
+        return self.slot
+
+
+class ControlLoop(QThread):
+    """
+    A `QThread` based class running the bubble PIDs at a fixed rate, apart
+    from frame analysis.
+
+    The analysis thread posts `(camera_time, received_at, radii, frame_id)`
+    measurements to `mailbox`, `camera_time` being NaN if the frame has no
+    capture time, `radii` mapping tracked bubble IDs to their radius in the
+    frame and `frame_id` being the frame's `LatencyTracer` ID or `None`.
+    Every `1 / rate` seconds all bubbles in the latest measurement are
+    stepped together in `bank` with the same `dt`, so slow drawing or encoding
+    in the analysis loop changes neither the update times nor `dt`. The PWM
+    cycles of all bubbles are posted to `commands`, and the one of bubble
+    `track_id` goes to `actuator` (`PwmActuator`) and `fgen_worker`
+    (`InstrumentWorker`) if set. Measurements older than `max_age` seconds
+    are not used, and the outputs are held. A bubble missing from the latest
+    measurement is disabled (output 0) and removed from `bank` once it has
+    been missing for `max_age`. The derivative uses the time between the
+    frames, by `received_at` for frames without a capture time, and `dt`
+    when consecutive frames were timed by different clocks.
+    """
+
+    def __init__(
+        self,
+        rate: float = 100.0,
+        track_id: int = 1,
+        setpoint: float = 100.0,
+        max_age: float = 0.1,
+    ) -> None:
+        super().__init__()
+        self.rate = rate
+        self.track_id = track_id
+        self.setpoint = setpoint
+        self.max_age = max_age
+        self.running = False
+
+        self.mailbox = Mailbox()
+        self.bank = PidBank(setpoint=setpoint)
+        # Latest {track ID: [on_time, off_time]} of all controlled bubbles
+        self.commands = Mailbox()
+        # Time each bubble was first missing from the measurements, by track ID
+        self.missing_since: dict[int, float] = {}
+        self.actuator = None
+        self.fgen_worker = None
+        self.tracer: LatencyTracer | None = None
+
+        self.updates = 0
+        self.stale = 0
+        # Measurements overwritten before the loop read them
+        self.dropped = 0
+        self.last_seq = 0
+        # Mailbox sequence number and time of the last measurement used, and
+        # whether that time came from the camera
+        self.used_seq = 0
+        self.used_time: float | None = None
+        self.used_camera_time = False
+        # Seconds each update ran after its scheduled time
+        self.lateness: deque[float] = deque(maxlen=1000)
+        # Seconds from each used frame reaching the analysis thread to its update
+        self.ages: deque[float] = deque(maxlen=1000)
+        # (camera time, radius, control signal) of bubble `track_id`
+        self.history: deque[tuple[float, float, float]] = deque(maxlen=100000)
+
+    def step(self, now: float) -> None:
+        """
+        Runs one PID update with the latest measurement
+        """
+        seq, measurement = self.mailbox.latest()
+        if seq > self.last_seq + 1:
+            self.dropped += seq - self.last_seq - 1
+        self.last_seq = seq
+        if measurement is None:
+            return
+
+        camera_time, received_at, radii, frame_id = measurement
+        age = now - received_at
+        if age > self.max_age or len(radii) == 0:
+            self.stale += 1
+            return
+
+        self.update_tracks(radii, now)
+        dt = 1.0 / self.rate
+        # The same measurement is used on several ticks between frames, only
+        # a new one moves the derivative, over the time between the frames
+        new_measurement = seq != self.used_seq
+        derivative_dt = None
+        if new_measurement:
+            # The camera and host clocks are never mixed in one interval
+            camera_timed = bool(np.isfinite(camera_time))
+            measured_at = camera_time if camera_timed else received_at
+            if (
+                self.used_time is not None
+                and self.used_camera_time == camera_timed
+                and measured_at - self.used_time > 0
+            ):
+                derivative_dt = measured_at - self.used_time
+            self.used_seq = seq
+            self.used_time = measured_at
+            self.used_camera_time = camera_timed
+        track_ids = list(radii)
+        outputs = self.bank.update(
+            track_ids, list(radii.values()), dt, new_measurement, derivative_dt
+        )
+        self.updates += 1
+        self.ages.append(age)
+        self.commands.post(self.bank.pwm_cycles())
+        if self.tracer is not None:
+            self.tracer.stamp(frame_id, "pid_update")
+
+        if self.track_id not in radii:
+            return
+        output = outputs[track_ids.index(self.track_id)]
+        self.history.append((camera_time, radii[self.track_id], float(output)))
+        pwm_cycle = self.bank.pwm_cycle(self.track_id)
+        if self.actuator is not None:
+            self.actuator.submit(pwm_cycle, frame_id)
+        if self.fgen_worker is not None:
+            self.fgen_worker.set_pwm_cycle(pwm_cycle, frame_id)
+
+    def update_tracks(self, radii: dict[int, float], now: float) -> None:
+        """
+        Disables the bubbles missing from `radii`, removes those missing for
+        longer than `max_age` and enables the ones that came back
+        """
+        returned = [t for t in self.missing_since if t in radii]
+        for track_id in returned:
+            del self.missing_since[track_id]
+        self.bank.set_enabled(returned, True)
+
+        missing = [t for t in self.bank.slots if t not in radii]
+        for track_id in missing:
+            since = self.missing_since.setdefault(track_id, now)
+            if now - since > self.max_age:
+                self.bank.remove(track_id)
+                del self.missing_since[track_id]
+        self.bank.set_enabled(missing, False)
+
+    def run(self) -> None:
+        self.running = True
+        period = 1.0 / self.rate
+        next_tick = time.perf_counter()
+        while self.running:
+            now = time.perf_counter()
+            if now < next_tick:
+                time.sleep(next_tick - now)
+                continue
+
+            self.lateness.append(now - next_tick)
+            self.step(now)
+
+            next_tick += period
+            # Skip the ticks missed while stalled instead of bursting to catch up
+            if next_tick < time.perf_counter():
+                next_tick = time.perf_counter() + period
+
+    def stop(self) -> None:
+        self.running = False
+
+    def stats(self) -> dict[str, float]:
+        """
+        Returns the update lateness and measurement age in milliseconds
+        """
+        stats = {
+            "updates": self.updates,
+            "stale": self.stale,
+            "dropped": self.dropped,
+        }
+        if len(self.lateness) > 0:
+            times = np.array(self.lateness) * 1000
+            stats["lateness_p50_ms"] = float(np.percentile(times, 50))
+            stats["lateness_p99_ms"] = float(np.percentile(times, 99))
+        if len(self.ages) > 0:
+            times = np.array(self.ages) * 1000
+            stats["age_p50_ms"] = float(np.percentile(times, 50))
+            stats["age_p99_ms"] = float(np.percentile(times, 99))
+        return stats
@@ -0,0 +1,105 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pyvisa
+from PySide6.QtCore import QMutex, QMutexLocker, QThread, Signal
+
+
+class DeviceDiscovery(QThread):
+    """
+    A `QThread` based class listing the VISA instruments off the GUI thread.
+
+    Each `refresh()` probes all listed resources concurrently, opening them with
+    a short `timeout` so an unresponsive one only holds up its own probe. USB
+    instruments are reported through `found` as soon as they answer, and their
+    `*IDN?` is cached by resource name, so they are not opened again on the
+    next refresh unless `force` is set.
+    """
+
+    # Emitted with the resource name, IDN and model name of each USB instrument
+    found = Signal(str, str, str)
+    # Emitted with the resource name and the error of each failed probe
+    failed = Signal(str, str)
+    # Emitted with the number of instruments found once a refresh is complete
+    done = Signal(int)
+
+    def __init__(
+        self,
+        rm,
+        timeout: int = 500,
+        max_workers: int = 8,
+    ) -> None:
+        super().__init__()
+        self.rm = rm
+        # Open and I/O timeout of each probe in milliseconds
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.force = False
+
+        # (IDN, model name) by resource name, `None` for non-USB resources
+        self.cache: dict[str, tuple[str, str] | None] = {}
+        self.cache_mutex = QMutex()
+
+    def refresh(self, force: bool = False) -> None:
+        """
+        Starts probing the resources, unless a refresh is already running
+        """
+        if self.isRunning():
+            print("Device refresh already running")
+            return
+        self.force = force
+        self.start()
+
+    def probe(self, resource: str) -> tuple[str, str] | None:
+        """
+        Returns the IDN and model name of the USB instrument at `resource`, from
+        the cache if it answered before
+        """
+        with QMutexLocker(self.cache_mutex):
+            if not self.force and resource in self.cache:
+                return self.cache[resource]
+
+        with self.rm.open_resource(
+            resource, open_timeout=self.timeout, timeout=self.timeout
+        ) as instrument:
+            # USB instruments, and stand-ins like the simulated generator, are
+            # the message based resources that report a model name
+            if hasattr(instrument, "model_name") and callable(
+                getattr(instrument, "query", None)
+            ):
+                result = (instrument.query("*IDN?").strip(), instrument.model_name)
+            else:
+                result = None
+
+        with QMutexLocker(self.cache_mutex):
+            self.cache[resource] = result
+        return result
+
+    def run(self) -> None:
+        start = time.perf_counter()
+        try:
+            resources = self.rm.list_resources()
+        except pyvisa.errors.Error as e:
+            print(f"Could not list VISA resources: {e}")
+            self.done.emit(0)
+            return
+
+        found = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            probes = {pool.submit(self.probe, r): r for r in resources}
+            for probe in as_completed(probes):
+                resource = probes[probe]
+                try:
+                    result = probe.result()
+                except Exception as e:
+                    self.failed.emit(resource, str(e))
+                    continue
+                if result is not None:
+                    found += 1
+                    self.found.emit(resource, *result)
+
+        print(
+            f"Probed {len(resources)} VISA resources in "
+            f"{(time.perf_counter() - start) * 1000:.0f} ms"
+        )
+        self.done.emit(found)
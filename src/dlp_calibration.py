@@ -0,0 +1,303 @@
+import os
+import time
+
+import cv2 as cv
+import numpy as np
+from PySide6.QtCore import QMutex, QMutexLocker, QThread, QWaitCondition, Signal
+
+CALIBRATION_DIR = "calibrations"
+
+
+def calibration_path(setup: str) -> str:
+    """
+    Returns where the calibration of `setup` is cached
+    """
+    return os.path.join(CALIBRATION_DIR, f"{setup}.npz")
+
+
+def gray_code_bits(size: int) -> int:
+    return max(int(np.ceil(np.log2(size))), 1)
+
+
+def gray_code_pairs(size: int) -> np.ndarray:
+    """
+    Returns the Gray code bits of `0..size-1` as (2 * nb_bits, size) booleans,
+    most significant bit first, each bit followed by its inverse
+    """
+    nb_bits = gray_code_bits(size)
+    coords = np.arange(size)
+    gray = coords ^ (coords >> 1)
+    shifts = np.arange(nb_bits - 1, -1, -1)[:, np.newaxis]
+    bits = ((gray[np.newaxis, :] >> shifts) & 1).astype(bool)
+    return np.stack((bits, ~bits), axis=1).reshape(2 * nb_bits, size)
+
+
+def gray_code_patterns(size_x: int = 1024, size_y: int = 768) -> np.ndarray:
+    """
+    Returns the packed calibration sequence (n, size_y, size_x / 8)
+
+    The sequence starts with an all-on and an all-off frame, followed by the
+    column then the row Gray code patterns from `gray_code_pairs()`. Every frame
+    repeats a single packed row or column, so nothing is rasterized at full size.
+    """
+    row_bytes = size_x // 8
+    columns = np.packbits(gray_code_pairs(size_x), axis=-1)
+    rows = np.where(gray_code_pairs(size_y), np.uint8(255), np.uint8(0))
+
+    frames = np.empty(
+        (2 + len(columns) + len(rows), size_y, row_bytes), dtype=np.uint8
+    )
+    frames[0] = 255
+    frames[1] = 0
+    frames[2 : 2 + len(columns)] = columns[:, np.newaxis, :]
+    frames[2 + len(columns) :] = rows[:, :, np.newaxis]
+    return frames
+
+
+def decode_gray_code(
+    captures: np.ndarray, nb_bits: int, min_contrast: int = 10
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Decodes (2 * nb_bits, h, w) captures of pattern and inverse pairs into the
+    projector coordinate seen by each camera pixel
+
+    Returns the coordinates and a mask of the pixels where every pair differed
+    by at least `min_contrast`.
+    """
+    positive = captures[0::2]
+    negative = captures[1::2]
+    bits = positive > negative
+    reliable = np.all(
+        np.abs(positive.astype(np.int16) - negative) >= min_contrast, axis=0
+    )
+
+    # Gray to binary: each binary bit is the XOR of all Gray bits above it
+    binary = np.bitwise_xor.accumulate(bits, axis=0)
+    weights = 1 << np.arange(nb_bits - 1, -1, -1)
+    coords = np.tensordot(weights, binary, axes=1)
+    return coords, reliable
+
+
+class Calibration:
+    """
+    Mapping from camera pixels to DLP micromirrors, fitted as a homography.
+
+    `warp_mask()` moves a mask drawn in camera coordinates onto the DMD with a
+    precomputed remap table, so it costs a single lookup per mirror.
+    """
+
+    def __init__(
+        self,
+        homography: np.ndarray,
+        camera_shape: tuple[int, int],
+        size_x: int = 1024,
+        size_y: int = 768,
+        rms_error: float = 0.0,
+    ) -> None:
+        self.homography = homography
+        self.camera_shape = camera_shape
+        self.size_x = size_x
+        self.size_y = size_y
+        self.rms_error = rms_error
+
+        # Fixed-point remap table from each mirror to its camera pixel, built on
+        # first use
+        self.map1: np.ndarray | None = None
+        self.map2: np.ndarray | None = None
+
+    def build_remap(self) -> None:
+        cols, rows = np.meshgrid(
+            np.arange(self.size_x, dtype=np.float32),
+            np.arange(self.size_y, dtype=np.float32),
+        )
+        mirrors = np.stack((cols, rows), axis=-1).reshape(-1, 1, 2)
+        camera = cv.perspectiveTransform(mirrors, np.linalg.inv(self.homography))
+        camera = camera.reshape(self.size_y, self.size_x, 2)
+        self.map1, self.map2 = cv.convertMaps(
+            camera[..., 0], camera[..., 1], cv.CV_16SC2
+        )
+
+    def warp_mask(self, mask: np.ndarray) -> np.ndarray:
+        """
+        Returns camera-coordinate `mask` as seen by the DMD (size_y, size_x)
+        """
+        if self.map1 is None:
+            self.build_remap()
+        return cv.remap(
+            mask,
+            self.map1,
+            self.map2,
+            cv.INTER_NEAREST,
+            borderMode=cv.BORDER_CONSTANT,
+            borderValue=0,
+        )
+
+    def pack_mask(self, mask: np.ndarray) -> np.ndarray:
+        """
+        Warps camera-coordinate `mask` onto the DMD and packs it for `SeqPut`
+        """
+        return np.packbits(self.warp_mask(mask) != 0, axis=-1)
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez(
+            path,
+            homography=self.homography,
+            camera_shape=np.array(self.camera_shape),
+            dlp_size=np.array((self.size_x, self.size_y)),
+            rms_error=self.rms_error,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "Calibration | None":
+        """
+        Loads a cached calibration, `None` if there is none at `path`
+        """
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            size_x, size_y = (int(v) for v in data["dlp_size"])
+            return cls(
+                data["homography"],
+                tuple(int(v) for v in data["camera_shape"]),
+                size_x,
+                size_y,
+                float(data["rms_error"]),
+            )
+
+
+def fit_calibration(
+    captures: np.ndarray,
+    size_x: int = 1024,
+    size_y: int = 768,
+    min_contrast: int = 10,
+    step: int = 4,
+) -> Calibration | None:
+    """
+    Fits the camera to DLP homography from captures of `gray_code_patterns()`
+
+    Every `step`-th reliably decoded camera pixel is used. Returns `None` if too
+    few pixels could be decoded.
+    """
+    nb_x, nb_y = gray_code_bits(size_x), gray_code_bits(size_y)
+    sampled = captures[:, ::step, ::step]
+    white, black = sampled[0], sampled[1]
+    lit = white.astype(np.int16) - black >= min_contrast
+
+    cols, cols_ok = decode_gray_code(sampled[2 : 2 + 2 * nb_x], nb_x, min_contrast)
+    rows, rows_ok = decode_gray_code(sampled[2 + 2 * nb_x :], nb_y, min_contrast)
+    valid = lit & cols_ok & rows_ok & (cols < size_x) & (rows < size_y)
+
+    ys, xs = np.nonzero(valid)
+    if len(xs) < 4:
+        print("Calibration failed: the DLP pattern was not seen by the camera")
+        return None
+
+    camera = np.column_stack((xs * step, ys * step)).astype(np.float32)
+    mirrors = np.column_stack((cols[ys, xs], rows[ys, xs])).astype(np.float32)
+    homography, inliers = cv.findHomography(camera, mirrors, cv.RANSAC, 2.0)
+    if homography is None:
+        print("Calibration failed: no homography fits the decoded pixels")
+        return None
+
+    inliers = inliers.ravel() > 0
+    mapped = cv.perspectiveTransform(camera[inliers].reshape(-1, 1, 2), homography)
+    residuals = mapped.reshape(-1, 2) - mirrors[inliers]
+    rms_error = float(np.sqrt(np.mean(np.sum(residuals**2, axis=1))))
+    return Calibration(homography, captures.shape[1:3], size_x, size_y, rms_error)
+
+
+class CalibrationThread(QThread):
+    """
+    Projects the Gray-code calibration sequence through a `DlpThread`, captures
+    each pattern from the camera frames passed to `on_camera_frame()` and fits
+    the camera to DLP mapping.
+    """
+
+    progress = Signal(int, int)
+    # Emitted with the `Calibration`, or `None` if calibration failed
+    calibrated = Signal(object)
+
+    def __init__(
+        self,
+        dlp,
+        setup: str = "default",
+        settle_time: float = 0.1,
+        frames_per_pattern: int = 2,
+        frame_timeout: float = 2.0,
+    ) -> None:
+        super().__init__()
+        self.dlp = dlp
+        self.setup = setup
+        # Seconds to let the DMD and camera exposure settle after each switch
+        self.settle_time = settle_time
+        self.frames_per_pattern = frames_per_pattern
+        self.frame_timeout = frame_timeout
+
+        # Latest camera frame and the `time.perf_counter()` time it arrived
+        self.frame: np.ndarray | None = None
+        self.frame_time = 0.0
+        self.frame_mutex = QMutex()
+        self.frame_cond = QWaitCondition()
+
+    def on_camera_frame(self, data) -> None:
+        with QMutexLocker(self.frame_mutex):
+            self.frame = data[0]
+            self.frame_time = time.perf_counter()
+            self.frame_cond.wakeAll()
+
+    def next_frame(self, after: float) -> np.ndarray | None:
+        """
+        Waits for a camera frame that arrived after `after`
+        """
+        deadline = time.perf_counter() + self.frame_timeout
+        with QMutexLocker(self.frame_mutex):
+            while self.frame is None or self.frame_time <= after:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return None
+                self.frame_cond.wait(self.frame_mutex, int(remaining * 1000) + 1)
+            return self.frame
+
+    def capture(self) -> np.ndarray | None:
+        """
+        Returns the mean of `frames_per_pattern` camera frames taken after the
+        settle time
+        """
+        after = time.perf_counter() + self.settle_time
+        time.sleep(self.settle_time)
+        total = None
+        for _ in range(self.frames_per_pattern):
+            frame = self.next_frame(after)
+            if frame is None:
+                return None
+            if frame.ndim == 3:
+                frame = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+            total = frame.astype(np.float32) if total is None else total + frame
+            after = self.frame_time
+        return (total / self.frames_per_pattern).astype(np.uint8)
+
+    def run(self) -> None:
+        size_x, size_y = self.dlp.device.nSizeX, self.dlp.device.nSizeY
+        patterns = gray_code_patterns(size_x, size_y)
+        self.dlp.load_packed(patterns, pattern_id="calibration")
+
+        captures = []
+        for i in range(len(patterns)):
+            self.dlp.play_range(i, i)
+            frame = self.capture()
+            if frame is None:
+                print("Calibration failed: no camera frames received")
+                self.calibrated.emit(None)
+                return
+            captures.append(frame)
+            self.progress.emit(i + 1, len(patterns))
+
+        calibration = fit_calibration(np.stack(captures), size_x, size_y)
+        if calibration is not None:
+            calibration.save(calibration_path(self.setup))
+            print(
+                f"Saved DLP calibration to {calibration_path(self.setup)} "
+                f"(RMS error {calibration.rms_error:.2f} mirrors)"
+            )
+        self.calibrated.emit(calibration)
@@ -1,26 +1,216 @@
+import os
+import time
 from typing import TypeAlias, override
 import numpy as np
-from ALP4 import ALP4, ALPError, ALP_PROJ_MODE, ALP_MASTER, ALP_DATA_FORMAT, ALP_DATA_BINARY_TOPDOWN, ALP_BIN_MODE, ALP_BIN_UNINTERRUPTED
-from PySide6.QtCore import QMutex, QMutexLocker, QThread
+import cv2 as cv
+from ALP4 import ALP4, ALPError, ALP_PROJ_MODE, ALP_MASTER, ALP_FIRSTFRAME, ALP_LASTFRAME, ALP_SEQ_REPEAT
+from PySide6.QtCore import QMutex, QMutexLocker, QThread, QWaitCondition, Signal
+
+from bitplane_cache import BitplaneCache
+from grayscale import quantize_centered
+from mock_alp4 import MockALP4
+from pattern_library import PatternLibrary
 
 Img: TypeAlias = np.ndarray[tuple[int, int, int], np.dtype[np.integer]]
+# Stack of frames shaped (n, nSizeY, nSizeX)
+ImgStack: TypeAlias = np.ndarray[tuple[int, int, int], np.dtype[np.integer]]
+# Stack of packed 1-bit frames shaped (n, nSizeY, nSizeX / 8)
+PackedStack: TypeAlias = np.ndarray[tuple[int, int, int], np.dtype[np.uint8]]
+
+
+def create_device() -> ALP4 | MockALP4:
+    """
+    Returns the ALP-4.1 device, or a simulated one if the `DLPCTL_MOCK_DLP`
+    environment variable is set or the ALP driver cannot be loaded
+    """
+    if os.environ.get("DLPCTL_MOCK_DLP"):
+        print("DLPCTL_MOCK_DLP is set, using a simulated DLP")
+        return MockALP4()
+    try:
+        return ALP4(version="4.1")
+    except (OSError, ValueError) as e:
+        print(f"Could not load the ALP driver ({e}), using a simulated DLP")
+        return MockALP4()
 
 
 class DlpThread(QThread):
-    def __init__(self) -> None:
+    """
+    A `QThread` based class for controlling the DLP.
+
+    While running, the thread uploads patterns queued with `queue_packed()` or
+    `queue_bitmask_files()` in the background, then swaps to them without
+    stopping the pattern that is currently projected.
+    """
+
+    # Emitted with the pattern ID and the seconds from queueing to the swap
+    # being submitted to the ALP, and to the pattern being on the DMD
+    pattern_swapped = Signal(str, float, float)
+
+    def __init__(self, device: ALP4 | MockALP4 | None = None) -> None:
         super().__init__()
-        self.device: ALP4 = ALP4(version="4.1")
+        self.device: ALP4 | MockALP4 = device if device is not None else create_device()
         self.connected: bool = False
         self.set_img_mutex: QMutex = QMutex()
         self._img: Img | None = None
 
+        # Sequences kept in the DLP's memory so recent patterns switch without an upload
+        self.library: PatternLibrary = PatternLibrary(self.device)
+
+        # Current pattern and its sequence, `None` if there is none
+        self.pattern_id: str | None = None
+        self.seq_id = None
+        self.nb_frames: int = 0
+        self.loop: bool = True
+
+        # Packed frames of previously loaded masks
+        self.cache: BitplaneCache = BitplaneCache()
+
+        # If `True`, new patterns are uploaded by this thread while the current one
+        # keeps projecting
+        self.double_buffer: bool = True
+        self.running: bool = False
+        # Latest queued upload, older requests that were not started yet are dropped
+        self.pending: tuple | None = None
+        self.pending_mutex: QMutex = QMutex()
+        self.pending_cond: QWaitCondition = QWaitCondition()
+
     @override
     def run(self) -> None:
-        # if self.img is not None and not self.running:
-        #     self.device.Run(None, True)  # pyright: ignore[reportUnknownMemberType]
-        # else:
-        #     pass
-        self.device.Run()
+        self.running = True
+        while self.running:
+            with QMutexLocker(self.pending_mutex):
+                while self.running and self.pending is None:
+                    self.pending_cond.wait(self.pending_mutex)
+                request = self.pending
+                self.pending = None
+
+            if request is None:
+                continue
+            try:
+                self.upload_and_swap(*request)
+            except ALPError as e:
+                print(f"DLP upload failed: {e}")
+            except Exception as e:
+                # Keep serving, a bad request must not stop later uploads
+                print(f"DLP upload failed: {e!r}")
+
+    def upload_and_swap(
+        self,
+        source,
+        picture_time: int | None,
+        loop: bool,
+        queued_at: float,
+        pattern_id: str | None,
+        bit_depth: int = 1,
+    ) -> None:
+        """
+        Uploads a queued pattern next to the projected one, then swaps to it
+        """
+        if isinstance(source, np.ndarray):
+            data = source if bit_depth == 1 else self.quantize(source, bit_depth)
+        elif bit_depth == 1:
+            frames = [self.packed_bitmask_file(filename) for filename in source]
+            frames = [frame for frame in frames if frame is not None]
+            if len(frames) == 0:
+                return
+            data = np.stack(frames)
+        else:
+            data = self.grayscale_files(source, bit_depth)
+            if data is None:
+                return
+
+        pattern_id = self.load_resident(
+            data, bit_depth, picture_time, loop, pattern_id
+        )
+        with QMutexLocker(self.set_img_mutex):
+            self.library.switch(pattern_id, seamless=True)
+            submitted_at = time.perf_counter()
+            # The outgoing pattern finishes its iteration first, at the latest
+            # by `handover_at`
+            shown_at = submitted_at
+            if self.library.swap_pending():
+                shown_at = max(self.library.handover_at, submitted_at)
+        self.pattern_swapped.emit(
+            pattern_id, submitted_at - queued_at, shown_at - queued_at
+        )
+
+    def queue(
+        self,
+        source,
+        picture_time: int | None,
+        loop: bool,
+        queued_at: float | None = None,
+        pattern_id: str | None = None,
+        bit_depth: int = 1,
+    ) -> None:
+        if queued_at is None:
+            queued_at = time.perf_counter()
+        with QMutexLocker(self.pending_mutex):
+            self.pending = (source, picture_time, loop, queued_at, pattern_id, bit_depth)
+            self.pending_cond.wakeOne()
+
+    def queue_packed(
+        self,
+        packed: PackedStack,
+        picture_time: int | None = None,
+        loop: bool = True,
+        queued_at: float | None = None,
+        pattern_id: str | None = None,
+    ) -> None:
+        """
+        Queues packed frames to be uploaded and swapped in by the running thread
+
+        `queued_at` is the `time.perf_counter()` time the latency reported by
+        `pattern_swapped` is measured from, now if `None`.
+        """
+        if packed.ndim == 2:
+            packed = packed[np.newaxis]
+        if (
+            packed.ndim != 3
+            or len(packed) == 0
+            or packed.dtype != np.uint8
+            or packed.shape[1:] != (self.device.nSizeY, self.device.nSizeX // 8)
+        ):
+            print(f"Invalid packed frames for the DLP: {packed.shape} {packed.dtype}")
+            return
+        self.queue(packed, picture_time, loop, queued_at, pattern_id)
+
+    def queue_grayscale(
+        self,
+        frames: ImgStack,
+        bit_depth: int = 8,
+        picture_time: int | None = None,
+        loop: bool = True,
+    ) -> None:
+        """
+        Queues uint8 frames to be quantized to `bit_depth` bits, uploaded and
+        swapped in by the running thread
+        """
+        if frames.ndim == 2:
+            frames = frames[np.newaxis]
+        if frames.ndim != 3 or len(frames) == 0 or not self.validate_img(frames[0]):
+            print(f"Invalid grayscale frames for the DLP: {frames.shape}")
+            return
+        self.queue(frames, picture_time, loop, bit_depth=bit_depth)
+
+    def queue_bitmask_files(
+        self,
+        filenames: list[str],
+        picture_time: int | None = None,
+        bit_depth: int = 1,
+    ) -> None:
+        """
+        Queues bitmask files to be read, uploaded and swapped in by the running thread
+        """
+        self.queue(list(filenames), picture_time, True, bit_depth=bit_depth)
+
+    def project(self) -> None:
+        """
+        Starts projecting the current pattern
+        """
+        with QMutexLocker(self.set_img_mutex):
+            if self.pattern_id is not None:
+                self.library.switch(self.pattern_id)
 
     def open(self) -> bool:
         """
@@ -29,6 +219,7 @@ class DlpThread(QThread):
         try:
             self.device.Initialize()
             self.device.ProjControl(ALP_PROJ_MODE, ALP_MASTER)
+            self.cache = BitplaneCache(self.device.nSizeX, self.device.nSizeY)
 
             self.connected = True
             return True
@@ -47,45 +238,236 @@ class DlpThread(QThread):
         """
         if new_img is None:
             self._img = None
-        else:
-            with QMutexLocker(self.set_img_mutex):
-                if self.validate_img(new_img):
-                    # Pause and get rid of old sequence if already allocated
-                    if self.img:
-                        self._img = None
-                        self.device.Halt()
-                        self.device.FreeSeq()
+        elif self.validate_img(new_img):
+            packed = self.cache.get_or_pack(new_img)
+            self.load_packed(packed[np.newaxis])
+            self._img = new_img
 
-                    # Allocate and push new sequence data
-                    self.device.SeqAlloc(nbImg=1, bitDepth=1)
-                    padded_seq = self.pad_img_centered(new_img)
+    def packed_bitmask_file(self, filename: str) -> np.ndarray | None:
+        """
+        Returns the packed frame of the bitmask image in `filename`, reusing the
+        cached one if the same file content was loaded before
+        """
+        with open(filename, "rb") as f:
+            data = f.read()
 
-                    self.device.SeqControl(ALP_DATA_FORMAT, ALP_DATA_BINARY_TOPDOWN)
-                    self.device.SeqControl(ALP_BIN_MODE, ALP_BIN_UNINTERRUPTED)
+        key = BitplaneCache.key(data)
+        packed = self.cache.get(key)
+        if packed is None:
+            img = cv.imdecode(np.frombuffer(data, dtype=np.uint8), cv.IMREAD_GRAYSCALE)
+            if img is None or not self.validate_img(img):
+                print(f"Invalid bitmask: {filename}")
+                return None
+            packed = self.cache.pack(img)
+            self.cache.put(key, packed)
+        return packed
 
-                    self.device.SeqPut(np.packbits(padded_seq * 255))
+    def grayscale_files(self, filenames: list[str], bit_depth: int) -> ImgStack | None:
+        """
+        Reads the images in `filenames` as frames quantized to `bit_depth` bits
+        and centered on the DMD, `None` if none of them could be read
+        """
+        frames = []
+        for filename in filenames:
+            img = cv.imread(filename, cv.IMREAD_GRAYSCALE)
+            if img is None or not self.validate_img(img):
+                print(f"Invalid image: {filename}")
+                continue
+            frames.append(self.quantize(img, bit_depth))
+        if len(frames) == 0:
+            return None
+        return np.concatenate(frames)
 
-                    # self.device.SetTiming(pictureTime=20_000)
-                    self._img = padded_seq
+    def load_bitmask_files(
+        self,
+        filenames: list[str],
+        picture_time: int | None = None,
+        bit_depth: int = 1,
+    ) -> bool:
+        """
+        Uploads the bitmask images in `filenames` as one sequence, in order
 
-    def pad_img_centered(self, img: Img) -> Img:
-        target_x = 1024
-        target_y = 768
+        With a `bit_depth` above 1 the images are uploaded as grayscale frames.
+        Returns `True` if at least one image was uploaded
+        """
+        if bit_depth > 1:
+            data = self.grayscale_files(filenames, bit_depth)
+            if data is None:
+                return False
+            self.load_resident(data, bit_depth, picture_time)
+            return True
+
+        frames = [self.packed_bitmask_file(filename) for filename in filenames]
+        frames = [packed for packed in frames if packed is not None]
+        if len(frames) == 0:
+            return False
+
+        self.load_packed(np.stack(frames), picture_time)
+        return True
+
+    def free_sequences(self) -> None:
+        """
+        Stops projection and frees every resident sequence
+        """
+        self._img = None
+        self.library.clear()
+        self.pattern_id = None
+        self.seq_id = None
+        self.nb_frames = 0
+
+    def load_sequence(
+        self, frames: ImgStack, picture_time: int | None = None, loop: bool = True
+    ) -> None:
+        """
+        Uploads a stack of binary frames to the DLP as one sequence
+
+        `frames` is shaped (n, nSizeY, nSizeX) and nonzero pixels are turned on.
+        The whole stack is sent in a single `SeqPut`. `picture_time` is the
+        display time of each frame in microseconds, the device default if `None`.
+        Call `run()` to start projecting.
+        """
+        if frames.ndim != 3 or frames.shape[1:] != (
+            self.device.nSizeY,
+            self.device.nSizeX,
+        ):
+            print(f"Invalid sequence shape for the DLP: {frames.shape}")
+            return
+
+        # 8 pixels per byte, top row first
+        self.load_packed(np.packbits(frames != 0, axis=-1), picture_time, loop)
+
+    def load_packed(
+        self,
+        packed: PackedStack,
+        picture_time: int | None = None,
+        loop: bool = True,
+        pattern_id: str | None = None,
+    ) -> str:
+        """
+        Uploads a stack of already packed 1-bit frames as one sequence, unless the
+        same pattern is still resident on the DLP
+
+        See `load_sequence()` for the other parameters. `pattern_id` defaults to a
+        hash of the frames and timing. Returns the pattern ID.
+        """
+        return self.load_resident(packed, 1, picture_time, loop, pattern_id)
 
-        actual_x = img.shape[0]
-        actual_y = img.shape[1]
+    def load_grayscale(
+        self,
+        frames: ImgStack,
+        bit_depth: int = 8,
+        picture_time: int | None = None,
+        loop: bool = True,
+        pattern_id: str | None = None,
+    ) -> str | None:
+        """
+        Uploads uint8 frames (n, h, w) as one grayscale sequence of `bit_depth`
+        bits, centered on the DMD
 
-        pad_rows = (target_y - actual_y) // 2
-        pad_cols = (target_x - actual_x) // 2
+        The ALP only takes packed binary data for 1-bit sequences, so each pixel
+        is sent as one MSB-aligned byte and split into bit planes by the device.
 
-        print(f"nSizeX: {self.device.nSizeX}")
-        print(f"nSizeY: {self.device.nSizeY}")
-        print(f"pad_rows: {pad_rows}")
-        print(f"pad_cols: {pad_cols}")
+        Returns the pattern ID, `None` if the frames do not fit the DMD
+        """
+        if frames.ndim == 2:
+            frames = frames[np.newaxis]
+        if frames.ndim != 3 or len(frames) == 0 or not self.validate_img(frames[0]):
+            print(f"Invalid grayscale frames for the DLP: {frames.shape}")
+            return None
+        data = self.quantize(frames, bit_depth)
+        return self.load_resident(data, bit_depth, picture_time, loop, pattern_id)
+
+    def quantize(self, frames: ImgStack, bit_depth: int) -> ImgStack:
+        """
+        Returns uint8 `frames` quantized to `bit_depth` bits and centered on the DMD
+        as MSB-aligned frames (n, nSizeY, nSizeX)
+        """
+        if frames.ndim == 2:
+            frames = frames[np.newaxis]
+        return quantize_centered(
+            frames, bit_depth, self.device.nSizeX, self.device.nSizeY
+        )
+
+    def load_resident(
+        self,
+        data: np.ndarray,
+        bit_depth: int,
+        picture_time: int | None = None,
+        loop: bool = True,
+        pattern_id: str | None = None,
+    ) -> str:
+        """
+        Uploads packed 1-bit frames, or MSB-aligned frames with a `bit_depth`
+        above 1, unless the same pattern is still resident on the DLP
+        """
+        if pattern_id is None:
+            pattern_id = BitplaneCache.key(data) + f"_{bit_depth}_{picture_time}_{loop}"
+
+        with QMutexLocker(self.set_img_mutex):
+            sequence = self.library.add(
+                pattern_id, data, picture_time, loop, bit_depth
+            )
+            self.pattern_id = pattern_id
+            self.seq_id = sequence.seq_id
+            self.nb_frames = sequence.nb_frames
+            self.loop = sequence.loop
+        return pattern_id
+
+    def switch_pattern(self, pattern_id: str) -> bool:
+        """
+        Projects a pattern that is resident on the DLP, without any upload
+
+        Returns `False` if the pattern was evicted or never loaded
+        """
+        with QMutexLocker(self.set_img_mutex):
+            sequence = self.library.get(pattern_id)
+            if sequence is None or not self.library.switch(pattern_id):
+                return False
+            self.pattern_id = pattern_id
+            self.seq_id = sequence.seq_id
+            self.nb_frames = sequence.nb_frames
+            self.loop = sequence.loop
+        return True
+
+    def play_range(
+        self, first: int, last: int, loop: bool = True, repeat: int = 1
+    ) -> None:
+        """
+        Restarts projection on frames `first` to `last` (inclusive) of the current
+        sequence, either looping or played `repeat` times
+        """
+        if self.pattern_id is None:
+            print("No DLP sequence loaded!")
+            return
+        if not 0 <= first <= last < self.nb_frames:
+            print(f"Invalid frame range {first}-{last} for {self.nb_frames} frames")
+            return
+
+        with QMutexLocker(self.set_img_mutex):
+            self.device.Halt()
+            self.device.SeqControl(ALP_FIRSTFRAME, first, self.seq_id)
+            self.device.SeqControl(ALP_LASTFRAME, last, self.seq_id)
+            if not loop:
+                self.device.SeqControl(ALP_SEQ_REPEAT, repeat, self.seq_id)
+            self.loop = loop
+            sequence = self.library.get(self.pattern_id)
+            sequence.loop = loop
+            sequence.repeat = repeat
+            self.library.switch(self.pattern_id)
+
+    def pad_img_centered(self, img: Img) -> Img:
+        """
+        Pads `img` with zeros so it is centered on the DMD (nSizeY rows, nSizeX columns)
+        """
+        pad_rows = self.device.nSizeY - img.shape[0]
+        pad_cols = self.device.nSizeX - img.shape[1]
 
         padded_img = np.pad(
             array=img,
-            pad_width=((pad_cols, pad_cols), (pad_rows, pad_rows)),
+            pad_width=(
+                (pad_rows // 2, pad_rows - pad_rows // 2),
+                (pad_cols // 2, pad_cols - pad_cols // 2),
+            ),
             mode="constant",
             constant_values=0,
         )
@@ -96,14 +478,20 @@ class DlpThread(QThread):
         """
         Returns True if img is a valid image for the DLP to allocate/use
         """
-        return img.shape <= (self.device.nSizeX, self.device.nSizeY)
+        return (
+            img.ndim == 2
+            and img.shape[0] <= self.device.nSizeY
+            and img.shape[1] <= self.device.nSizeX
+        )
 
     def close(self) -> None:
-        self.device.Halt()
-        self.device.FreeSeq()
+        self.free_sequences()
         self.device.Free()
 
     def stop(self) -> None:
+        with QMutexLocker(self.pending_mutex):
+            self.running = False
+            self.pending_cond.wakeAll()
         self.quit()
 
     def __del__(self) -> None:
@@ -1,16 +1,29 @@
-import serial
-import time 
+import sys
+import time
 
-ser = serial.Serial('COM5', 115200, timeout = 1)
+from serial_link import SerialLink
+
+# e.g. python src/esp32.py COM5, or the `port` printed by fake_esp32.FakeEsp32
+link = SerialLink(sys.argv[1] if len(sys.argv) > 1 else "COM5")
+if not link.open():
+    sys.exit(1)
 time.sleep(2)
 
 while True:
     burst = input("Burst? ")
     if burst == "y":
-        init = time.time() * 1000 
-        ser.write(b'70\n')
-        response = None
-        while response != "DONE":
-            response = ser.readline().decode().strip()
-            print(response)
-        print(f"command time taken {(time.time() * 1000) - init}")
\ No newline at end of file
+        init = time.perf_counter()
+        future = link.pulse(70)
+        print(f"command sent in {(time.perf_counter() - init) * 1000:.3f} ms")
+        try:
+            reply = future.result(timeout=1)
+            print(
+                f"command time taken {reply.round_trip * 1000:.3f} ms, "
+                f"applied at device time {reply.device_time} us"
+            )
+        except Exception as e:
+            print(f"Burst failed: {e}")
+    elif burst == "q":
+        print(f"serial link: {link.stats()}")
+        link.close()
+        break
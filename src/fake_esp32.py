@@ -0,0 +1,127 @@
+import os
+import select
+import struct
+import threading
+import time
+import tty
+
+from serial_link import (
+    ACK,
+    CMD_NACK,
+    CMD_PING,
+    CMD_PULSE,
+    CMD_PWM,
+    REPLY,
+    FrameParser,
+    encode_frame,
+)
+
+# NACK error codes
+ERROR_UNKNOWN_COMMAND = 1
+ERROR_BAD_PAYLOAD = 2
+
+
+class FakeEsp32:
+    """
+    Stand-in for the ESP32 controller behind a pseudo-terminal, for testing the
+    serial code without the board. Unix only.
+
+    Open `port` with `SerialLink` like the board's serial port. Commands are
+    answered after `reply_latency` seconds with the time they took effect on
+    the simulated device clock. `pwm` holds the last PWM period and on time in
+    microseconds.
+    """
+
+    def __init__(self, reply_latency: float = 0.5e-3) -> None:
+        self.reply_latency = reply_latency
+        self.master, self.slave = os.openpty()
+        # No echo or line editing, the frames are binary
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.parser = FrameParser()
+        self.start_time = time.perf_counter()
+        self.running = False
+        self.thread: threading.Thread | None = None
+
+        self.pwm = (0, 0)
+        self.commands: list[tuple[int, int, bytes]] = []
+
+    def micros(self) -> int:
+        return int((time.perf_counter() - self.start_time) * 1e6) & 0xFFFFFFFF
+
+    def reply(self, command: int, seq: int, payload: bytes) -> bytes:
+        if command == CMD_PING:
+            return encode_frame(REPLY | command, seq, ACK.pack(self.micros()))
+        if command == CMD_PWM:
+            if len(payload) != 8:
+                return encode_frame(CMD_NACK, seq, bytes([ERROR_BAD_PAYLOAD]))
+            self.pwm = struct.unpack("<II", payload)
+            return encode_frame(REPLY | command, seq, ACK.pack(self.micros()))
+        if command == CMD_PULSE:
+            if len(payload) != 4:
+                return encode_frame(CMD_NACK, seq, bytes([ERROR_BAD_PAYLOAD]))
+            (on_time,) = struct.unpack("<I", payload)
+            time.sleep(on_time / 1e6)
+            return encode_frame(REPLY | command, seq, ACK.pack(self.micros()))
+        return encode_frame(CMD_NACK, seq, bytes([ERROR_UNKNOWN_COMMAND]))
+
+    def serve(self) -> None:
+        while self.running:
+            try:
+                # Polled so `close()` can stop the thread before closing the fds
+                ready, _, _ = select.select([self.master], [], [], 0.05)
+                if not ready:
+                    continue
+                data = os.read(self.master, 1024)
+            except (OSError, ValueError):
+                # EIO once the port hangs up, EBADF if the fds are closed
+                break
+            for command, seq, payload in self.parser.feed(data):
+                self.commands.append((command, seq, payload))
+                if self.reply_latency > 0:
+                    time.sleep(self.reply_latency)
+                try:
+                    os.write(self.master, self.reply(command, seq, payload))
+                except OSError:
+                    return
+
+    def start(self) -> None:
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def close(self) -> None:
+        self.running = False
+        # The fds may be reused once closed, so `serve` must be done with them
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+            self.thread = None
+        os.close(self.slave)
+        os.close(self.master)
+
+
+if __name__ == "__main__":
+    # Measures command round trips against the fake board
+    from serial_link import SerialLink
+
+    device = FakeEsp32()
+    device.start()
+    link = SerialLink(device.port)
+    link.open()
+
+    ping_times = []
+    for _ in range(100):
+        ping_times.append(link.ping().result(timeout=1).round_trip)
+
+    start = time.perf_counter()
+    futures = [link.set_pwm(100, on_time) for on_time in range(0, 100, 1)]
+    sent = time.perf_counter() - start
+    for future in futures:
+        future.result(timeout=1)
+    assert device.pwm == (100_000, 99_000)
+
+    print(f"ping: {sum(ping_times) / len(ping_times) * 1000:.2f} ms round trip")
+    print(f"pipelined send: {sent / len(futures) * 1e6:.0f} us/command")
+    print(f"serial link: {link.stats()}")
+    link.close()
+    device.close()
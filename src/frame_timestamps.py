@@ -0,0 +1,66 @@
+import os
+import struct
+
+import numpy as np
+
+# Sidecar layout: an 8 byte magic header followed by one little-endian float64
+# per written frame, holding seconds since the first frame of the recording,
+# or NaN for frames written without a capture time.
+TIMESTAMP_MAGIC = b"DLPTS\x00\x01\x00"
+TIMESTAMP_DTYPE = np.dtype("<f8")
+
+
+def sidecar_path(video_path: str) -> str:
+    """
+    Returns the timestamp sidecar path belonging to `video_path`
+    """
+    return os.path.splitext(video_path)[0] + ".ts"
+
+
+class TimestampWriter:
+    """
+    Appends the capture timestamp of every written frame to a binary sidecar
+    next to the video, so variable frame rates and dropped frames survive recording
+    """
+
+    def __init__(self, video_path: str) -> None:
+        self.path = sidecar_path(video_path)
+        self.file = open(self.path, "wb")
+        self.file.write(TIMESTAMP_MAGIC)
+        self.first_timestamp: float | None = None
+        self.count = 0
+
+    def write(self, timestamp: float) -> None:
+        """
+        Records `timestamp` (seconds, any monotonic clock, NaN if unknown) for
+        the next frame
+        """
+        if self.file.closed:
+            return
+        if self.first_timestamp is None and not np.isnan(timestamp):
+            self.first_timestamp = timestamp
+        if self.first_timestamp is not None:
+            timestamp -= self.first_timestamp
+        self.file.write(struct.pack("<d", timestamp))
+        self.count += 1
+
+    def close(self) -> None:
+        if not self.file.closed:
+            self.file.close()
+
+
+def read_timestamps(video_path: str) -> np.ndarray | None:
+    """
+    Loads the per-frame timestamps recorded for `video_path`
+
+    Returns `None` if the video has no (valid) sidecar
+    """
+    path = sidecar_path(video_path)
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "rb") as f:
+        if f.read(len(TIMESTAMP_MAGIC)) != TIMESTAMP_MAGIC:
+            print(f"Ignoring timestamp sidecar with unknown format: {path}")
+            return None
+        return np.fromfile(f, dtype=TIMESTAMP_DTYPE)
@@ -1,74 +1,343 @@
+import hashlib
+import os
+import time
+from collections import deque
+
 import pyvisa
 import numpy as np
+from PySide6.QtCore import QMutex, QMutexLocker
 from pyvisa.resources import USBInstrument
 
+from simulated_fgen import SimulatedResourceManager
+
+# Settings the instrument may adjust when the header on the left changes, e.g. a
+# new function clipping the frequency to its range
+COUPLED = {
+    "FUNC": ("FREQ", "VOLT", "VOLT:OFFS"),
+    "VOLT:UNIT": ("VOLT",),
+}
+
+# DAC codes of the 33220A arbitrary waveform memory, -8191 being the negative
+# and +8191 the positive peak of the amplitude
+DAC_MAX = 8191
+ARB_MAX_POINTS = 65536
+
+
+def encode_dac(samples: np.ndarray) -> np.ndarray:
+    """
+    Converts samples normalized to [-1, 1] into 33220A DAC codes
+    """
+    return np.round(np.clip(samples, -1, 1) * DAC_MAX).astype(np.int16)
+
+
+def pwm_waveform(duty: float, points: int = 1000) -> np.ndarray:
+    """
+    Returns one PWM period as DAC codes, high for the first `duty` of the
+    `points` samples and low for the rest
+    """
+    high = int(round(min(max(duty, 0.0), 1.0) * points))
+    waveform = np.full(points, -DAC_MAX, dtype=np.int16)
+    waveform[:high] = DAC_MAX
+    return waveform
+
+
+def format_value(value) -> str:
+    """
+    Formats a setting the same way every time, so cached and new values compare
+    equal when the instrument would not change
+    """
+    if isinstance(value, (float, np.floating)):
+        return f"{float(value):.10g}"
+    return str(value)
+
+
+def create_resource_manager() -> pyvisa.ResourceManager | SimulatedResourceManager:
+    """
+    Returns the VISA resource manager, or a simulated one listing a 33220A if the
+    `DLPCTL_MOCK_FGEN` environment variable is set or no VISA library is found
+    """
+    if os.environ.get("DLPCTL_MOCK_FGEN"):
+        print("DLPCTL_MOCK_FGEN is set, using a simulated function generator")
+        return SimulatedResourceManager()
+    try:
+        return pyvisa.ResourceManager()
+    except (OSError, ValueError) as e:
+        print(f"VISA library not available ({e}), using a simulated function generator")
+        return SimulatedResourceManager()
+
+
+# Resource manager shared by everything opening VISA instruments
+_resource_manager: pyvisa.ResourceManager | SimulatedResourceManager | None = None
+
+
+def shared_resource_manager() -> pyvisa.ResourceManager | SimulatedResourceManager:
+    """
+    Returns the process-wide resource manager, created on first use
+    """
+    global _resource_manager
+    if _resource_manager is None:
+        _resource_manager = create_resource_manager()
+    return _resource_manager
+
 
 class FunctionGenerator:
     """
     Class representing an Agilent 33220A function generator connected via USB.
+
+    Settings go through `apply()`, which remembers the last value written for
+    each SCPI header, drops the ones that would not change anything and sends
+    the rest as a single `;:` joined message. Read-back verification is off by
+    default and, when on, is also a single query per call.
     """
 
-    def __init__(self) -> None:
+    def __init__(
+        self, rm: pyvisa.ResourceManager | SimulatedResourceManager | None = None
+    ) -> None:
         self.instrument: USBInstrument | None = None
-        self.rm = pyvisa.ResourceManager()
+        self.rm = rm if rm is not None else shared_resource_manager()
         self.PEAK_TO_PEAK = 10  # volts
 
-    def select_instrument(self, rm: pyvisa.ResourceManager, resource_name) -> None:
+        # Last value written for each SCPI header, e.g. {"FREQ": "100"}
+        self.state: dict[str, str] = {}
+        # Reads back every applied setting when True
+        self.verify = False
+        # Serializes instrument I/O between the GUI and analysis threads
+        self.mutex = QMutex()
+
+        self.round_trips = 0
+        self.skipped = 0
+        self.last_error = ""
+
+        # Content hash of the waveform in volatile memory, `None` if unknown
+        self.waveform_key: str | None = None
+        self.uploads = 0
+        self.cached_uploads = 0
+        # Seconds taken by each write or query
+        self.io_times: deque[float] = deque(maxlen=1000)
+
+    def select_instrument(self, rm: pyvisa.ResourceManager, resource_name) -> bool:
         """
-        Used to connect instrument with resource name 
+        Used to connect instrument with resource name
+
+        Returns False if the instrument could not be opened.
         """
-        # Close existing connection
-        if self.instrument:
-            self.instrument.close()
+        # Swapped under the mutex so no write is half way through on the old one
+        with QMutexLocker(self.mutex):
+            # Close existing connection
+            if self.instrument:
+                self.instrument.close()
+                self.instrument = None
+            try:
+                self.instrument = rm.open_resource(resource_name)
+            except pyvisa.errors.Error as e:
+                self.last_error = str(e)
+                print(f"Could not open {resource_name}: {e}")
+                return False
+            # The instrument state is unknown until everything has been written once
+            self.state.clear()
+            self.waveform_key = None
+        return self.apply(
+            {
+                "VOLT:UNIT": "VPP",
+                "VOLT": 0,
+                "VOLT:OFFS": 0,
+                "FREQ": 100,
+                "FUNC": "SQU",
+                "OUTP": "OFF",
+            }
+        )
 
-        instrument = rm.open_resource(resource_name)
-        self.instrument = instrument
-        self.set_voltage(0, "vpp")
-        self.set_voltage(0, "vdc")
-        self.set_frequency(100)
-        self.set_function("SQU")
-        self.instrument.write('OUTP OFF')
+    def write(self, message: str) -> None:
+        start = time.perf_counter()
+        self.instrument.write(message)
+        self.io_times.append(time.perf_counter() - start)
+        self.round_trips += 1
+
+    def query(self, message: str) -> str:
+        start = time.perf_counter()
+        response = self.instrument.query(message)
+        self.io_times.append(time.perf_counter() - start)
+        self.round_trips += 1
+        return response
+
+    def apply(self, settings: dict, force: bool = False) -> bool:
+        """
+        Writes the `settings` ({header: value}) that differ from the cached
+        instrument state as one message, in order, except that headers in
+        `COUPLED` go first so the values they may adjust are written after
+        them. `force` writes all of them.
+
+        Returns False if no instrument is selected or the write failed.
+        """
+        if not self.instrument:
+            self.last_error = "Function generator not selected!"
+            print(self.last_error)
+            return False
+
+        with QMutexLocker(self.mutex):
+            changed = {}
+            for header, value in settings.items():
+                value = format_value(value)
+                if force or self.state.get(header) != value:
+                    changed[header] = value
+            self.skipped += len(settings) - len(changed)
+            if not changed:
+                return True
+            order = sorted(changed, key=lambda h: h not in COUPLED)
+            changed = {header: changed[header] for header in order}
 
-    def set_voltage(self, voltage: float, type: str) -> None:
-        if self.instrument:
             try:
-                if type == "vpp":
-                    self.instrument.write("VOLT:UNIT VPP")
-                    self.instrument.write(f"VOLT {voltage}")
-                    volt_read = float(self.instrument.query("VOLT?"))
-                    volt_unit = self.instrument.query("VOLT:UNIT?").strip()
-                    print(f"Amplitude: {volt_read:.4f} {volt_unit}")
-                else: 
-                    self.instrument.write(f"VOLT:OFFS {voltage}")
-                    off_read = float(self.instrument.query("VOLT:OFFS?"))
-                    print(f"Offset: {off_read:.4f} V")
+                self.write(";:".join(f"{h} {v}" for h, v in changed.items()))
+                self.state.update(changed)
+                # The instrument may clip coupled values to the range of the new
+                # setting, even those written with it
+                for header in changed:
+                    for coupled in COUPLED.get(header, ()):
+                        self.state.pop(coupled, None)
+                if self.verify:
+                    self.read_back(changed)
             except pyvisa.errors.Error as e:
-                print(f"Error setting voltage: {e}")
-        else:
-            print("Function generator not selected!")
+                # Part of the message may have been applied
+                for header in changed:
+                    self.state.pop(header, None)
+                self.last_error = str(e)
+                print(f"Error applying {changed}: {e}")
+                return False
+            return True
+
+    def read_back(self, headers) -> dict[str, str]:
+        """
+        Queries the current value of every header in one message and prints it
+        """
+        headers = list(headers)
+        response = self.query(";:".join(f"{h}?" for h in headers))
+        values = dict(zip(headers, (v.strip() for v in response.split(";"))))
+        print(", ".join(f"{h}: {v}" for h, v in values.items()))
+        return values
+
+    @staticmethod
+    def voltage_settings(voltage: float, type: str) -> dict:
+        if type == "vpp":
+            return {"VOLT:UNIT": "VPP", "VOLT": voltage}
+        return {"VOLT:OFFS": voltage}
+
+    def set_voltage(self, voltage: float, type: str) -> None:
+        self.apply(self.voltage_settings(voltage, type))
 
     def set_frequency(self, frequency: int) -> None:
-        if self.instrument:
-            try:
-                self.instrument.write(f"FREQ {frequency}")
-                print(
-                    f"Current frequency: {np.float64(self.instrument.query('FREQ?')):.4f} Hz"
-                )
-            except pyvisa.errors.Error as e:
-                print(f"Error setting frequency: {e}")
-        else:
-            print("Function generator not selected!")
+        self.apply({"FREQ": frequency})
 
     def set_function(self, function: str) -> None:
         # function can be something like SQU or SIN
-        if self.instrument:
+        self.apply({"FUNC": function})
+
+    def set_output(self, on: bool, force: bool = False) -> None:
+        self.apply({"OUTP": "ON" if on else "OFF"}, force)
+
+    def upload_waveform(self, waveform: np.ndarray) -> bool:
+        """
+        Loads `waveform` (int16 DAC codes) into volatile memory as one binary
+        block and selects it as the output function
+
+        Uploading the waveform already in volatile memory does nothing. Returns
+        False if the upload failed.
+        """
+        if not self.instrument:
+            self.last_error = "Function generator not selected!"
+            print(self.last_error)
+            return False
+        if not 1 <= len(waveform) <= ARB_MAX_POINTS:
+            raise ValueError(f"Waveforms must have 1 to {ARB_MAX_POINTS} points")
+
+        digest = hashlib.blake2b(np.ascontiguousarray(waveform), digest_size=16)
+        key = digest.hexdigest()
+        if key == self.waveform_key:
+            self.cached_uploads += 1
+            return True
+
+        # Little-endian blocks, so the int16 array is sent without byte swapping
+        if not self.apply({"FORM:BORD": "SWAP"}):
+            return False
+        with QMutexLocker(self.mutex):
             try:
-                self.instrument.write(f"FUNC {function}")
-                print(f"Current function: {self.instrument.query('FUNC?').strip()}")
+                start = time.perf_counter()
+                self.instrument.write_binary_values(
+                    "DATA:DAC VOLATILE, ", waveform, datatype="h", is_big_endian=False
+                )
+                self.io_times.append(time.perf_counter() - start)
+                self.round_trips += 1
             except pyvisa.errors.Error as e:
-                print(f"Error setting function: {e}")
+                self.waveform_key = None
+                self.last_error = str(e)
+                print(f"Error uploading waveform: {e}")
+                return False
+            self.waveform_key = key
+            self.uploads += 1
+        # The new data only plays once VOLATILE is selected again
+        return self.apply({"FUNC:USER": "VOLATILE", "FUNC": "USER"}, force=True)
+
+    def configure_burst(
+        self,
+        mode: str = "GAT",
+        cycles: int = 1,
+        phase: float = 0.0,
+        polarity: str = "NORM",
+        source: str = "EXT",
+    ) -> bool:
+        """
+        Enables burst mode, either gated by the rear trigger input (`GAT`) or
+        `cycles` periods per trigger from `source` (`TRIG`)
+        """
+        settings = {"BURS:MODE": mode, "BURS:PHAS": phase}
+        if mode == "GAT":
+            settings["BURS:GATE:POL"] = polarity
         else:
-            print("Function generator not selected!")
+            settings["BURS:NCYC"] = cycles
+            settings["TRIG:SOUR"] = source
+        settings["BURS:STAT"] = "ON"
+        return self.apply(settings)
+
+    def disable_burst(self) -> bool:
+        return self.apply({"BURS:STAT": "OFF"})
+
+    def apply_pid_duty(self, pid, points: int = 1000) -> bool:
+        """
+        Plays the PWM cycle of a `CirclePID` as an arbitrary waveform, so the
+        instrument does the on/off timing. Only a changed duty cycle, at
+        `points` resolution, is uploaded.
+        """
+        return self.apply_pwm_cycle(pid.pwm_cycle, points)
+
+    def apply_pwm_cycle(self, pwm_cycle: list[float], points: int = 1000) -> bool:
+        """
+        Plays `pwm_cycle` ([on_time, off_time] in milliseconds) as an arbitrary
+        waveform
+        """
+        on_time, off_time = pwm_cycle
+        period = on_time + off_time
+        if period <= 0:
+            return False
+        if not self.upload_waveform(pwm_waveform(on_time / period, points)):
+            return False
+        # Cycle times are in milliseconds
+        return self.apply({"FREQ": 1000 / period})
+
+    def stats(self) -> dict[str, float]:
+        """
+        Returns the instrument round trips, skipped settings and I/O times in
+        milliseconds
+        """
+        stats = {
+            "round_trips": self.round_trips,
+            "skipped": self.skipped,
+            "uploads": self.uploads,
+            "cached_uploads": self.cached_uploads,
+        }
+        if len(self.io_times) > 0:
+            times = np.array(self.io_times) * 1000
+            stats["io_mean_ms"] = float(times.mean())
+            stats["io_p99_ms"] = float(np.percentile(times, 99))
+        return stats
 
     def __del__(self) -> None:
         if self.instrument:
@@ -0,0 +1,82 @@
+import numpy as np
+
+MAX_BIT_DEPTH = 8
+
+# (shift, mask) of the three delta swaps transposing an 8x8 bit matrix held in
+# a 64-bit word, from Hacker's Delight
+TRANSPOSE_STEPS = [
+    (np.uint64(7), np.uint64(0x00AA00AA00AA00AA)),
+    (np.uint64(14), np.uint64(0x0000CCCC0000CCCC)),
+    (np.uint64(28), np.uint64(0x00000000F0F0F0F0)),
+]
+
+
+def quantization_lut(bit_depth: int) -> np.ndarray:
+    """
+    Returns the 256 entry table rounding 8-bit intensities to `bit_depth` bits,
+    MSB-aligned as the ALP reads grayscale sequences
+    """
+    if not 1 <= bit_depth <= MAX_BIT_DEPTH:
+        raise ValueError(f"Bit depth must be between 1 and {MAX_BIT_DEPTH}")
+    levels = (1 << bit_depth) - 1
+    values = np.round(np.arange(256) * levels / 255).astype(np.uint16)
+    return (values << (MAX_BIT_DEPTH - bit_depth)).astype(np.uint8)
+
+
+def quantize_centered(
+    frames: np.ndarray, bit_depth: int, size_x: int = 1024, size_y: int = 768
+) -> np.ndarray:
+    """
+    Quantizes a (n, h, w) uint8 stack to `bit_depth` bits and centers it on the
+    DMD in a single pass, returning (n, size_y, size_x) MSB-aligned frames
+    """
+    n, h, w = frames.shape
+    row = (size_y - h) // 2
+    col = (size_x - w) // 2
+
+    out = np.zeros((n, size_y, size_x), dtype=np.uint8)
+    np.take(
+        quantization_lut(bit_depth),
+        frames.astype(np.uint8, copy=False),
+        out=out[:, row : row + h, col : col + w],
+        mode="clip",
+    )
+    return out
+
+
+def bitplanes(frames: np.ndarray, bit_depth: int = MAX_BIT_DEPTH) -> np.ndarray:
+    """
+    Decomposes MSB-aligned uint8 frames (..., h, w) into their packed bit planes
+    (..., bit_depth, h, w / 8), most significant plane first
+
+    Every group of 8 pixels is read as one 64-bit word holding an 8x8 bit matrix
+    (pixel by bit), and all words are transposed at once with three masked
+    swaps, which leaves each byte holding one packed plane. `w` must be a
+    multiple of 8.
+    """
+    words = frames.reshape(*frames.shape[:-1], -1, 8).view("<u8")[..., 0]
+    # Reversed byte order puts the first pixel in the most significant bit
+    words = words.byteswap()
+    swap = np.empty_like(words)
+    for shift, mask in TRANSPOSE_STEPS:
+        np.right_shift(words, shift, out=swap)
+        swap ^= words
+        swap &= mask
+        words ^= swap
+        swap <<= shift
+        words ^= swap
+    words.byteswap(inplace=True)
+
+    planes = words[..., np.newaxis].view(np.uint8)
+    return np.ascontiguousarray(np.moveaxis(planes, -1, -3)[..., :bit_depth, :, :])
+
+
+def combine_bitplanes(planes: np.ndarray) -> np.ndarray:
+    """
+    Inverse of `bitplanes()`, returns the MSB-aligned uint8 frames
+    """
+    bit_depth = planes.shape[-3]
+    bits = np.unpackbits(planes, axis=-1)
+    weights = 1 << np.arange(MAX_BIT_DEPTH - 1, MAX_BIT_DEPTH - 1 - bit_depth, -1)
+    frames = np.tensordot(bits, weights.astype(np.uint8), axes=([-3], [0]))
+    return frames.astype(np.uint8, copy=False)
@@ -0,0 +1,137 @@
+import time
+
+from PySide6.QtCore import QMutex, QMutexLocker, QThread, QWaitCondition, Signal
+
+from function_generator import FunctionGenerator
+from latency_trace import LatencyTracer
+
+
+class InstrumentWorker(QThread):
+    """
+    A `QThread` based class doing the function generator I/O off the GUI thread.
+
+    `select_instrument()` connects to an instrument before any pending value
+    is sent, so opening it never blocks the caller either.
+    Settings are submitted per SCPI header and only the latest value of each
+    header is kept until the worker gets to it, so a burst of slider values
+    collapses into a single write of the final one. PID duty cycles given to
+    `set_pwm_cycle()` are played as arbitrary waveforms the same way, latest
+    first. Neither call waits on the instrument.
+    """
+
+    # Emitted with the settings ({header: value}) once they are applied
+    completed = Signal(object)
+    # Emitted with the settings and the error when they could not be applied
+    failed = Signal(object, str)
+    # Emitted with the resource name and whether the instrument was connected
+    selected = Signal(str, bool)
+
+    def __init__(self, fgen: FunctionGenerator) -> None:
+        super().__init__()
+        self.fgen = fgen
+        self.running = False
+
+        # Resource manager and name of the instrument to connect to, if any
+        self.pending_instrument: tuple | None = None
+        # Latest value submitted for each header, in latest submission order
+        self.pending: dict = {}
+        # Latest [on_time, off_time] in milliseconds to play, if any
+        self.pending_pwm: list[float] | None = None
+        # `LatencyTracer` ID of the frame the pending PWM cycle was computed from
+        self.pending_frame_id: int | None = None
+        self.mutex = QMutex()
+        self.cond = QWaitCondition()
+        # If set, gets the writes of each frame's PWM cycle that reached the
+        # instrument
+        self.tracer: LatencyTracer | None = None
+
+        # Number of submitted values replaced before they were sent
+        self.coalesced = 0
+
+    def submit(self, settings: dict) -> None:
+        with QMutexLocker(self.mutex):
+            for header, value in settings.items():
+                # Re-inserted so the latest value goes after earlier headers
+                if header in self.pending:
+                    del self.pending[header]
+                    self.coalesced += 1
+                self.pending[header] = value
+            self.cond.wakeAll()
+
+    def select_instrument(self, rm, resource_name: str) -> None:
+        with QMutexLocker(self.mutex):
+            self.pending_instrument = (rm, resource_name)
+            self.cond.wakeAll()
+
+    def set_voltage(self, voltage: float, type: str) -> None:
+        self.submit(FunctionGenerator.voltage_settings(voltage, type))
+
+    def set_frequency(self, frequency: int) -> None:
+        self.submit({"FREQ": frequency})
+
+    def set_function(self, function: str) -> None:
+        self.submit({"FUNC": function})
+
+    def set_output(self, on: bool) -> None:
+        self.submit({"OUTP": "ON" if on else "OFF"})
+
+    def set_pwm_cycle(
+        self, pwm_cycle: list[float], frame_id: int | None = None
+    ) -> None:
+        """
+        Plays `pwm_cycle` with `FunctionGenerator.apply_pwm_cycle()`
+        """
+        with QMutexLocker(self.mutex):
+            if self.pending_pwm is not None:
+                self.coalesced += 1
+            self.pending_pwm = list(pwm_cycle)
+            self.pending_frame_id = frame_id
+            self.cond.wakeAll()
+
+    def run(self) -> None:
+        self.running = True
+        while True:
+            with QMutexLocker(self.mutex):
+                while self.running and not self.has_pending():
+                    self.cond.wait(self.mutex)
+                # Settings submitted before `stop()` are still sent
+                if not self.has_pending():
+                    return
+                instrument = self.pending_instrument
+                self.pending_instrument = None
+                settings = self.pending
+                self.pending = {}
+                pwm_cycle = self.pending_pwm
+                frame_id = self.pending_frame_id
+                self.pending_pwm = None
+
+            if instrument is not None:
+                rm, resource_name = instrument
+                self.selected.emit(
+                    resource_name, self.fgen.select_instrument(rm, resource_name)
+                )
+            if settings:
+                if self.fgen.apply(settings):
+                    self.completed.emit(settings)
+                else:
+                    self.failed.emit(settings, self.fgen.last_error)
+            if pwm_cycle is not None and self.fgen.instrument:
+                enqueued = time.perf_counter_ns()
+                round_trips = self.fgen.round_trips
+                self.fgen.apply_pwm_cycle(pwm_cycle)
+                # A cached waveform at an unchanged frequency sends nothing
+                if self.tracer is not None and self.fgen.round_trips != round_trips:
+                    self.tracer.stamp(frame_id, "enqueue", enqueued)
+                    self.tracer.stamp(frame_id, "ack")
+
+    def has_pending(self) -> bool:
+        return (
+            self.pending_instrument is not None
+            or bool(self.pending)
+            or self.pending_pwm is not None
+        )
+
+    def stop(self) -> None:
+        with QMutexLocker(self.mutex):
+            self.running = False
+            self.cond.wakeAll()
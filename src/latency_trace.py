@@ -0,0 +1,182 @@
+import csv
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from PySide6.QtCore import QMutex, QMutexLocker
+
+# Stages of a frame from the camera to the actuator, in order:
+#   grab            camera thread got the frame from the camera
+#   received        analysis thread picked the frame up
+#   analysis_start  `frame_analysis()` called
+#   analysis_end    `frame_analysis()` returned
+#   pid_update      PID output computed from the frame's radius
+#   enqueue         PWM command written to the ESP32 or function generator
+#   ack             ESP32 acknowledged the command, or the instrument write returned
+STAGES = (
+    "grab",
+    "received",
+    "analysis_start",
+    "analysis_end",
+    "pid_update",
+    "enqueue",
+    "ack",
+)
+STAGE_INDEX = {stage: i for i, stage in enumerate(STAGES)}
+
+
+class LatencyTracer:
+    """
+    Records `time.perf_counter_ns()` stamps of every traced frame at each of
+    `STAGES`, so the latency from grabbing a frame to actuating on it can be
+    split up per stage.
+
+    `new_frame()` hands out increasing frame IDs, which travel with the frame
+    through the analysis thread, control loop and actuator. Each stage keeps
+    its first stamp, since the control loop and actuator may act on a frame
+    more than once. The last `capacity` frames are kept. Any thread may stamp.
+
+    The camera timestamp of the exposure is on the camera's own clock, so
+    `grab` is the host time the frame was retrieved and excludes exposure and
+    transfer.
+    """
+
+    def __init__(self, capacity: int = 4096) -> None:
+        self.capacity = capacity
+        self.next_id = 0
+        self.frame_ids = np.full(capacity, -1, dtype=np.int64)
+        # 0 where a frame did not reach a stage
+        self.stamps = np.zeros((capacity, len(STAGES)), dtype=np.int64)
+        self.mutex = QMutex()
+
+    def new_frame(self, grab_time: int | None = None) -> int:
+        """
+        Starts tracing a frame grabbed at `grab_time` (`perf_counter_ns()`,
+        now if `None`) and returns its ID
+        """
+        if grab_time is None:
+            grab_time = time.perf_counter_ns()
+        with QMutexLocker(self.mutex):
+            frame_id = self.next_id
+            self.next_id += 1
+            row = frame_id % self.capacity
+            self.frame_ids[row] = frame_id
+            self.stamps[row] = 0
+            self.stamps[row, 0] = grab_time
+        return frame_id
+
+    def stamp(self, frame_id: int | None, stage: str, t: int | None = None) -> None:
+        """
+        Records that frame `frame_id` reached `stage` at `t` (`perf_counter_ns()`,
+        now if `None`), unless it already did or the frame is no longer kept
+        """
+        if frame_id is None:
+            return
+        if t is None:
+            t = time.perf_counter_ns()
+        row = frame_id % self.capacity
+        col = STAGE_INDEX[stage]
+        with QMutexLocker(self.mutex):
+            if self.frame_ids[row] == frame_id and self.stamps[row, col] == 0:
+                self.stamps[row, col] = t
+
+    def snapshot(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the frame IDs and stamps of the kept frames in frame order
+        """
+        with QMutexLocker(self.mutex):
+            valid = self.frame_ids >= 0
+            frame_ids = self.frame_ids[valid]
+            stamps = self.stamps[valid]
+        order = np.argsort(frame_ids)
+        return frame_ids[order], stamps[order]
+
+    def stats(self) -> dict[str, float]:
+        return trace_stats(self.snapshot()[1])
+
+    def export(self, path: str) -> None:
+        """
+        Saves the trace to `path`. `.npz` and `.csv` keep every stamp, `.json`
+        only the per-stage statistics.
+        """
+        frame_ids, stamps = self.snapshot()
+        ext = os.path.splitext(path)[1].lower()
+        if ext == ".npz":
+            np.savez(path, frame_ids=frame_ids, stamps=stamps, stages=np.array(STAGES))
+        elif ext == ".csv":
+            with open(path, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(("frame_id",) + STAGES)
+                for frame_id, row in zip(frame_ids.tolist(), stamps.tolist()):
+                    writer.writerow([frame_id] + row)
+        elif ext == ".json":
+            with open(path, "w") as f:
+                json.dump(trace_stats(stamps), f, indent=2)
+        else:
+            raise ValueError(f"Unknown trace format {ext!r}, use .npz, .csv or .json")
+
+
+def trace_stats(stamps: np.ndarray) -> dict[str, float]:
+    """
+    Returns p50/p99/max in milliseconds of the time each stage took, from the
+    last earlier stage the frame reached, and of the total from grab to ack
+    """
+    stats = {"frames": len(stamps)}
+    reached = stamps > 0
+
+    def add(name: str, ns: np.ndarray) -> None:
+        if len(ns) == 0:
+            return
+        ms = ns / 1e6
+        stats[f"{name}_p50_ms"] = float(np.percentile(ms, 50))
+        stats[f"{name}_p99_ms"] = float(np.percentile(ms, 99))
+        stats[f"{name}_max_ms"] = float(ms.max())
+
+    last = stamps[:, 0].copy()
+    for col in range(1, len(STAGES)):
+        both = reached[:, col] & (last > 0)
+        add(STAGES[col], stamps[both, col] - last[both])
+        last = np.where(reached[:, col], stamps[:, col], last)
+
+    ack = STAGE_INDEX["ack"]
+    done = reached[:, 0] & reached[:, ack]
+    add("total", stamps[done, ack] - stamps[done, 0])
+    return stats
+
+
+def load_stats(path: str) -> dict[str, float]:
+    """
+    Returns the statistics of a trace exported in any format
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".json":
+        with open(path) as f:
+            return json.load(f)
+    if ext == ".npz":
+        with np.load(path) as data:
+            stamps = data["stamps"]
+    else:
+        stamps = np.loadtxt(path, delimiter=",", skiprows=1, dtype=np.int64, ndmin=2)
+        stamps = stamps[:, 1:]
+    return trace_stats(stamps)
+
+
+if __name__ == "__main__":
+    # Compares exported traces, e.g. python src/latency_trace.py before.npz after.npz
+    if len(sys.argv) < 2:
+        print("usage: python src/latency_trace.py TRACE [TRACE ...]")
+        sys.exit(1)
+
+    runs = [load_stats(path) for path in sys.argv[1:]]
+    names = [os.path.basename(path) for path in sys.argv[1:]]
+    print(f"{'':26}" + "".join(f"{name[:16]:>18}" for name in names))
+    print(f"{'frames':26}" + "".join(f"{run['frames']:>18}" for run in runs))
+    for stage in STAGES[1:] + ("total",):
+        for stat in ("p50", "p99", "max"):
+            key = f"{stage}_{stat}_ms"
+            values = "".join(
+                f"{run[key]:>18.3f}" if key in run else f"{'-':>18}" for run in runs
+            )
+            print(f"{stage + ' ' + stat + ' (ms)':26}{values}")
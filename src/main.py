@@ -1,3 +1,4 @@
+import os
 import sys
 from functools import partial
 
@@ -8,7 +9,9 @@ from PySide6.QtWidgets import (
     QFileDialog,
     QListWidgetItem,
     QMainWindow,
+    QCheckBox,
     QPushButton,
+    QSpinBox,
 )
 
 import cv2 as cv
@@ -18,16 +21,24 @@ import serial
 
 import time
 
-from pyvisa import ResourceManager
-from pyvisa.resources import USBInstrument
 
-from function_generator import FunctionGenerator
+from function_generator import FunctionGenerator, shared_resource_manager
+from device_discovery import DeviceDiscovery
+from instrument_worker import InstrumentWorker
 from ui.ui_dlpctl import Ui_MainWindow
 
 from camera_thread import CameraThread
 from video_write_thread import VideoWriteThread
 from dlp_thread import DlpThread
 from video_read_thread import VideoReadThread
+from ring_recorder import RingRecorder
+from closed_loop_mask import ClosedLoopMasker
+from dlp_calibration import Calibration, CalibrationThread, calibration_path
+from serial_link import SerialLink
+from pwm_actuator import PwmActuator
+from control_loop import ControlLoop
+from latency_trace import LatencyTracer
+from segmented_video import new_recording_dir
 
 
 class MainWindow(QMainWindow, Ui_MainWindow):
@@ -89,6 +100,34 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             "waveform" : None,
             "vpp" : 0,
             "vdc" : 0,
+            # radius in px that triggers a ring buffer recording, 0 disables it
+            "trigger_radius" : 0,
+            "roi_recording_on" : False,
+            # display time of each frame of a DLP sequence in us, 0 for the device default
+            "dlp_picture_time" : 0,
+            # bits per pixel of loaded DLP images, above 1 they are projected in grayscale
+            "dlp_bit_depth" : 1,
+            # project masks of the tracked bubbles every `closed_loop_mask_every` frames
+            "closed_loop_mask_on" : False,
+            # "disc", "annulus" or "exclusion"
+            "closed_loop_mask_mode" : "disc",
+            "closed_loop_mask_every" : 1,
+            # name the camera to DLP calibration is cached under
+            "calibration_setup" : "default",
+            # read back every function generator setting after writing it
+            "fgen_verify" : False,
+            # play the PID duty cycle as a function generator arbitrary waveform
+            "fgen_arb_pid_on" : False,
+            # stream the PID output to the ESP32 over `serial_port` while PID is on
+            "pwm_actuator_on" : False,
+            # PWM updates sent per second
+            "pwm_actuator_rate" : 50,
+            # run the PID at a fixed rate on its own thread instead of per analysed frame
+            "control_loop_on" : False,
+            # PID updates per second of the control loop
+            "control_loop_rate" : 100,
+            # stamp every analysed frame from grab to actuation, exported on close
+            "latency_trace_on" : False,
         }
 
         self.frame_pos = 0
@@ -97,20 +136,53 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.opened_files = []
 
         self.camera: CameraThread = CameraThread()
+        # If `None`, frames are not latency traced
+        self.latency_tracer: LatencyTracer | None = None
+        if self.settings["latency_trace_on"]:
+            self.latency_tracer = LatencyTracer()
+        self.camera.tracer = self.latency_tracer
         self.pushButton.clicked.connect(self.connect_camera)
         
         self.video_writer: VideoWriteThread = VideoWriteThread()
+        # Queued behind the frames the camera already sent to the writer
+        self.camera.release_out.connect(
+            self.video_writer.release_writer, Qt.ConnectionType.QueuedConnection
+        )
+
+        # Keeps the last seconds of camera frames so events can be saved after the fact
+        self.ring_recorder: RingRecorder = RingRecorder(fps=self.camera.desired_fps)
 
         self.dlp: DlpThread = DlpThread()
         self.pushButton_2.clicked.connect(self.connect_dlp)
+        self.closed_loop_masker: ClosedLoopMasker = ClosedLoopMasker(self.dlp)
+
+        # Camera to DLP mapping from the last calibration of this setup, if any
+        self.calibration: Calibration | None = Calibration.load(
+            calibration_path(self.settings["calibration_setup"])
+        )
+        if self.calibration:
+            self.closed_loop_masker.set_homography(self.calibration.homography)
+        self.calibration_thread: CalibrationThread | None = None
 
         self.serial = None
         self.serial_port = 'COM5'
+        self.serial_link: SerialLink | None = None
+        self.pwm_actuator: PwmActuator | None = None
+        self.control_loop: ControlLoop | None = None
 
         self.exposure_slider.sliderReleased.connect(self.exposure_slider_changed)
         self.exposure_spinbox.valueChanged.connect(self.exposure_slider.setValue)
 
         self.function_generator: FunctionGenerator = FunctionGenerator()
+        self.function_generator.verify = self.settings["fgen_verify"]
+        # Sends function generator settings in the background, latest value wins
+        self.instrument_worker: InstrumentWorker = InstrumentWorker(
+            self.function_generator
+        )
+        self.instrument_worker.failed.connect(self.on_instrument_failed)
+        self.instrument_worker.selected.connect(self.on_instrument_selected)
+        self.instrument_worker.tracer = self.latency_tracer
+        self.instrument_worker.start()
         self.waveform_combobox.activated.connect(self.update_waveform)
 
         self.freq_slider.valueChanged.connect(self.freq_spinbox.setValue)
@@ -125,7 +197,13 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.offset_voltage_spinbox.valueChanged.connect(partial(self.update_voltage, "vdc", "spinbox"))
 
 
-        self.rm = ResourceManager()
+        # Simulated when DLPCTL_MOCK_FGEN is set or NI-VISA is missing
+        self.rm = shared_resource_manager()
+        # Probes VISA resources in the background and caches their IDN
+        self.device_discovery: DeviceDiscovery = DeviceDiscovery(self.rm)
+        self.device_discovery.found.connect(self.on_device_found)
+        self.device_discovery.failed.connect(self.on_device_failed)
+        self.device_discovery.done.connect(self.on_devices_done)
         self.refresh_devices.clicked.connect(self.refresh_devices_clicked)
         # key: resource name, value: (idn, list_item, list_widget)
         self.visa_insts: dict[
@@ -137,6 +215,47 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.capture.setEnabled(False)
         self.capture.pressed.connect(self.on_capture)
 
+        self.trigger = QPushButton("Trigger", self.horizontalFrame_2)
+        self.horizontalLayout.insertWidget(
+            self.horizontalLayout.indexOf(self.capture) + 1, self.trigger
+        )
+        self.trigger.setEnabled(False)
+        self.trigger.pressed.connect(self.on_trigger)
+
+        self.roi_recording = QPushButton("ROI Rec", self.horizontalFrame_2)
+        self.roi_recording.setCheckable(True)
+        self.horizontalLayout.insertWidget(
+            self.horizontalLayout.indexOf(self.trigger) + 1, self.roi_recording
+        )
+        self.roi_recording.clicked.connect(self.checked_roi_recording)
+
+        # Bubble radius that triggers a ring buffer recording, 0 turns it off
+        self.trigger_radius = QSpinBox(self.horizontalFrame_2)
+        self.trigger_radius.setRange(0, 1000)
+        self.trigger_radius.setSuffix(" px")
+        self.trigger_radius.setSpecialValueText("Radius trigger off")
+        self.trigger_radius.setToolTip("Record when a bubble grows past this radius")
+        self.trigger_radius.setValue(self.settings["trigger_radius"])
+        self.horizontalLayout.insertWidget(
+            self.horizontalLayout.indexOf(self.trigger) + 1, self.trigger_radius
+        )
+        self.trigger_radius.valueChanged.connect(self.update_trigger_radius)
+
+        self.mask_loop = QPushButton("Mask Loop", self.horizontalFrame_2)
+        self.mask_loop.setCheckable(True)
+        self.horizontalLayout.insertWidget(
+            self.horizontalLayout.indexOf(self.load_bitmask) + 1, self.mask_loop
+        )
+        self.mask_loop.setEnabled(False)
+        self.mask_loop.clicked.connect(self.checked_mask_loop)
+
+        self.calibrate = QPushButton("Calibrate", self.horizontalFrame_2)
+        self.horizontalLayout.insertWidget(
+            self.horizontalLayout.indexOf(self.mask_loop) + 1, self.calibrate
+        )
+        self.calibrate.setEnabled(False)
+        self.calibrate.pressed.connect(self.on_calibrate)
+
         self.analysis_button.setChecked(self.analysis_on)
         self.analysis_button.clicked.connect(self.checked_analysis)
 
@@ -196,6 +315,35 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.selection_checkbox.stateChanged.connect(self.checked_selection)
         self.pid_checkbox.stateChanged.connect(self.checked_pid)
 
+        self.fgen_arb_pid = self.add_pid_option(
+            "Function generator PWM", "fgen_arb_pid_on", 2
+        )
+        self.fgen_arb_pid.setToolTip(
+            "Play the PID duty cycle as an arbitrary waveform on the function generator"
+        )
+        self.fgen_arb_pid.toggled.connect(self.checked_fgen_arb_pid)
+        self.pwm_actuator_checkbox = self.add_pid_option(
+            "ESP32 PWM", "pwm_actuator_on", 3
+        )
+        self.pwm_actuator_checkbox.setToolTip(
+            "Stream the PID duty cycle to the ESP32, which times the pulses"
+        )
+        self.pwm_actuator_checkbox.toggled.connect(self.checked_pwm_actuator)
+        self.control_loop_checkbox = self.add_pid_option(
+            "Fixed rate control loop", "control_loop_on", 4
+        )
+        self.control_loop_checkbox.setToolTip(
+            "Run the PID on its own thread at a constant rate"
+        )
+        self.control_loop_checkbox.toggled.connect(self.checked_control_loop)
+        self.latency_trace_checkbox = self.add_pid_option(
+            "Latency trace", "latency_trace_on", 5
+        )
+        self.latency_trace_checkbox.setToolTip(
+            "Time every frame from grab to actuation, saved when unchecked or on close"
+        )
+        self.latency_trace_checkbox.toggled.connect(self.checked_latency_trace)
+
         self.clear_all.pressed.connect(self.clear_all_bubbles)
 
         self.actionOpen.triggered.connect(self.on_open)
@@ -218,6 +366,11 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.ReadThread.update_camera_frame(data)
 
     def refresh_devices_clicked(self):
+        # The running refresh is still filling the list
+        if self.device_discovery.isRunning():
+            print("Device refresh already running")
+            return
+
         # Clear out visa instruments from list
         for inst in self.visa_insts.values():
             li = inst[1]  # list item
@@ -227,29 +380,29 @@ class MainWindow(QMainWindow, Ui_MainWindow):
                 self.device_list.takeItem(row)
                 del li
                 lw.close()
+        self.visa_insts = {}
 
         print("Refreshing device list")
-        resources = self.rm.list_resources()
-        for i, resource in enumerate(resources):
-            try:
-                with self.rm.open_resource(resource) as instrument:
-                    print(f"instrument {i} detected of type {type(instrument)}")
-                    if isinstance(instrument, USBInstrument):
-                        idn = instrument.query("*IDN?").strip()
-                        list_item = QListWidgetItem(self.device_list)
-                        list_button = QPushButton(f"{instrument.model_name}")
-
-                        self.visa_insts[resource] = (idn, list_item, list_button)
-                        self.device_list.addItem(list_item)
-                        self.device_list.setItemWidget(list_item, list_button)
-
-                        if "Waveform Generator" in instrument.model_name:
-                            list_button.clicked.connect(
-                                partial(self.connect_function_generator_clicked, resource)
-                            )
-            except Exception as e:
-                print(e)
-                self.visa_insts[resource] = ("VISA Device (No IDN)", None, None)
+        self.device_discovery.refresh()
+
+    def on_device_found(self, resource: str, idn: str, model_name: str):
+        list_item = QListWidgetItem(self.device_list)
+        list_button = QPushButton(f"{model_name}")
+
+        self.visa_insts[resource] = (idn, list_item, list_button)
+        self.device_list.addItem(list_item)
+        self.device_list.setItemWidget(list_item, list_button)
+
+        if "Waveform Generator" in model_name:
+            list_button.clicked.connect(
+                partial(self.connect_function_generator_clicked, resource)
+            )
+
+    def on_device_failed(self, resource: str, error: str):
+        print(f"{resource}: {error}")
+        self.visa_insts[resource] = ("VISA Device (No IDN)", None, None)
+
+    def on_devices_done(self, count: int):
         print(f"VISA devices detected: {self.visa_insts}")
 
     def exposure_slider_changed(self):
@@ -257,7 +410,12 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.exposure_spinbox.setValue(self.exposure_slider.value())
 
     def connect_function_generator_clicked(self, idn: str):
-        self.function_generator.select_instrument(self.rm, idn)
+        self.instrument_worker.select_instrument(self.rm, idn)
+
+    def on_instrument_selected(self, resource: str, connected: bool):
+        # Failures are printed by the function generator
+        if connected:
+            print(f"Function generator connected: {resource}")
     
 
     def update_waveform(self):
@@ -271,7 +429,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         }
         command_str = self.waveform_combobox.currentText()
         if command_str in commands:
-            self.function_generator.set_function(commands[command_str])
+            self.instrument_worker.set_function(commands[command_str])
             self.update_settings("waveform", commands[command_str])
 
     def update_freq(self, val):
@@ -289,7 +447,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         if val > 10 * 1e6:
             print("Frequency too high, max frequency: 10 MHz")
         else:
-            self.function_generator.set_frequency(int(val))
+            self.instrument_worker.set_frequency(int(val))
 
         self.update_settings("freq", int(val))
 
@@ -323,7 +481,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         factor = units[cfg["unit_widget"].currentText()]
         val = val * factor
 
-        self.function_generator.set_voltage(val, voltage_type)
+        self.instrument_worker.set_voltage(val, voltage_type)
         self.update_settings(voltage_type, val)
 
     def connect_camera(self):
@@ -331,21 +489,30 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             if self.camera.open():
                 self.camera.start()
                 self.capture.setEnabled(True)
+                self.trigger.setEnabled(True)
                 self.pushButton.setStyleSheet("color: green;")
+                self.camera.ring = self.ring_recorder
+                if not self.ring_recorder.isRunning():
+                    self.ring_recorder.start()
                 self.camera.frame_out.connect(self.video_writer.save_frame)
                 # self.camera.display_out.connect(self.update_display)
                 self.camera.display_out.connect(self.on_camera_frame)
                 self.update_settings("source", "camera")
+                self.calibrate.setEnabled(self.dlp.connected)
                 self.read_video()
             else:
                 self.capture.setEnabled(False)
+                self.trigger.setEnabled(False)
                 self.pushButton.setStyleSheet("")
                 print("Could not connect to camera")
         else:
             self.camera.stop_recording()
             self.camera.stop_grabbing()
             self.camera.close()
+            self.camera.ring = None
             self.capture.setEnabled(False)
+            self.trigger.setEnabled(False)
+            self.calibrate.setEnabled(False)
             self.pushButton.setStyleSheet("")
 
     def connect_dlp(self):
@@ -353,9 +520,17 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             if self.dlp.open():
                 self.pushButton_2.setStyleSheet("color: green;")
                 self.load_bitmask.setEnabled(True)
+                self.mask_loop.setEnabled(True)
+                self.calibrate.setEnabled(self.camera.basler is not None)
+                self.dlp.pattern_swapped.connect(self.on_pattern_swapped)
+                self.dlp.pattern_swapped.connect(
+                    self.closed_loop_masker.on_pattern_swapped
+                )
+                self.dlp.start()
             else:
                 self.pushButton_2.setStyleSheet("")
                 self.load_bitmask.setEnabled(False)
+                self.mask_loop.setEnabled(False)
 
     def on_capture(self):
         if not self.camera.recording:
@@ -364,43 +539,78 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         else:
             self.camera.stop_recording()
             self.capture.setStyleSheet("")
-            print("stopping capture, saved to output.mp4")
+            print("stopping capture")
+
+    def on_trigger(self):
+        self.ring_recorder.trigger("button")
 
     def on_load_bitmask(self):
-        filename = QFileDialog.getOpenFileName(
+        filenames = QFileDialog.getOpenFileNames(
             self.load_bitmask,
             "Open bitmask",
             "",
             ("Image Files (*.png *.jpg *.bmp"),
         )[0]
 
-        bitmask = cv.imread(filename, cv.IMREAD_GRAYSCALE)
-
-        self.dlp.img = bitmask
-        self.dlp.run()
+        if len(filenames) == 0:
+            return
+
+        # Several files are uploaded as one sequence, played in name order
+        picture_time = self.settings["dlp_picture_time"]
+        bit_depth = self.settings["dlp_bit_depth"]
+        if self.dlp.double_buffer and self.dlp.isRunning():
+            self.dlp.queue_bitmask_files(sorted(filenames), picture_time, bit_depth)
+        elif self.dlp.load_bitmask_files(sorted(filenames), picture_time, bit_depth):
+            self.dlp.project()
+            print(f"DLP pattern library: {self.dlp.library.stats()}")
+
+    def on_calibrate(self):
+        if self.calibration_thread and self.calibration_thread.isRunning():
+            return
+        if self.mask_loop.isChecked():
+            self.mask_loop.setChecked(False)
+            self.checked_mask_loop()
+
+        self.calibrate.setStyleSheet("color: orange;")
+        self.calibration_thread = CalibrationThread(
+            self.dlp, self.settings["calibration_setup"]
+        )
+        self.camera.display_out.connect(self.calibration_thread.on_camera_frame)
+        self.calibration_thread.calibrated.connect(self.on_calibrated)
+        self.calibration_thread.start()
+
+    def on_calibrated(self, calibration):
+        self.camera.display_out.disconnect(self.calibration_thread.on_camera_frame)
+        if calibration is None:
+            self.calibrate.setStyleSheet("")
+            return
+        self.calibration = calibration
+        self.closed_loop_masker.set_homography(calibration.homography)
+        self.calibrate.setStyleSheet("color: green;")
+
+    def on_pattern_swapped(self, pattern_id, submit_latency, latency):
+        # Closed-loop masks swap every frame, their stats are printed when stopped
+        if pattern_id.startswith("mask_"):
+            return
+        print(
+            f"DLP pattern swapped in {submit_latency * 1000:.1f} ms, "
+            f"on the DMD after {latency * 1000:.1f} ms"
+        )
+        print(f"DLP pattern library: {self.dlp.library.stats()}")
 
     def on_open(self):
         self.update_settings("source", "video")
         self.read_video()
 
     def update_display(self, data):
-        q_img = None
-
-        # reading from file
-        if isinstance(data, np.ndarray):
+        # The read thread always sends the frame as a numpy array, camera or file
+        if data.ndim == 2:
+            h, w = data.shape
+            q_img = QImage(data.data, w, h, w, QImage.Format.Format_Grayscale8)
+        else:
             rgb = cv.cvtColor(data, cv.COLOR_BGR2RGB)
             h, w, ch = rgb.shape
             q_img = QImage(rgb.data, w, h, ch * w, QImage.Format.Format_RGB888)
-
-        # reading from camera
-        # this should be deleted since video_read_thread will always output a numpy array
-        else:
-            frame, current_fps, exposure, recording_state = data
-            h, w = frame.shape
-            channels = 1
-            q_img = QImage(
-                frame.data, w, h, channels * w, QImage.Format.Format_Grayscale8
-            )
         pixmap = QPixmap.fromImage(q_img).scaled(
             self.video_frame.size(),
             Qt.AspectRatioMode.KeepAspectRatio,
@@ -435,6 +645,12 @@ class MainWindow(QMainWindow, Ui_MainWindow):
                 self.serial
             )
             self.ReadThread.FrameUpdate.connect(self.update_display)
+            self.ReadThread.TriggerEvent.connect(self.ring_recorder.trigger)
+            self.ReadThread.masker = self.closed_loop_masker
+            self.ReadThread.actuator = self.pwm_actuator
+            self.ReadThread.control_loop = self.control_loop
+            self.ReadThread.tracer = self.latency_tracer
+            self.ReadThread.instrument_worker = self.instrument_worker
             # look into this
 
             # self.ReadThread.FrameUpdate.connect(self.video_writer.save_frame)
@@ -484,6 +700,12 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         )
 
         self.ReadThread.FrameUpdate.connect(self.update_display)
+        self.ReadThread.TriggerEvent.connect(self.ring_recorder.trigger)
+        self.ReadThread.masker = self.closed_loop_masker
+        self.ReadThread.actuator = self.pwm_actuator
+        self.ReadThread.control_loop = self.control_loop
+        self.ReadThread.tracer = self.latency_tracer
+        self.ReadThread.instrument_worker = self.instrument_worker
         self.ReadThread.start()
 
     def showEvent(self, event):
@@ -495,16 +717,43 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.camera.close()
         self.camera.stop()
         self.camera.wait(1000)
+        # Write the frames still queued for the writer and release it
+        QtWidgets.QApplication.processEvents()
         self.video_writer.stop()
         self.video_writer.wait()
+        self.ring_recorder.stop()
+        if self.calibration_thread:
+            self.calibration_thread.wait()
         self.dlp.stop()
         self.dlp.wait()
+        self.instrument_worker.stop()
+        self.instrument_worker.wait()
+        self.device_discovery.wait()
+        self.stop_control_loop()
+        self.stop_pwm_actuator()
+        if self.function_generator.round_trips > 0:
+            print(
+                f"Function generator I/O: {self.function_generator.stats()}, "
+                f"{self.instrument_worker.coalesced} values coalesced"
+            )
 
         if self.ReadThread:
             self.ReadThread.stop()
             self.ReadThread.wait()
+        if self.latency_tracer:
+            self.save_latency_trace()
         super().closeEvent(event)
 
+    def save_latency_trace(self):
+        """
+        Prints the per-stage latencies and saves the trace for comparing runs
+        with `python src/latency_trace.py`
+        """
+        print(f"Latency trace: {self.latency_tracer.stats()}")
+        path = new_recording_dir("latency")
+        self.latency_tracer.export(os.path.join(path, "trace.npz"))
+        self.latency_tracer.export(os.path.join(path, "trace.json"))
+
     def on_video_click(self, x, y):
         x -= (self.settings["video_frame_w"] - self.settings["pixmap_w"]) // 2
         y -= (self.settings["video_frame_h"] - self.settings["pixmap_h"]) // 2
@@ -532,6 +781,25 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         if self.ReadThread.isRunning():
             self.ReadThread.stop()
 
+    def update_trigger_radius(self, val):
+        self.update_settings("trigger_radius", val)
+
+    def checked_roi_recording(self):
+        self.update_settings("roi_recording_on", self.roi_recording.isChecked())
+        if self.roi_recording.isChecked():
+            self.roi_recording.setStyleSheet("color: green;")
+        else:
+            self.roi_recording.setStyleSheet("")
+
+    def checked_mask_loop(self):
+        self.update_settings("closed_loop_mask_on", self.mask_loop.isChecked())
+        if self.mask_loop.isChecked():
+            self.closed_loop_masker.reset()
+            self.mask_loop.setStyleSheet("color: green;")
+        else:
+            self.mask_loop.setStyleSheet("")
+            print(f"Closed-loop masks: {self.closed_loop_masker.stats()}")
+
     def checked_filters(self):
         self.update_settings("filters_on", self.show_filters.isChecked())
 
@@ -558,6 +826,14 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
     def checked_pid(self):
         self.update_settings("pid_on", self.pid_checkbox.isChecked())
+        if self.pid_checkbox.isChecked():
+            if self.settings["pwm_actuator_on"]:
+                self.start_pwm_actuator()
+            if self.settings["control_loop_on"]:
+                self.start_control_loop()
+        else:
+            self.stop_control_loop()
+            self.stop_pwm_actuator()
         # self.serial = None
         # if self.pid_checkbox.isChecked():
         #     if self.function_generator.instrument:
@@ -591,14 +867,116 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         
 
 
-    def checked_fgen_output_on(self):
-        if self.function_generator.instrument:
-            if self.fgen_output_on_button.isChecked():
-                self.function_generator.instrument.write("OUTP ON")
-            else:
-                self.function_generator.instrument.write("OUTP OFF")
+    def start_pwm_actuator(self):
+        if self.pwm_actuator is not None:
+            return
+        link = SerialLink(self.serial_port)
+        if not link.open():
+            print("Make sure the serial port is correct and the ESP32 is running")
+            return
+        self.serial_link = link
+        self.pwm_actuator = PwmActuator(link, self.settings["pwm_actuator_rate"])
+        self.pwm_actuator.tracer = self.latency_tracer
+        self.pwm_actuator.start()
+        self.ReadThread.actuator = self.pwm_actuator
+
+    def stop_pwm_actuator(self):
+        if self.pwm_actuator is None:
+            return
+        self.ReadThread.actuator = None
+        self.pwm_actuator.stop()
+        self.pwm_actuator.wait()
+        print(f"PWM actuator: {self.pwm_actuator.stats()}")
+        print(f"Serial link: {self.serial_link.stats()}")
+        self.serial_link.close()
+        self.pwm_actuator = None
+        self.serial_link = None
+
+    def start_control_loop(self):
+        if self.control_loop is not None:
+            return
+        self.control_loop = ControlLoop(self.settings["control_loop_rate"])
+        self.control_loop.actuator = self.pwm_actuator
+        self.control_loop.tracer = self.latency_tracer
+        if self.settings["fgen_arb_pid_on"]:
+            self.control_loop.fgen_worker = self.instrument_worker
+        self.control_loop.start()
+        # The analysis thread then only posts radii, the loop publishes the output
+        self.ReadThread.control_loop = self.control_loop
+
+    def stop_control_loop(self):
+        if self.control_loop is None:
+            return
+        self.ReadThread.control_loop = None
+        self.control_loop.stop()
+        self.control_loop.wait()
+        print(f"Control loop: {self.control_loop.stats()}")
+        self.control_loop = None
+
+    def add_pid_option(self, text, name, row):
+        """
+        Adds a checkbox below PID toggling the boolean setting `name`
+        """
+        checkbox = QCheckBox(text, self.scrollAreaWidgetContents_2)
+        checkbox.setFocusPolicy(Qt.FocusPolicy.NoFocus)
+        checkbox.setChecked(self.settings[name])
+        checkbox.toggled.connect(partial(self.update_settings, name))
+        self.pid_grid.addWidget(checkbox, row, 0, 1, 2)
+        return checkbox
+
+    def checked_fgen_arb_pid(self, checked):
+        if self.control_loop is not None:
+            self.control_loop.fgen_worker = self.instrument_worker if checked else None
+
+    def checked_pwm_actuator(self, checked):
+        if not self.pid_checkbox.isChecked():
+            return
+        if checked:
+            self.start_pwm_actuator()
+        else:
+            self.stop_pwm_actuator()
+        if self.control_loop is not None:
+            self.control_loop.actuator = self.pwm_actuator
+
+    def checked_control_loop(self, checked):
+        if not self.pid_checkbox.isChecked():
+            return
+        if checked:
+            self.start_control_loop()
         else:
-            print("Function generator not selected!")
+            self.stop_control_loop()
+
+    def checked_latency_trace(self, checked):
+        if checked:
+            if self.latency_tracer is None:
+                self.set_latency_tracer(LatencyTracer())
+        elif self.latency_tracer is not None:
+            self.save_latency_trace()
+            self.set_latency_tracer(None)
+
+    def set_latency_tracer(self, tracer):
+        """
+        Hands `tracer` to every thread a frame passes through
+        """
+        self.latency_tracer = tracer
+        self.camera.tracer = tracer
+        self.ReadThread.tracer = tracer
+        self.instrument_worker.tracer = tracer
+        if self.pwm_actuator is not None:
+            self.pwm_actuator.tracer = tracer
+        if self.control_loop is not None:
+            self.control_loop.tracer = tracer
+
+    def checked_fgen_output_on(self):
+        self.instrument_worker.set_output(self.fgen_output_on_button.isChecked())
+
+    def on_instrument_failed(self, settings: dict, error: str):
+        print(f"Function generator settings {settings} not applied: {error}")
+        if "OUTP" in settings:
+            # Show the output state that was actually applied
+            self.fgen_output_on_button.setChecked(
+                self.function_generator.state.get("OUTP") == "ON"
+            )
     
     def update_blur(self, val):
         if val % 2 == 0:
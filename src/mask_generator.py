@@ -0,0 +1,245 @@
+import argparse
+import hashlib
+import inspect
+import json
+import os
+
+import cv2 as cv
+import numpy as np
+
+from grayscale import quantize_centered
+
+MASK_CACHE_DIR = "mask_cache"
+
+
+def coordinates(size_x: int, size_y: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the pixel center coordinates as broadcastable (1, 1, size_x) and
+    (1, size_y, 1) arrays
+    """
+    xs = np.arange(size_x, dtype=np.float32).reshape(1, 1, size_x)
+    ys = np.arange(size_y, dtype=np.float32).reshape(1, size_y, 1)
+    return xs, ys
+
+
+def disc(xs, ys, cx, cy, r):
+    return (xs - cx) ** 2 + (ys - cy) ** 2 <= r**2
+
+
+def ring(xs, ys, cx, cy, r_inner, r_outer):
+    d2 = (xs - cx) ** 2 + (ys - cy) ** 2
+    return (d2 <= r_outer**2) & (d2 > r_inner**2)
+
+
+def rectangle(xs, ys, x0, y0, x1, y1):
+    return (xs >= x0) & (xs < x1) & (ys >= y0) & (ys < y1)
+
+
+def stripes(xs, ys, period, angle=0.0, duty=0.5, phase=0.0):
+    """
+    Stripes across the direction `angle` (degrees), on for `duty` of each period
+    """
+    theta = np.deg2rad(angle)
+    position = xs * np.cos(theta) + ys * np.sin(theta)
+    return ((position / period + phase) % 1.0) < duty
+
+
+def checkerboard(xs, ys, square, offset_x=0.0, offset_y=0.0):
+    return (
+        (np.floor((xs - offset_x) / square) + np.floor((ys - offset_y) / square)) % 2
+    ) == 0
+
+
+def disc_grid(
+    xs, ys, radius, pitch_x, pitch_y=None, offset_x=0.0, offset_y=0.0, hexagonal=0
+):
+    """
+    Array of discs on a rectangular lattice, or a hexagonal one where every other
+    row is shifted by half a pitch
+    """
+    if pitch_y is None:
+        pitch_y = pitch_x
+    row = np.floor((ys - offset_y) / pitch_y + 0.5)
+    shift = hexagonal * (row % 2) * pitch_x / 2
+    dx = xs - offset_x - shift
+    dx = dx - np.round(dx / pitch_x) * pitch_x
+    dy = ys - offset_y - row * pitch_y
+    return dx**2 + dy**2 <= radius**2
+
+
+def linear_gradient(xs, ys, angle=0.0, start=0.0, end=255.0):
+    """
+    Intensity ramp from `start` to `end` across the frame along the direction
+    `angle` (degrees)
+    """
+    theta = np.deg2rad(angle)
+    cos, sin = np.cos(theta), np.sin(theta)
+    width, height = xs.shape[-1] - 1, ys.shape[-2] - 1
+    # Projections of the frame corners bound the ramp
+    low = np.minimum(0, cos * width) + np.minimum(0, sin * height)
+    span = np.abs(cos) * width + np.abs(sin) * height
+    t = (xs * cos + ys * sin - low) / np.maximum(span, 1)
+    return start + (end - start) * t
+
+
+def radial_gradient(xs, ys, cx, cy, radius, start=255.0, end=0.0):
+    """
+    Intensity falling from `start` at the center to `end` at `radius`
+    """
+    t = np.clip(np.sqrt((xs - cx) ** 2 + (ys - cy) ** 2) / radius, 0, 1)
+    return start + (end - start) * t
+
+
+BINARY_SHAPES = {
+    "disc": disc,
+    "ring": ring,
+    "rectangle": rectangle,
+    "stripes": stripes,
+    "checkerboard": checkerboard,
+    "disc_grid": disc_grid,
+}
+GRADIENTS = {
+    "linear_gradient": linear_gradient,
+    "radial_gradient": radial_gradient,
+}
+
+
+def batch_params(size_x: int, size_y: int, params: dict) -> tuple[int, dict]:
+    """
+    Broadcasts scalar and 1D parameters to a common batch length, each shaped
+    (n, 1, 1). Centers default to the middle of the DMD.
+    """
+    params = dict(params)
+    params.setdefault("cx", (size_x - 1) / 2)
+    params.setdefault("cy", (size_y - 1) / 2)
+    arrays = np.broadcast_arrays(
+        *(np.atleast_1d(np.asarray(v, dtype=np.float32)) for v in params.values())
+    )
+    n = len(arrays[0]) if arrays else 1
+    return n, {k: a.reshape(-1, 1, 1) for k, a in zip(params, arrays)}
+
+
+def generate(
+    shape: str,
+    size_x: int = 1024,
+    size_y: int = 768,
+    bit_depth: int = 1,
+    chunk: int = 8,
+    **params,
+) -> np.ndarray:
+    """
+    Generates a batch of masks at DLP resolution, one per element of the
+    parameter arrays
+
+    Binary shapes return packed 1-bit frames (n, size_y, size_x / 8). Gradients
+    return frames quantized to `bit_depth` bits (n, size_y, size_x), MSB-aligned
+    as `DlpThread.load_resident()` takes them. Masks are evaluated `chunk` at a
+    time so large sweeps stay within memory. Raises `TypeError` for parameters
+    the shape does not take.
+    """
+    binary = shape in BINARY_SHAPES
+    if not binary and shape not in GRADIENTS:
+        raise ValueError(f"Unknown mask shape {shape}")
+    func = BINARY_SHAPES[shape] if binary else GRADIENTS[shape]
+
+    accepted = list(inspect.signature(func).parameters)[2:]
+    unknown = [name for name in params if name not in accepted]
+    if unknown:
+        raise TypeError(
+            f"{shape} got unexpected parameters {unknown}, it takes {accepted}"
+        )
+
+    xs, ys = coordinates(size_x, size_y)
+    n, arrays = batch_params(size_x, size_y, params)
+    # Drops the default centers of shapes without one
+    arrays = {k: v for k, v in arrays.items() if k in accepted}
+
+    if binary:
+        out = np.empty((n, size_y, (size_x + 7) // 8), dtype=np.uint8)
+    else:
+        out = np.empty((n, size_y, size_x), dtype=np.uint8)
+
+    for start in range(0, n, chunk):
+        part = {k: v[start : start + chunk] for k, v in arrays.items()}
+        values = np.broadcast_to(
+            func(xs, ys, **part), (min(chunk, n - start), size_y, size_x)
+        )
+        if binary:
+            out[start : start + chunk] = np.packbits(values, axis=-1)
+        else:
+            frames = np.clip(np.round(values), 0, 255).astype(np.uint8)
+            out[start : start + chunk] = quantize_centered(
+                frames, bit_depth, size_x, size_y
+            )
+    return out
+
+
+def cache_key(
+    shape: str, size_x: int, size_y: int, bit_depth: int, params: dict
+) -> str:
+    spec = {
+        "shape": shape,
+        "size": [size_x, size_y],
+        "bit_depth": bit_depth,
+        "params": {
+            k: np.atleast_1d(np.asarray(v, dtype=np.float32)).tolist()
+            for k, v in sorted(params.items())
+        },
+    }
+    return hashlib.blake2b(json.dumps(spec).encode(), digest_size=16).hexdigest()
+
+
+def cached_generate(
+    shape: str,
+    size_x: int = 1024,
+    size_y: int = 768,
+    bit_depth: int = 1,
+    directory: str = MASK_CACHE_DIR,
+    **params,
+) -> np.ndarray:
+    """
+    `generate()` backed by an on-disk cache keyed by the shape and parameters
+    """
+    key = cache_key(shape, size_x, size_y, bit_depth, params)
+    path = os.path.join(directory, f"{key}.npz")
+    if os.path.exists(path):
+        with np.load(path) as data:
+            return data["masks"]
+
+    masks = generate(shape, size_x, size_y, bit_depth, **params)
+    os.makedirs(directory, exist_ok=True)
+    np.savez_compressed(path, masks=masks)
+    return masks
+
+
+def to_image(mask: np.ndarray, shape: str, size_x: int) -> np.ndarray:
+    """
+    Returns one frame generated for `shape` as an 8-bit image
+    """
+    if shape in BINARY_SHAPES:
+        return np.unpackbits(mask, axis=-1)[..., :size_x] * np.uint8(255)
+    return mask
+
+
+if __name__ == "__main__":
+    # e.g. python src/mask_generator.py disc r=50 --size 532x384 --out circle.png
+    parser = argparse.ArgumentParser(description="Write DLP masks as lossless PNGs")
+    parser.add_argument("shape", choices=[*BINARY_SHAPES, *GRADIENTS])
+    parser.add_argument("params", nargs="*", help="name=value or name=v1,v2,...")
+    parser.add_argument("--size", default="1024x768", help="width x height")
+    parser.add_argument("--bit-depth", type=int, default=8)
+    parser.add_argument("--out", default="mask.png")
+    args = parser.parse_args()
+
+    size_x, size_y = (int(v) for v in args.size.lower().split("x"))
+    params = {}
+    for param in args.params:
+        name, value = param.split("=")
+        params[name] = [float(v) for v in value.split(",")]
+
+    masks = generate(args.shape, size_x, size_y, args.bit_depth, **params)
+    stem, ext = os.path.splitext(args.out)
+    for i, mask in enumerate(masks):
+        path = args.out if len(masks) == 1 else f"{stem}_{i:04d}{ext or '.png'}"
+        cv.imwrite(path, to_image(mask, args.shape, size_x))
+        print(f"Saved {path}")
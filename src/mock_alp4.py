@@ -0,0 +1,327 @@
+import ctypes
+import time
+
+import numpy as np
+from ALP4 import (
+    ALPError,
+    ALP_AVAIL_MEMORY,
+    ALP_DATA_BINARY_TOPDOWN,
+    ALP_DATA_FORMAT,
+    ALP_DATA_LSB_ALIGN,
+    ALP_DATA_MSB_ALIGN,
+    ALP_FIRSTFRAME,
+    ALP_LASTFRAME,
+    ALP_SEQ_REPEAT,
+)
+
+from grayscale import bitplanes, combine_bitplanes
+
+# ALP return codes used by the simulation, see `ALP4.ALP_ERRORS`
+ALP_PARM_INVALID = 1005
+ALP_MEMORY_FULL = 1007
+ALP_SEQ_IN_USE = 1008
+
+# Picture time the ALP uses when none is set, in microseconds
+DEFAULT_PICTURE_TIME = 33334
+
+
+class MockSequence:
+    def __init__(
+        self, nb_img: int, bit_depth: int, size_x: int, size_y: int
+    ) -> None:
+        self.nb_img = nb_img
+        self.bit_depth = bit_depth
+        self.data_format = ALP_DATA_MSB_ALIGN
+        self.first_frame = 0
+        self.last_frame = nb_img - 1
+        self.repeat = 1
+        self.picture_time = DEFAULT_PICTURE_TIME
+        self.controls: dict[int, int] = {}
+        # Packed bit planes of each frame, as the DMD stores them
+        self.data = np.zeros(
+            (nb_img, bit_depth, size_y, size_x // 8), dtype=np.uint8
+        )
+
+
+class MockALP4:
+    """
+    Simulated stand-in for `ALP4.ALP4`, for running and benchmarking the DLP code
+    without the ViALUX kit or its driver.
+
+    Implements the subset of the ALP4lib API used by `DlpThread`. USB transfers
+    take `command_latency` plus their size divided by `usb_bandwidth`; with
+    `sleep=False` this time is only added to `modelled_time`, so benchmarks can
+    run faster than the hardware. `framebuffer()` returns what the DMD shows.
+    """
+
+    def __init__(
+        self,
+        version: str = "4.1",
+        size_x: int = 1024,
+        size_y: int = 768,
+        memory_frames: int = 43690,
+        usb_bandwidth: float = 40e6,
+        command_latency: float = 0.3e-3,
+        sleep: bool = True,
+    ) -> None:
+        self.version = version
+        self.nSizeX = size_x
+        self.nSizeY = size_y
+        self.memory_frames = memory_frames
+        self.usb_bandwidth = usb_bandwidth
+        self.command_latency = command_latency
+        self.sleep = sleep
+
+        self.Seqs: list[int] = []
+        self._lastDDRseq: int | None = None
+        self.sequences: dict[int, MockSequence] = {}
+        self.next_id = 1
+        self.initialized = False
+
+        # (sequence id, loop, start time) being projected, and the
+        # (sequence id, loop, time of the Run call) queued after it
+        self.running: tuple[int, bool, float] | None = None
+        self.queued: tuple[int, bool, float] | None = None
+
+        self.modelled_time = 0.0
+        self.bytes_transferred = 0
+        self.calls: dict[str, int] = {}
+
+    def transfer(self, name: str, nbytes: int = 0) -> None:
+        """
+        Models the USB round-trip of one API call carrying `nbytes` of data
+        """
+        self.calls[name] = self.calls.get(name, 0) + 1
+        duration = self.command_latency + nbytes / self.usb_bandwidth
+        self.modelled_time += duration
+        self.bytes_transferred += nbytes
+        if self.sleep:
+            time.sleep(duration)
+
+    def now(self) -> float:
+        return time.perf_counter() if self.sleep else self.modelled_time
+
+    def sequence(self, SequenceId) -> MockSequence:
+        if SequenceId is None:
+            SequenceId = self._lastDDRseq
+        if SequenceId not in self.sequences:
+            raise ALPError(ALP_PARM_INVALID)
+        return self.sequences[SequenceId]
+
+    def used_frames(self) -> int:
+        return sum(seq.nb_img * seq.bit_depth for seq in self.sequences.values())
+
+    def Initialize(self, DeviceNum=None) -> None:
+        self.transfer("Initialize")
+        self.initialized = True
+        print(f"Simulated DMD, resolution = {self.nSizeX} x {self.nSizeY}.")
+
+    def DevInquire(self, inquireType: int) -> int:
+        self.transfer("DevInquire")
+        if inquireType == ALP_AVAIL_MEMORY:
+            return self.memory_frames - self.used_frames()
+        raise ALPError(ALP_PARM_INVALID)
+
+    def ProjControl(self, controlType: int, value: int) -> None:
+        self.transfer("ProjControl")
+
+    def SeqAlloc(self, nbImg: int = 1, bitDepth: int = 1) -> int:
+        self.transfer("SeqAlloc")
+        if not 1 <= bitDepth <= 8 or nbImg < 1:
+            raise ALPError(ALP_PARM_INVALID)
+        if self.used_frames() + nbImg * bitDepth > self.memory_frames:
+            raise ALPError(ALP_MEMORY_FULL)
+
+        seq_id = self.next_id
+        self.next_id += 1
+        self.sequences[seq_id] = MockSequence(
+            nbImg, bitDepth, self.nSizeX, self.nSizeY
+        )
+        self.Seqs.append(seq_id)
+        self._lastDDRseq = seq_id
+        return seq_id
+
+    def SeqControl(self, controlType: int, value: int, SequenceId=None) -> None:
+        self.transfer("SeqControl")
+        seq = self.sequence(SequenceId)
+        if controlType == ALP_DATA_FORMAT:
+            seq.data_format = value
+        elif controlType == ALP_FIRSTFRAME:
+            seq.first_frame = value
+        elif controlType == ALP_LASTFRAME:
+            seq.last_frame = value
+        elif controlType == ALP_SEQ_REPEAT:
+            seq.repeat = value
+        seq.controls[controlType] = value
+
+    def SetTiming(
+        self,
+        SequenceId=None,
+        illuminationTime=None,
+        pictureTime=None,
+        synchDelay=None,
+        synchPulseWidth=None,
+        triggerInDelay=None,
+    ) -> None:
+        self.transfer("SetTiming")
+        seq = self.sequence(SequenceId)
+        if pictureTime:
+            seq.picture_time = pictureTime
+
+    def SeqPut(
+        self, imgData, SequenceId=None, PicOffset=0, PicLoad=0, dataFormat="Python"
+    ) -> None:
+        if SequenceId is None:
+            SequenceId = self._lastDDRseq
+        seq = self.sequence(SequenceId)
+        if self.running and self.running[0] == SequenceId:
+            raise ALPError(ALP_SEQ_IN_USE)
+
+        nb_load = PicLoad if PicLoad else seq.nb_img - PicOffset
+        binary = seq.data_format == ALP_DATA_BINARY_TOPDOWN
+        row_bytes = self.nSizeX // 8 if binary else self.nSizeX
+        nbytes = nb_load * self.nSizeY * row_bytes
+
+        if dataFormat == "C":
+            data = np.frombuffer(ctypes.string_at(imgData, nbytes), dtype=np.uint8)
+        else:
+            data = np.asarray(imgData).astype(np.uint8).ravel()[:nbytes]
+        frames = data.reshape(nb_load, self.nSizeY, row_bytes)
+        if binary:
+            frames = frames[:, np.newaxis]
+        else:
+            if seq.data_format == ALP_DATA_LSB_ALIGN:
+                frames = frames << np.uint8(8 - seq.bit_depth)
+            frames = bitplanes(frames, seq.bit_depth)
+        seq.data[PicOffset : PicOffset + nb_load] = frames
+        self.transfer("SeqPut", nbytes)
+
+    def Run(self, SequenceId=None, loop: bool = True) -> None:
+        self.transfer("Run")
+        if SequenceId is None:
+            SequenceId = self._lastDDRseq
+        self.sequence(SequenceId)
+        self.update_projection()
+
+        # A running sequence finishes its current iteration before the next starts
+        if self.running is not None:
+            self.queued = (SequenceId, loop, self.now())
+        else:
+            self.running = (SequenceId, loop, self.now())
+
+    def Wait(self) -> None:
+        self.transfer("Wait")
+
+    def Halt(self) -> None:
+        self.transfer("Halt")
+        self.running = None
+        self.queued = None
+
+    def FreeSeq(self, SequenceId=None) -> None:
+        self.transfer("FreeSeq")
+        if SequenceId is None:
+            SequenceId = self._lastDDRseq
+        self.update_projection()
+        in_use = [p[0] for p in (self.running, self.queued) if p is not None]
+        if SequenceId in in_use:
+            print("Unable to free the image sequence, it is currently in use.")
+            return
+        self.sequences.pop(SequenceId, None)
+        if SequenceId in self.Seqs:
+            self.Seqs.remove(SequenceId)
+
+    def Free(self) -> None:
+        self.transfer("Free")
+        self.Halt()
+        self.sequences.clear()
+        self.Seqs.clear()
+        self.initialized = False
+
+    def frame_index(self) -> int | None:
+        """
+        Returns the index of the frame the DMD is showing, `None` if idle
+        """
+        self.update_projection()
+        if self.running is None:
+            return None
+        seq_id, loop, start = self.running
+        seq = self.sequences[seq_id]
+        nb_frames = seq.last_frame - seq.first_frame + 1
+        shown = int((self.now() - start) * 1e6 // seq.picture_time)
+        if not loop:
+            shown = min(shown, nb_frames * seq.repeat - 1)
+        return seq.first_frame + shown % nb_frames
+
+    def update_projection(self) -> None:
+        """
+        Starts the queued sequence once the running one has finished its iteration
+        """
+        if self.running is None or self.queued is None:
+            return
+        seq_id, loop, start = self.running
+        next_id, next_loop, queued_at = self.queued
+        seq = self.sequences[seq_id]
+
+        iteration = (seq.last_frame - seq.first_frame + 1) * seq.picture_time * 1e-6
+        if loop:
+            end = start + ((queued_at - start) // iteration + 1) * iteration
+        else:
+            end = start + iteration * seq.repeat
+        if self.now() >= end:
+            self.running = (next_id, next_loop, end)
+            self.queued = None
+
+    def framebuffer(self) -> np.ndarray:
+        """
+        Returns the image on the DMD as (nSizeY, nSizeX) uint8, 0 or 255 for
+        binary sequences and MSB-aligned intensities for grayscale ones
+        """
+        idx = self.frame_index()
+        if idx is None:
+            return np.zeros((self.nSizeY, self.nSizeX), dtype=np.uint8)
+
+        seq = self.sequences[self.running[0]]
+        if seq.bit_depth == 1:
+            return np.unpackbits(seq.data[idx, 0], axis=-1) * np.uint8(255)
+        return combine_bitplanes(seq.data[idx])
+
+
+if __name__ == "__main__":
+    # Benchmarks the mask pipeline and pattern switching against the simulation
+    from bitplane_cache import BitplaneCache
+    from pattern_library import PatternLibrary
+
+    device = MockALP4(sleep=False)
+    device.Initialize()
+    cache = BitplaneCache(device.nSizeX, device.nSizeY)
+    library = PatternLibrary(device)
+
+    rng = np.random.default_rng(0)
+    masks = [
+        (rng.random((384, 532)) > 0.5).astype(np.uint8) * 255 for _ in range(16)
+    ]
+
+    start = time.perf_counter()
+    packed = [cache.get_or_pack(mask) for mask in masks]
+    pack_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for mask in masks:
+        cache.get_or_pack(mask)
+    cached_time = time.perf_counter() - start
+
+    modelled = device.modelled_time
+    for i, frame in enumerate(packed):
+        library.add(str(i), frame[np.newaxis])
+    upload_time = device.modelled_time - modelled
+
+    for i in rng.integers(0, len(packed), 200):
+        library.switch(str(i))
+    assert np.array_equal(
+        device.framebuffer() > 0,
+        np.unpackbits(packed[int(library.current)], axis=-1) > 0,
+    )
+
+    print(f"pack: {pack_time / len(masks) * 1000:.3f} ms/mask")
+    print(f"cached pack: {cached_time / len(masks) * 1000:.3f} ms/mask")
+    print(f"modelled upload: {upload_time / len(masks) * 1000:.3f} ms/mask")
+    print(f"library: {library.stats()}")
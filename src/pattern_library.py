@@ -0,0 +1,257 @@
+import ctypes
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+from ALP4 import (
+    ALP4,
+    ALPError,
+    ALP_AVAIL_MEMORY,
+    ALP_BIN_MODE,
+    ALP_BIN_UNINTERRUPTED,
+    ALP_DATA_BINARY_TOPDOWN,
+    ALP_DATA_FORMAT,
+    ALP_DATA_MSB_ALIGN,
+)
+
+# Picture time the ALP uses when none is set, in microseconds
+DEFAULT_PICTURE_TIME = 33334
+
+
+class ResidentSequence:
+    """
+    A sequence allocated in the DLP's on-board memory
+    """
+
+    def __init__(
+        self,
+        seq_id,
+        nb_frames: int,
+        loop: bool,
+        bit_depth: int = 1,
+        picture_time: int | None = None,
+    ) -> None:
+        self.seq_id = seq_id
+        self.nb_frames = nb_frames
+        self.loop = loop
+        self.bit_depth = bit_depth
+        self.picture_time = picture_time or DEFAULT_PICTURE_TIME
+        # Iterations played when not looping
+        self.repeat = 1
+
+    def duration(self) -> float:
+        """
+        Returns the seconds the sequence plays before a queued one takes over
+        """
+        iterations = 1 if self.loop else self.repeat
+        return self.nb_frames * self.picture_time * 1e-6 * iterations
+
+
+class PatternLibrary:
+    """
+    Keeps several sequences resident in the DLP's on-board memory and switches
+    between them by pattern ID.
+
+    When the device runs out of sequence memory, or more than `max_sequences`
+    are resident, the least recently used sequences are freed. After a seamless
+    switch the previous sequence keeps projecting until the end of its
+    iteration, so it is only freed once that has passed.
+    """
+
+    def __init__(self, device: ALP4, max_sequences: int = 32) -> None:
+        self.device = device
+        self.max_sequences = max_sequences
+        self.sequences: OrderedDict[str, ResidentSequence] = OrderedDict()
+        self.current: str | None = None
+        # Pattern still projecting after a seamless switch, until `handover_at`
+        # (`time.perf_counter()`)
+        self.outgoing: str | None = None
+        self.handover_at = 0.0
+
+        # Seconds taken by recent `switch()` calls
+        self.switch_times: deque[float] = deque(maxlen=1000)
+        self.uploads = 0
+        self.evictions = 0
+        # Sequences the device did not free
+        self.free_failures = 0
+
+    def __contains__(self, pattern_id: str) -> bool:
+        return pattern_id in self.sequences
+
+    def __len__(self) -> int:
+        return len(self.sequences)
+
+    def get(self, pattern_id: str) -> ResidentSequence | None:
+        return self.sequences.get(pattern_id)
+
+    def available_frames(self) -> int:
+        """
+        Returns how many more bit planes fit in the device's sequence memory
+        """
+        return int(self.device.DevInquire(ALP_AVAIL_MEMORY))
+
+    def swap_pending(self) -> bool:
+        """
+        Returns whether the sequence switched away from seamlessly may still
+        be projecting
+        """
+        if self.outgoing is not None and time.perf_counter() >= self.handover_at:
+            self.outgoing = None
+        return self.outgoing is not None
+
+    def evict_lru(self) -> bool:
+        """
+        Frees the least recently used sequence that is not being projected,
+        waiting for a seamless switch to finish if only its outgoing sequence
+        is left
+
+        Returns `False` if there was nothing left to evict
+        """
+        pending = self.swap_pending()
+        for pattern_id in list(self.sequences):
+            if pattern_id == self.current or (pending and pattern_id == self.outgoing):
+                continue
+            if self.remove(pattern_id):
+                self.evictions += 1
+                return True
+        if pending and self.outgoing != self.current:
+            time.sleep(max(self.handover_at - time.perf_counter(), 0.0))
+            return self.evict_lru()
+        return False
+
+    def remove(self, pattern_id: str) -> bool:
+        """
+        Frees pattern `pattern_id`, halting the projection if it is on the DMD
+
+        Returns `False` if the device did not free it, it then stays resident
+        """
+        sequence = self.sequences.pop(pattern_id)
+        if pattern_id == self.current or (
+            pattern_id == self.outgoing and self.swap_pending()
+        ):
+            self.device.Halt()
+            self.current = None
+            self.outgoing = None
+
+        # ALP4lib only prints a warning when freeing fails, so the freed memory
+        # is checked instead
+        planes = sequence.nb_frames * sequence.bit_depth
+        available = self.available_frames()
+        self.device.FreeSeq(sequence.seq_id)
+        if self.available_frames() >= available + planes:
+            return True
+
+        print(f"DLP sequence {sequence.seq_id} of {pattern_id} was not freed")
+        self.free_failures += 1
+        self.sequences[pattern_id] = sequence
+        self.sequences.move_to_end(pattern_id, last=False)
+        if sequence.seq_id not in self.device.Seqs:
+            self.device.Seqs.append(sequence.seq_id)
+        return False
+
+    def add(
+        self,
+        pattern_id: str,
+        packed: np.ndarray,
+        picture_time: int | None = None,
+        loop: bool = True,
+        bit_depth: int = 1,
+    ) -> ResidentSequence:
+        """
+        Uploads `packed` frames (n, nSizeY, nSizeX / 8) as pattern `pattern_id`,
+        unless it is already resident
+
+        With a `bit_depth` above 1, `packed` holds MSB-aligned grayscale frames
+        (n, nSizeY, nSizeX) instead, since the binary data format is 1-bit only.
+        """
+        sequence = self.sequences.get(pattern_id)
+        if sequence is not None:
+            self.sequences.move_to_end(pattern_id)
+            return sequence
+
+        nb_frames = len(packed)
+        while len(self.sequences) >= self.max_sequences or (
+            self.available_frames() < nb_frames * bit_depth
+        ):
+            if not self.evict_lru():
+                break
+
+        while True:
+            try:
+                seq_id = self.device.SeqAlloc(nbImg=nb_frames, bitDepth=bit_depth)
+                break
+            except ALPError:
+                # The memory inquiry can be optimistic, retry with more room
+                if not self.evict_lru():
+                    raise
+
+        packed = np.ascontiguousarray(packed, dtype=np.uint8)
+        if bit_depth == 1:
+            self.device.SeqControl(ALP_DATA_FORMAT, ALP_DATA_BINARY_TOPDOWN, seq_id)
+            self.device.SeqControl(ALP_BIN_MODE, ALP_BIN_UNINTERRUPTED, seq_id)
+        else:
+            self.device.SeqControl(ALP_DATA_FORMAT, ALP_DATA_MSB_ALIGN, seq_id)
+        # Pass a raw pointer, the "Python" data format copies the whole stack
+        self.device.SeqPut(
+            packed.ctypes.data_as(ctypes.c_void_p), SequenceId=seq_id, dataFormat="C"
+        )
+        if picture_time:
+            self.device.SetTiming(SequenceId=seq_id, pictureTime=picture_time)
+
+        sequence = ResidentSequence(seq_id, nb_frames, loop, bit_depth, picture_time)
+        self.sequences[pattern_id] = sequence
+        self.uploads += 1
+        return sequence
+
+    def switch(self, pattern_id: str, seamless: bool = False) -> bool:
+        """
+        Starts projecting resident pattern `pattern_id`
+
+        With `seamless`, the projection is not halted first. The ALP then finishes
+        the current iteration of the running sequence and starts the new one right
+        after it, so the DMD never goes dark.
+
+        Returns `False` if the pattern is not resident
+        """
+        sequence = self.sequences.get(pattern_id)
+        if sequence is None:
+            return False
+
+        start = time.perf_counter()
+        if not seamless or self.current is None:
+            self.device.Halt()
+            self.outgoing = None
+        elif not self.swap_pending():
+            # A sequence queued by an earlier switch that has not started yet is
+            # replaced, the outgoing one keeps projecting either way
+            self.outgoing = self.current
+            self.handover_at = start + self.sequences[self.current].duration()
+        self.device.Run(sequence.seq_id, sequence.loop)
+        self.switch_times.append(time.perf_counter() - start)
+
+        self.current = pattern_id
+        self.sequences.move_to_end(pattern_id)
+        return True
+
+    def clear(self) -> None:
+        for pattern_id in list(self.sequences):
+            self.remove(pattern_id)
+
+    def stats(self) -> dict[str, float]:
+        """
+        Returns switch latency statistics in milliseconds along with usage counters
+        """
+        stats = {
+            "resident": len(self.sequences),
+            "uploads": self.uploads,
+            "evictions": self.evictions,
+            "free_failures": self.free_failures,
+            "switches": len(self.switch_times),
+        }
+        if len(self.switch_times) > 0:
+            times = np.array(self.switch_times) * 1000
+            stats["switch_mean_ms"] = float(times.mean())
+            stats["switch_p50_ms"] = float(np.percentile(times, 50))
+            stats["switch_p99_ms"] = float(np.percentile(times, 99))
+            stats["switch_max_ms"] = float(times.max())
+        return stats
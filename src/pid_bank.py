@@ -0,0 +1,213 @@
+import numpy as np
+
+
+class PidBank:
+    """
+    PID controllers of many tracked bubbles held in arrays and updated together.
+
+    Each track gets a slot with its own setpoint, gains and output limits.
+    `update()` steps every enabled track with a measurement in one vectorized
+    pass. Integration is conditional: while the output is saturated, errors
+    pushing it further into saturation are not integrated (anti-windup).
+    Outputs follow `CirclePID`, a duty ratio between `out_min` and `out_max`
+    that is 0 while the radius is above `pv_limit`. PWM cycles scale outputs
+    by `full_scale`, so a track with a lower `out_max` never drives fully.
+    """
+
+    def __init__(
+        self,
+        capacity: int = 16,
+        setpoint: float = 100.0,
+        kp: float = 0.6,
+        ki: float = 0.3,
+        kd: float = 0.1,
+        out_min: float = 0.0,
+        out_max: float = 100.0,
+        pv_limit: float = 100.0,
+        cycle_time: float = 100.0,
+    ) -> None:
+        # Defaults of new tracks
+        self.defaults = {
+            "setpoint": setpoint,
+            "kp": kp,
+            "ki": ki,
+            "kd": kd,
+            "out_min": out_min,
+            "out_max": out_max,
+            "pv_limit": pv_limit,
+        }
+        # PWM period in milliseconds
+        self.cycle_time = cycle_time
+        # Output of full drive for every track, like `CirclePID.max_ratio`
+        self.full_scale = out_max
+
+        # Slot of each track ID
+        self.slots: dict[int, int] = {}
+        self.free: list[int] = []
+        self.size = 0
+        self.allocate(capacity)
+
+    def allocate(self, capacity: int) -> None:
+        """
+        Grows the arrays to `capacity` slots, keeping the tracks' state
+        """
+        old = self.size
+        arrays = {
+            "ids": np.full(capacity, -1, dtype=np.int64),
+            "setpoint": np.zeros(capacity),
+            "kp": np.zeros(capacity),
+            "ki": np.zeros(capacity),
+            "kd": np.zeros(capacity),
+            "out_min": np.zeros(capacity),
+            "out_max": np.zeros(capacity),
+            "pv_limit": np.zeros(capacity),
+            "integral": np.zeros(capacity),
+            "prev_error": np.zeros(capacity),
+            # Derivative term of the last new measurement
+            "derivative": np.zeros(capacity),
+            "output": np.zeros(capacity),
+            "enabled": np.zeros(capacity, dtype=bool),
+            # False until the first update, which has no derivative term
+            "started": np.zeros(capacity, dtype=bool),
+        }
+        for name, array in arrays.items():
+            if old > 0:
+                array[:old] = getattr(self, name)
+            setattr(self, name, array)
+        self.free.extend(range(capacity - 1, old - 1, -1))
+        self.size = capacity
+
+    def add(self, track_id: int, **params) -> int:
+        """
+        Adds an enabled track, with `params` overriding the default setpoint,
+        gains or limits, and returns its slot
+        """
+        if track_id in self.slots:
+            return self.slots[track_id]
+        if not self.free:
+            self.allocate(self.size * 2)
+        slot = self.free.pop()
+        self.slots[track_id] = slot
+
+        for name, default in self.defaults.items():
+            getattr(self, name)[slot] = params.pop(name, default)
+        if params:
+            raise ValueError(f"Unknown PID parameters {list(params)}")
+        self.ids[slot] = track_id
+        self.integral[slot] = 0.0
+        self.prev_error[slot] = 0.0
+        self.derivative[slot] = 0.0
+        self.output[slot] = 0.0
+        self.started[slot] = False
+        self.enabled[slot] = True
+        return slot
+
+    def remove(self, track_id: int) -> None:
+        slot = self.slots.pop(track_id, None)
+        if slot is None:
+            return
+        self.ids[slot] = -1
+        self.enabled[slot] = False
+        self.free.append(slot)
+
+    def set_enabled(self, track_ids, enabled: bool) -> None:
+        """
+        Enables or disables tracks. Disabled tracks keep their state but are not
+        updated and output 0.
+        """
+        slots = [self.slots[t] for t in track_ids if t in self.slots]
+        self.enabled[slots] = enabled
+        if not enabled:
+            self.output[slots] = 0.0
+
+    def update(
+        self,
+        track_ids,
+        measurements,
+        dt: float,
+        new_measurement: bool = True,
+        derivative_dt: float | None = None,
+    ) -> np.ndarray:
+        """
+        Steps the tracks `track_ids` with their `measurements` (radii), adding
+        unknown tracks, and returns their outputs
+
+        The integral advances by `dt`. The derivative is taken over
+        `derivative_dt` (`dt` if `None`), the time since the previous
+        measurement, and held while `new_measurement` is False, so stepping
+        faster than the camera does not spike it on every new frame.
+        """
+        for track_id in track_ids:
+            if track_id not in self.slots:
+                self.add(track_id)
+        slots = np.array([self.slots[t] for t in track_ids], dtype=np.intp)
+        pv = np.asarray(measurements, dtype=np.float64)
+
+        active = self.enabled[slots]
+        if active.any():
+            if derivative_dt is None:
+                derivative_dt = dt
+            self.step(slots[active], pv[active], dt, new_measurement, derivative_dt)
+        return self.output[slots]
+
+    def step(
+        self,
+        slots: np.ndarray,
+        pv: np.ndarray,
+        dt: float,
+        new_measurement: bool = True,
+        derivative_dt: float | None = None,
+    ) -> None:
+        if derivative_dt is None:
+            derivative_dt = dt
+        error = self.setpoint[slots] - pv
+        integral = self.integral[slots] + error * dt
+        started = self.started[slots]
+        if not new_measurement:
+            derivative = np.where(started, self.derivative[slots], 0.0)
+        elif derivative_dt > 0:
+            derivative = (error - self.prev_error[slots]) / derivative_dt
+        else:
+            derivative = np.zeros_like(error)
+        derivative[~started] = 0.0
+
+        unclipped = (
+            self.kp[slots] * error
+            + self.ki[slots] * integral
+            + self.kd[slots] * derivative
+        )
+        output = np.clip(unclipped, self.out_min[slots], self.out_max[slots])
+        # Keep the integral while saturated and the error pushes further out
+        windup = (unclipped != output) & (np.sign(error) == np.sign(unclipped - output))
+        over_limit = pv > self.pv_limit[slots]
+        output[over_limit] = 0.0
+        keep = windup | over_limit
+
+        self.integral[slots] = np.where(keep, self.integral[slots], integral)
+        if new_measurement:
+            self.prev_error[slots] = error
+            self.derivative[slots] = derivative
+        else:
+            self.prev_error[slots] = np.where(started, self.prev_error[slots], error)
+        self.output[slots] = output
+        self.started[slots] = True
+
+    def pwm_cycle(self, track_id: int) -> list[float]:
+        """
+        Returns the [on_time, off_time] in milliseconds of one track, like
+        `CirclePID.pwm_cycle`
+        """
+        slot = self.slots[track_id]
+        on_time = float(self.output[slot] / self.full_scale * self.cycle_time)
+        return [round(on_time, 2), round(self.cycle_time - on_time, 2)]
+
+    def pwm_cycles(self) -> dict[int, list[float]]:
+        """
+        Returns the [on_time, off_time] of every track
+        """
+        slots = np.array(list(self.slots.values()), dtype=np.intp)
+        on_times = self.output[slots] / self.full_scale * self.cycle_time
+        return {
+            track_id: [round(on, 2), round(self.cycle_time - on, 2)]
+            for track_id, on in zip(self.slots, on_times.tolist())
+        }
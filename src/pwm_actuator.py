@@ -0,0 +1,139 @@
+import time
+from collections import deque
+from concurrent.futures import Future
+from functools import partial
+
+import numpy as np
+from PySide6.QtCore import QMutex, QMutexLocker, QThread, Signal
+
+from latency_trace import LatencyTracer
+from serial_link import SerialLink
+
+
+class PwmActuator(QThread):
+    """
+    A `QThread` based class streaming PID outputs to the ESP32 at a fixed rate.
+
+    `submit()` only stores the latest PWM cycle. Every `1 / rate` seconds this
+    thread sends it with `SerialLink.set_pwm()`, changed or not, and the board
+    times the on/off switching itself. A cycle not renewed within `max_age`
+    seconds, e.g. because the analysis stalled, is sent as off instead.
+    Acknowledgements carry the device time each update took effect, so
+    actuation jitter is measured on both ends.
+    """
+
+    # Emitted with the host `time.perf_counter()` and device time in seconds of
+    # each acknowledged update
+    acknowledged = Signal(float, float)
+
+    def __init__(
+        self, link: SerialLink, rate: float = 50.0, max_age: float = 0.1
+    ) -> None:
+        super().__init__()
+        self.link = link
+        self.rate = rate
+        self.max_age = max_age
+        self.running = False
+
+        # Latest [on_time, off_time] in milliseconds, `None` until submitted
+        self.pwm_cycle: list[float] | None = None
+        # `LatencyTracer` ID of the frame the PWM cycle was computed from
+        self.frame_id: int | None = None
+        # `time.perf_counter()` of the last `submit()`
+        self.submitted_at = 0.0
+        self.mutex = QMutex()
+        # If set, gets the first send and acknowledgement of each frame's cycle
+        self.tracer: LatencyTracer | None = None
+
+        self.sent = 0
+        self.failed = 0
+        # Updates sent as off because the cycle was older than `max_age`
+        self.stale = 0
+        # Seconds each update was sent after its scheduled time
+        self.lateness: deque[float] = deque(maxlen=1000)
+        # Seconds from sending each update to its acknowledgement
+        self.ack_latencies: deque[float] = deque(maxlen=1000)
+        # Device times in seconds at which consecutive updates took effect
+        self.device_times: deque[float] = deque(maxlen=1000)
+
+    def submit(self, pwm_cycle: list[float], frame_id: int | None = None) -> None:
+        with QMutexLocker(self.mutex):
+            self.pwm_cycle = list(pwm_cycle)
+            self.frame_id = frame_id
+            self.submitted_at = time.perf_counter()
+
+    def on_reply(self, future: Future, frame_id: int | None = None) -> None:
+        try:
+            reply = future.result()
+        except Exception:
+            self.failed += 1
+            return
+        if self.tracer is not None:
+            self.tracer.stamp(frame_id, "ack", round(reply.received_at * 1e9))
+        device_time = reply.device_time / 1e6
+        self.ack_latencies.append(reply.round_trip)
+        self.device_times.append(device_time)
+        self.acknowledged.emit(reply.received_at, device_time)
+
+    def run(self) -> None:
+        self.running = True
+        period = 1.0 / self.rate
+        next_tick = time.perf_counter()
+        while self.running:
+            now = time.perf_counter()
+            if now < next_tick:
+                time.sleep(next_tick - now)
+                continue
+
+            with QMutexLocker(self.mutex):
+                pwm_cycle = self.pwm_cycle
+                frame_id = self.frame_id
+                age = time.perf_counter() - self.submitted_at
+            if pwm_cycle is not None:
+                on_time, off_time = pwm_cycle
+                if age > self.max_age:
+                    # Nothing drives the bubble until a fresh cycle comes in
+                    on_time, off_time = 0.0, on_time + off_time
+                    frame_id = None
+                    self.stale += 1
+                self.lateness.append(time.perf_counter() - next_tick)
+                if self.tracer is not None:
+                    self.tracer.stamp(frame_id, "enqueue")
+                future = self.link.set_pwm(on_time + off_time, on_time)
+                future.add_done_callback(partial(self.on_reply, frame_id=frame_id))
+                self.sent += 1
+
+            next_tick += period
+            # Skip the ticks missed while stalled instead of bursting to catch up
+            if next_tick < time.perf_counter():
+                next_tick = time.perf_counter() + period
+
+        # Leave the actuator off
+        if self.pwm_cycle is not None:
+            self.link.set_pwm(sum(self.pwm_cycle), 0)
+
+    def stop(self) -> None:
+        self.running = False
+
+    def stats(self) -> dict[str, float]:
+        """
+        Returns the send lateness, acknowledgement latency and jitter of the
+        device update intervals in milliseconds
+        """
+        stats = {"sent": self.sent, "failed": self.failed, "stale": self.stale}
+        if len(self.lateness) > 0:
+            times = np.array(self.lateness) * 1000
+            stats["lateness_p50_ms"] = float(np.percentile(times, 50))
+            stats["lateness_p99_ms"] = float(np.percentile(times, 99))
+            stats["lateness_max_ms"] = float(times.max())
+        if len(self.ack_latencies) > 0:
+            times = np.array(self.ack_latencies) * 1000
+            stats["ack_p50_ms"] = float(np.percentile(times, 50))
+            stats["ack_p99_ms"] = float(np.percentile(times, 99))
+        if len(self.device_times) > 1:
+            # Device clock wraps every 2^32 us
+            intervals = np.diff(np.array(self.device_times)) % (2**32 / 1e6)
+            jitter = (intervals - 1.0 / self.rate) * 1000
+            stats["device_jitter_std_ms"] = float(jitter.std())
+            stats["device_jitter_max_ms"] = float(np.abs(jitter).max())
+        return stats
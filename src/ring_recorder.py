@@ -0,0 +1,231 @@
+import os
+import time
+
+import cv2 as cv
+import numpy as np
+from PySide6.QtCore import QMutex, QMutexLocker, QThread, Signal
+
+from frame_timestamps import TimestampWriter
+from segmented_video import new_recording_dir
+
+
+class RingRecorder(QThread):
+    """
+    A `QThread` based class keeping the last few seconds of camera frames in RAM.
+
+    `push()` is called from the camera thread for every frame and only copies the
+    frame into a preallocated slot. When `trigger()` is called, this thread writes
+    the pre-trigger window plus the following post-trigger window to a new
+    `recordings/<date>_<time>_trigger` directory while acquisition keeps going.
+    """
+
+    saved = Signal(str)
+
+    def __init__(
+        self,
+        memory_budget_mb: float = 1024,
+        pre_seconds: float = 1.0,
+        post_seconds: float = 1.0,
+        fps: float = 100,
+    ) -> None:
+        super().__init__()
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        self.fps = fps
+        self.running = False
+        # Seconds without new frames after which a flush stops early, e.g. when
+        # the camera stopped grabbing before the event ended
+        self.idle_timeout = 1.0
+
+        # Allocated on the first frame, once the frame geometry is known
+        self.frames: np.ndarray | None = None
+        self.timestamps = np.zeros(0, dtype=np.float64)
+        # Sequence number of the frame held in each slot, -1 if empty
+        self.slot_seq = np.zeros(0, dtype=np.int64)
+        self.capacity = 0
+        self.count = 0
+        # Held while the ring is reallocated and while a slot is copied out of
+        # it, so a flush never reads from arrays being replaced
+        self.ring_mutex = QMutex()
+        # Number of allocations, a flush stops when the ring it read from is gone
+        self.generation = 0
+
+        self.trigger_mutex = QMutex()
+        # (start_timestamp, end_timestamp, reason) of requested flushes
+        self.pending: list[tuple[float, float, str]] = []
+
+    def allocate(self, frame: np.ndarray) -> None:
+        """
+        Sizes the ring from the memory budget for frames shaped like `frame`
+        """
+        self.capacity = max(1, self.memory_budget // frame.nbytes)
+        self.frames = np.empty((self.capacity, *frame.shape), dtype=frame.dtype)
+        self.timestamps = np.zeros(self.capacity, dtype=np.float64)
+        self.slot_seq = np.full(self.capacity, -1, dtype=np.int64)
+        self.count = 0
+        self.generation += 1
+        print(
+            f"Ring buffer holds {self.capacity} frames "
+            f"({self.capacity / self.fps:.2f} s at {self.fps} fps)"
+        )
+
+    def push(self, frame: np.ndarray, timestamp: float) -> None:
+        """
+        Stores `frame` in the ring, overwriting the oldest frame when full
+        """
+        if (
+            self.frames is None
+            or frame.shape != self.frames.shape[1:]
+            or frame.dtype != self.frames.dtype
+        ):
+            with QMutexLocker(self.ring_mutex):
+                self.allocate(frame)
+
+        slot = self.count % self.capacity
+        # Invalidate the slot first so a concurrent reader can spot torn frames
+        self.slot_seq[slot] = -1
+        self.frames[slot] = frame
+        self.timestamps[slot] = timestamp
+        self.slot_seq[slot] = self.count
+        self.count += 1
+
+    def latest_timestamp(self) -> float | None:
+        if self.count == 0:
+            return None
+        return float(self.timestamps[(self.count - 1) % self.capacity])
+
+    def buffered_seconds(self) -> float:
+        """
+        Returns how many seconds of frames the ring can hold at the configured fps
+        """
+        return self.capacity / self.fps if self.fps > 0 else 0.0
+
+    def trigger(self, reason: str = "api") -> None:
+        """
+        Requests a recording of `pre_seconds` before and `post_seconds` after now
+        """
+        now = self.latest_timestamp()
+        if now is None:
+            print("Ring buffer is empty, ignoring trigger")
+            return
+
+        with QMutexLocker(self.trigger_mutex):
+            # A trigger during an event that is still being flushed extends it
+            if self.pending and now - self.pre_seconds <= self.pending[-1][1]:
+                start, _, first_reason = self.pending[-1]
+                self.pending[-1] = (start, now + self.post_seconds, first_reason)
+            else:
+                self.pending.append(
+                    (now - self.pre_seconds, now + self.post_seconds, reason)
+                )
+        print(f"Recording triggered ({reason})")
+
+    def run(self) -> None:
+        self.running = True
+        while self.running:
+            with QMutexLocker(self.trigger_mutex):
+                event = self.pending[0] if self.pending else None
+
+            if event is None:
+                time.sleep(0.01)
+                continue
+
+            self.flush(event)
+            with QMutexLocker(self.trigger_mutex):
+                self.pending.pop(0)
+
+    def oldest_seq_after(self, timestamp: float) -> int:
+        """
+        Returns the sequence number of the first buffered frame at or after `timestamp`
+        """
+        first = max(0, self.count - self.capacity)
+        for seq in range(first, self.count):
+            if self.timestamps[seq % self.capacity] >= timestamp:
+                return seq
+        return self.count
+
+    def flush(self, event: tuple[float, float, str]) -> None:
+        """
+        Streams the frames of `event` from the ring to disk, following the camera
+        """
+        start, _, reason = event
+        out = None
+        timestamps = None
+        scratch = None
+        with QMutexLocker(self.ring_mutex):
+            generation = self.generation
+            seq = self.oldest_seq_after(start)
+        dropped = 0
+        last_count = self.count
+        last_frame_at = time.perf_counter()
+
+        while self.running:
+            # The end may move if the event was re-triggered
+            with QMutexLocker(self.trigger_mutex):
+                end = self.pending[0][1]
+
+            if seq >= self.count:
+                latest = self.latest_timestamp()
+                if latest is not None and latest >= end:
+                    break
+                if self.count != last_count:
+                    last_count = self.count
+                    last_frame_at = time.perf_counter()
+                elif time.perf_counter() - last_frame_at > self.idle_timeout:
+                    print("Camera stopped before the triggered recording ended")
+                    break
+                time.sleep(0.001)
+                continue
+
+            # Fell so far behind that the slot was already overwritten
+            if seq < self.count - self.capacity:
+                dropped += self.count - self.capacity - seq
+                seq = self.count - self.capacity
+
+            with QMutexLocker(self.ring_mutex):
+                if self.generation != generation:
+                    print("Frame size changed during the triggered recording")
+                    break
+                slot = seq % self.capacity
+                if scratch is None:
+                    scratch = np.empty_like(self.frames[slot])
+                np.copyto(scratch, self.frames[slot])
+                timestamp = float(self.timestamps[slot])
+                valid = self.slot_seq[slot] == seq
+            if not valid:
+                dropped += 1
+                seq += 1
+                continue
+            seq += 1
+
+            if timestamp > end:
+                break
+
+            if out is None:
+                filename = os.path.join(
+                    new_recording_dir("trigger"), f"trigger_{reason}.mp4"
+                )
+                h, w = scratch.shape[:2]
+                out = cv.VideoWriter(
+                    filename,
+                    cv.VideoWriter.fourcc(*"mp4v"),
+                    self.fps,
+                    (w, h),
+                    isColor=scratch.ndim == 3,
+                )
+                timestamps = TimestampWriter(filename)
+            out.write(scratch)
+            timestamps.write(timestamp)
+
+        if out:
+            out.release()
+            timestamps.close()
+            if dropped:
+                print(f"Ring recorder dropped {dropped} frames while flushing")
+            print(f"Saved triggered recording to {filename}")
+            self.saved.emit(filename)
+
+    def stop(self) -> None:
+        self.running = False
+        self.wait()
@@ -0,0 +1,195 @@
+import json
+import os
+from collections.abc import Iterable, Iterator
+
+import cv2 as cv
+import numpy as np
+
+# One index record per stored crop. Keyframes use track id `KEYFRAME_TRACK`.
+ROI_INDEX_DTYPE = np.dtype(
+    [
+        ("frame", "<i8"),
+        ("track", "<i4"),
+        ("x", "<i4"),
+        ("y", "<i4"),
+        ("w", "<i4"),
+        ("h", "<i4"),
+        ("offset", "<i8"),
+        ("size", "<i8"),
+        ("timestamp", "<f8"),
+    ]
+)
+KEYFRAME_TRACK = -1
+
+
+class RoiRecorder:
+    """
+    Records only padded crops around live tracks, plus a lossless full-frame
+    keyframe every `keyframe_interval` frames.
+
+    A recording is a directory holding `header.json`, the raw crop bytes in
+    `rois.bin` and one `ROI_INDEX_DTYPE` record per crop in `index.bin`.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        frame_shape: tuple[int, ...],
+        padding: int = 8,
+        keyframe_interval: int = 100,
+    ) -> None:
+        self.directory = directory
+        self.frame_shape = frame_shape
+        self.padding = padding
+        self.keyframe_interval = keyframe_interval
+        self.frames_written = 0
+        self.bytes_written = 0
+
+        with open(os.path.join(directory, "header.json"), "w") as f:
+            json.dump(
+                {
+                    "frame_shape": list(frame_shape),
+                    "padding": padding,
+                    "keyframe_interval": keyframe_interval,
+                },
+                f,
+                indent=2,
+            )
+        self.data = open(os.path.join(directory, "rois.bin"), "wb")
+        self.index = open(os.path.join(directory, "index.bin"), "wb")
+
+    def add_record(
+        self,
+        frame_pos: int,
+        track: int,
+        x: int,
+        y: int,
+        data: np.ndarray,
+        shape: tuple[int, int],
+        timestamp: float,
+    ) -> None:
+        record = np.zeros(1, dtype=ROI_INDEX_DTYPE)
+        record["frame"] = frame_pos
+        record["track"] = track
+        record["x"] = x
+        record["y"] = y
+        record["h"], record["w"] = shape
+        record["offset"] = self.bytes_written
+        record["size"] = data.nbytes
+        record["timestamp"] = timestamp
+        self.data.write(data.tobytes())
+        record.tofile(self.index)
+        self.bytes_written += data.nbytes
+
+    def write(
+        self,
+        frame: np.ndarray,
+        frame_pos: int,
+        timestamp: float,
+        tracks: Iterable[tuple[int, float, float, float]],
+    ) -> None:
+        """
+        Stores the crops of `frame` around each `(track_id, x, y, r)` in `tracks`
+        """
+        if self.data.closed:
+            return
+
+        if self.frames_written % self.keyframe_interval == 0:
+            ok, encoded = cv.imencode(".png", frame)
+            if ok:
+                self.add_record(
+                    frame_pos, KEYFRAME_TRACK, 0, 0, encoded, frame.shape[:2], timestamp
+                )
+
+        h, w = frame.shape[:2]
+        for track, x, y, r in tracks:
+            half = int(np.ceil(r)) + self.padding
+            x0, y0 = max(int(x) - half, 0), max(int(y) - half, 0)
+            x1, y1 = min(int(x) + half + 1, w), min(int(y) + half + 1, h)
+            if x1 <= x0 or y1 <= y0:
+                continue
+            crop = np.ascontiguousarray(frame[y0:y1, x0:x1])
+            self.add_record(frame_pos, track, x0, y0, crop, crop.shape[:2], timestamp)
+
+        self.frames_written += 1
+
+    def release(self) -> None:
+        if not self.data.closed:
+            self.data.close()
+            self.index.close()
+            full_bytes = self.frames_written * int(np.prod(self.frame_shape))
+            ratio = full_bytes / self.bytes_written if self.bytes_written else 0
+            print(
+                f"Saved ROI recording to {self.directory} "
+                f"({ratio:.1f}x smaller than full frames)"
+            )
+
+
+class RoiReader:
+    """
+    Reads a recording made by `RoiRecorder`
+    """
+
+    def __init__(self, directory: str) -> None:
+        with open(os.path.join(directory, "header.json")) as f:
+            header = json.load(f)
+        self.frame_shape = tuple(header["frame_shape"])
+        self.index = np.fromfile(
+            os.path.join(directory, "index.bin"), dtype=ROI_INDEX_DTYPE
+        )
+        data_path = os.path.join(directory, "rois.bin")
+        if os.path.getsize(data_path) > 0:
+            self.data = np.memmap(data_path, dtype=np.uint8, mode="r")
+        else:
+            self.data = np.zeros(0, dtype=np.uint8)
+
+        self.keyframes = self.index[self.index["track"] == KEYFRAME_TRACK]
+        self.crops = self.index[self.index["track"] != KEYFRAME_TRACK]
+
+    def track_ids(self) -> np.ndarray:
+        return np.unique(self.crops["track"])
+
+    def frame_positions(self) -> np.ndarray:
+        return np.unique(self.index["frame"])
+
+    def crop(self, record: np.void) -> np.ndarray:
+        """
+        Returns the pixels stored for an index `record`
+        """
+        start = int(record["offset"])
+        data = self.data[start : start + int(record["size"])]
+        if record["track"] == KEYFRAME_TRACK:
+            return cv.imdecode(np.asarray(data), cv.IMREAD_UNCHANGED)
+        shape = (int(record["h"]), int(record["w"]), *self.frame_shape[2:])
+        return np.asarray(data).reshape(shape)
+
+    def track_clip(
+        self, track_id: int
+    ) -> Iterator[tuple[int, float, tuple[int, int], np.ndarray]]:
+        """
+        Yields `(frame_pos, timestamp, (x0, y0), crop)` for every frame of `track_id`
+        """
+        for record in self.crops[self.crops["track"] == track_id]:
+            yield (
+                int(record["frame"]),
+                float(record["timestamp"]),
+                (int(record["x"]), int(record["y"])),
+                self.crop(record),
+            )
+
+    def frame(self, frame_pos: int) -> np.ndarray:
+        """
+        Approximates the full frame at `frame_pos` by pasting its crops onto the
+        most recent keyframe
+        """
+        earlier = self.keyframes[self.keyframes["frame"] <= frame_pos]
+        if len(earlier) > 0:
+            frame = self.crop(earlier[-1]).copy()
+        else:
+            frame = np.zeros(self.frame_shape, dtype=np.uint8)
+
+        for record in self.crops[self.crops["frame"] == frame_pos]:
+            x, y = int(record["x"]), int(record["y"])
+            h, w = int(record["h"]), int(record["w"])
+            frame[y : y + h, x : x + w] = self.crop(record)
+        return frame
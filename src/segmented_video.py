@@ -0,0 +1,278 @@
+import bisect
+import json
+import os
+import time
+
+import cv2 as cv
+import numpy as np
+
+from frame_timestamps import TimestampWriter
+
+RECORDINGS_DIR = "recordings"
+MANIFEST_VERSION = 1
+
+
+def new_recording_dir(name: str) -> str:
+    """
+    Creates and returns a fresh, timestamped directory for a recording called `name`
+    """
+    path = os.path.join(RECORDINGS_DIR, f"{time.strftime('%Y%m%d_%H%M%S')}_{name}")
+    suffix = 1
+    unique_path = path
+    while os.path.exists(unique_path):
+        unique_path = f"{path}_{suffix}"
+        suffix += 1
+    os.makedirs(unique_path)
+    return unique_path
+
+
+class SegmentedVideoWriter:
+    """
+    Video writer that rotates to a new segment file after `max_seconds` of capture
+    time or `max_mb` of encoded data.
+
+    Finished segments are complete video files, and `manifest.json` is rewritten
+    whenever a segment is opened or closed, so a long recording can be opened
+    while it is still running. The segment being written is listed with no
+    frames until it is closed. Capture timestamps of the whole recording go
+    into `manifest.ts`. Frames without a capture time (NaN) are placed one
+    nominal frame interval after the previous frame for rotation and the
+    manifest, which only ever holds finite times.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        fps: float,
+        frame_size: tuple[int, int],
+        is_color: bool,
+        max_seconds: float | None = 60,
+        max_mb: float | None = 2048,
+    ) -> None:
+        self.directory = directory
+        self.fps = fps
+        self.frame_size = frame_size
+        self.is_color = is_color
+        self.max_seconds = max_seconds
+        self.max_bytes = max_mb * 1024 * 1024 if max_mb else None
+
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        self.timestamps = TimestampWriter(self.manifest_path)
+        self.segments: list[dict] = []
+        self.out: cv.VideoWriter | None = None
+        # Capture time of the recording's first frame, from the first finite one
+        self.start_time: float | None = None
+        self.elapsed = 0.0
+        self.frame_count = 0
+        self.released = False
+
+    def isOpened(self) -> bool:
+        return not self.released
+
+    def open_segment(self, timestamp: float) -> None:
+        filename = f"segment_{len(self.segments):04d}.mp4"
+        self.out = cv.VideoWriter(
+            os.path.join(self.directory, filename),
+            cv.VideoWriter.fourcc(*"mp4v"),
+            self.fps,
+            self.frame_size,
+            isColor=self.is_color,
+        )
+        if not self.out.isOpened():
+            raise RuntimeError(f"Could not open VideoWriter for {filename}")
+        self.segments.append(
+            {
+                "file": filename,
+                "first_frame": self.frame_count,
+                "frame_count": 0,
+                "start_time": timestamp,
+                "end_time": timestamp,
+            }
+        )
+        self.write_manifest()
+
+    def close_segment(self) -> None:
+        if self.out:
+            self.out.release()
+            self.out = None
+            self.write_manifest()
+
+    def should_rotate(self, timestamp: float) -> bool:
+        segment = self.segments[-1]
+        if segment["frame_count"] == 0:
+            return False
+        if self.max_seconds and timestamp - segment["start_time"] >= self.max_seconds:
+            return True
+        # File size lags the encoder a little, so only check it periodically
+        if self.max_bytes and segment["frame_count"] % 30 == 0:
+            path = os.path.join(self.directory, segment["file"])
+            return os.path.getsize(path) >= self.max_bytes
+        return False
+
+    def write(self, frame: np.ndarray, timestamp: float) -> None:
+        """
+        Writes `frame`, captured at `timestamp` seconds, to the current segment
+        """
+        if self.released:
+            return
+
+        self.timestamps.write(timestamp)
+        # Segment times are relative to the first frame, like the sidecar
+        if np.isfinite(timestamp):
+            if self.start_time is None:
+                self.start_time = timestamp - self.frame_count / self.fps
+            elapsed = timestamp - self.start_time
+        elif self.frame_count == 0:
+            elapsed = 0.0
+        else:
+            elapsed = self.elapsed + 1 / self.fps
+        self.elapsed = elapsed
+
+        if self.out is None:
+            self.open_segment(elapsed)
+        elif self.should_rotate(elapsed):
+            self.close_segment()
+            self.open_segment(elapsed)
+
+        self.out.write(frame)
+        segment = self.segments[-1]
+        # Kept out of the manifest until the segment is closed and readable
+        segment["frame_count"] += 1
+        segment["end_time"] = elapsed
+        self.frame_count += 1
+
+    def write_manifest(self) -> None:
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "fps": self.fps,
+            "frame_size": list(self.frame_size),
+            "is_color": self.is_color,
+            "frame_count": self.frame_count,
+            "segments": self.segments,
+        }
+        # Replace atomically so readers never see a half written manifest
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2, allow_nan=False)
+        os.replace(tmp_path, self.manifest_path)
+
+    def release(self) -> None:
+        if self.released:
+            return
+        self.released = True
+        self.close_segment()
+        self.timestamps.close()
+        print(f"Saved {self.frame_count} frames to {self.manifest_path}")
+
+
+class SegmentedVideoCapture:
+    """
+    Reads a segmented recording's manifest as one seekable stream.
+
+    Implements the parts of the `cv.VideoCapture` interface used by `VideoReadThread`.
+    """
+
+    def __init__(self, manifest_path: str) -> None:
+        self.directory = os.path.dirname(manifest_path)
+        with open(manifest_path) as f:
+            self.manifest = json.load(f)
+        self.segments = self.manifest["segments"]
+        self.first_frames = [segment["first_frame"] for segment in self.segments]
+        self.frame_count = sum(segment["frame_count"] for segment in self.segments)
+
+        self.cap: cv.VideoCapture | None = None
+        self.segment_idx = -1
+        self.pos = 0
+        self.open_segment(0)
+
+    def isOpened(self) -> bool:
+        return self.cap is not None and self.cap.isOpened()
+
+    def open_segment(self, idx: int) -> bool:
+        if self.cap:
+            self.cap.release()
+            self.cap = None
+        self.segment_idx = idx
+        if idx >= len(self.segments):
+            return False
+        path = os.path.join(self.directory, self.segments[idx]["file"])
+        self.cap = cv.VideoCapture(path)
+        return self.cap.isOpened()
+
+    def read(self) -> tuple[bool, np.ndarray | None]:
+        if self.pos >= self.frame_count:
+            return False, None
+
+        segment = self.segments[self.segment_idx]
+        if self.pos >= segment["first_frame"] + segment["frame_count"]:
+            if not self.open_segment(self.segment_idx + 1):
+                return False, None
+
+        ret, frame = self.cap.read()
+        if ret:
+            self.pos += 1
+        return ret, frame
+
+    def set(self, prop_id: int, value: float) -> bool:
+        if prop_id != cv.CAP_PROP_POS_FRAMES:
+            return False
+
+        pos = int(min(max(value, 0), self.frame_count))
+        idx = max(bisect.bisect_right(self.first_frames, pos) - 1, 0)
+        if idx != self.segment_idx and not self.open_segment(idx):
+            return False
+        self.pos = pos
+        return self.cap.set(cv.CAP_PROP_POS_FRAMES, pos - self.first_frames[idx])
+
+    def get(self, prop_id: int) -> float:
+        if prop_id == cv.CAP_PROP_POS_FRAMES:
+            return float(self.pos)
+        if prop_id == cv.CAP_PROP_FRAME_COUNT:
+            return float(self.frame_count)
+        if prop_id == cv.CAP_PROP_FPS:
+            return float(self.manifest["fps"])
+        return self.cap.get(prop_id) if self.cap else 0.0
+
+    def release(self) -> None:
+        if self.cap:
+            self.cap.release()
+            self.cap = None
+
+
+def open_video(path: str) -> cv.VideoCapture | SegmentedVideoCapture:
+    """
+    Opens either a plain video file or a segmented recording's `manifest.json`
+    """
+    if path.endswith(".json"):
+        return SegmentedVideoCapture(path)
+    return cv.VideoCapture(path)
+
+
+if __name__ == "__main__":
+    # Checks that recordings with missing capture times still rotate and keep
+    # a strict JSON manifest, e.g. python src/segmented_video.py
+    import tempfile
+
+    nan = float("nan")
+    with tempfile.TemporaryDirectory() as directory:
+        writer = SegmentedVideoWriter(
+            directory, 10, (32, 24), is_color=False, max_seconds=1, max_mb=None
+        )
+        frame = np.zeros((24, 32), dtype=np.uint8)
+        # Starts and continues without times, then mixes in real ones
+        timestamps = [nan] * 15 + [100.0 + 0.1 * i for i in range(10)] + [nan] * 10
+        for timestamp in timestamps:
+            writer.write(frame, timestamp)
+        writer.release()
+
+        def reject(constant):
+            raise ValueError(f"{constant} in manifest")
+
+        with open(writer.manifest_path) as f:
+            manifest = json.load(f, parse_constant=reject)
+        segments = manifest["segments"]
+        assert len(segments) == 4, segments
+        assert sum(s["frame_count"] for s in segments) == len(timestamps)
+        # 15 frames at the nominal rate, 0.9 s of capture time, then 10 more
+        assert abs(segments[-1]["end_time"] - 3.4) < 1e-9, segments[-1]
+        print(f"{len(segments)} segments: {[s['start_time'] for s in segments]}")
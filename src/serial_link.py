@@ -0,0 +1,310 @@
+import struct
+import time
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+
+import numpy as np
+import serial
+from PySide6.QtCore import QMutex, QMutexLocker, QThread
+
+# Frame layout, little-endian:
+#   sync (A5 5A) | command u8 | sequence u16 | payload length u8 | payload |
+#   CRC-16/CCITT-FALSE u16 of command through payload
+SYNC = b"\xa5\x5a"
+HEADER = struct.Struct("<BHB")
+CRC = struct.Struct("<H")
+MAX_PAYLOAD = 255
+
+CMD_PING = 0x01
+# Payload `<II`: PWM period and on time in microseconds
+CMD_PWM = 0x10
+# Payload `<I`: single pulse length in microseconds, acknowledged once it ended
+CMD_PULSE = 0x11
+# Replies carry the command they answer with this bit set
+REPLY = 0x80
+# Reply payload of an accepted command `<I`: device time in microseconds at
+# which the command took effect
+ACK = struct.Struct("<I")
+# Reply to a rejected command, payload `<B` error code
+CMD_NACK = 0xFF
+
+
+def crc16_table() -> list[int]:
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else crc << 1
+        table.append(crc & 0xFFFF)
+    return table
+
+
+CRC16_TABLE = crc16_table()
+
+
+def crc16(data: bytes, crc: int = 0xFFFF) -> int:
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ CRC16_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+
+def encode_frame(command: int, seq: int, payload: bytes = b"") -> bytes:
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError(f"Payloads are at most {MAX_PAYLOAD} bytes")
+    body = HEADER.pack(command, seq & 0xFFFF, len(payload)) + payload
+    return SYNC + body + CRC.pack(crc16(body))
+
+
+class FrameParser:
+    """
+    Splits a byte stream into `(command, seq, payload)` frames, skipping
+    anything before a sync word and frames with a bad CRC
+    """
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+        self.crc_errors = 0
+
+    def feed(self, data: bytes) -> list[tuple[int, int, bytes]]:
+        self.buffer += data
+        frames = []
+        while True:
+            start = self.buffer.find(SYNC)
+            if start < 0:
+                # Keep a trailing first sync byte
+                del self.buffer[: max(len(self.buffer) - 1, 0)]
+                return frames
+            del self.buffer[:start]
+
+            body_start = len(SYNC)
+            if len(self.buffer) < body_start + HEADER.size:
+                return frames
+            command, seq, length = HEADER.unpack_from(self.buffer, body_start)
+            end = body_start + HEADER.size + length
+            if len(self.buffer) < end + CRC.size:
+                return frames
+
+            body = bytes(self.buffer[body_start:end])
+            (crc,) = CRC.unpack_from(self.buffer, end)
+            if crc != crc16(body):
+                # Resynchronize on the next sync word
+                self.crc_errors += 1
+                del self.buffer[:1]
+                continue
+            frames.append((command, seq, body[HEADER.size :]))
+            del self.buffer[: end + CRC.size]
+
+
+class Reply:
+    """
+    Answer of the device to one command
+    """
+
+    def __init__(
+        self,
+        command: int,
+        seq: int,
+        payload: bytes,
+        sent_at: float,
+        received_at: float,
+    ) -> None:
+        self.command = command
+        self.seq = seq
+        self.payload = payload
+        # `time.perf_counter()` times the command was written and answered
+        self.sent_at = sent_at
+        self.received_at = received_at
+
+    @property
+    def device_time(self) -> int | None:
+        """
+        Device time in microseconds at which the command took effect
+        """
+        if len(self.payload) < ACK.size:
+            return None
+        return ACK.unpack_from(self.payload)[0]
+
+    @property
+    def round_trip(self) -> float:
+        return self.received_at - self.sent_at
+
+
+def settle(future: Future, result=None, error: Exception | None = None) -> None:
+    """
+    Completes `future` with `result` or `error`, unless the caller already
+    cancelled it
+    """
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+class SerialLink(QThread):
+    """
+    A `QThread` based class talking to the ESP32 controller with binary frames.
+
+    `send()` writes a frame and returns at once with a `Future`, which this
+    thread completes with the matching `Reply` (by sequence number) or fails
+    with `TimeoutError` after `reply_timeout` seconds or `RuntimeError` on a
+    NACK. The analysis loop therefore never waits on the microcontroller.
+    """
+
+    def __init__(
+        self,
+        port: str,
+        baudrate: int = 115200,
+        reply_timeout: float = 0.5,
+    ) -> None:
+        super().__init__()
+        self.port = port
+        self.baudrate = baudrate
+        self.reply_timeout = reply_timeout
+        self.serial: serial.SerialBase | None = None
+        self.running = False
+
+        self.seq = 0
+        # (future, command, sent time) of the commands awaiting a reply, by seq
+        self.pending: dict[int, tuple[Future, int, float]] = {}
+        self.mutex = QMutex()
+        self.parser = FrameParser()
+
+        self.timeouts = 0
+        # Seconds from writing each command to receiving its reply
+        self.round_trips: deque[float] = deque(maxlen=1000)
+
+    def open(self) -> bool:
+        try:
+            self.serial = serial.serial_for_url(
+                self.port, baudrate=self.baudrate, timeout=0.01
+            )
+        except serial.SerialException as e:
+            print(f"Serial connection error: {e}")
+            return False
+        self.serial.reset_input_buffer()
+        self.start()
+        return True
+
+    def send(self, command: int, payload: bytes = b"") -> Future:
+        future = Future()
+        with QMutexLocker(self.mutex):
+            if self.serial is None:
+                future.set_exception(ConnectionError("Serial link not open"))
+                return future
+            seq = self.seq
+            self.seq = (self.seq + 1) & 0xFFFF
+            frame = encode_frame(command, seq, payload)
+            self.pending[seq] = (future, command, time.perf_counter())
+            try:
+                self.serial.write(frame)
+            except serial.SerialException as e:
+                del self.pending[seq]
+                future.set_exception(e)
+        return future
+
+    def ping(self) -> Future:
+        return self.send(CMD_PING)
+
+    def set_pwm(self, cycle_time: float, on_time: float) -> Future:
+        """
+        Sets the PWM period and on time, both in milliseconds
+        """
+        return self.send(
+            CMD_PWM, struct.pack("<II", round(cycle_time * 1000), round(on_time * 1000))
+        )
+
+    def pulse(self, on_time: float) -> Future:
+        """
+        Fires one pulse of `on_time` milliseconds
+        """
+        return self.send(CMD_PULSE, struct.pack("<I", round(on_time * 1000)))
+
+    def dispatch(self, command: int, seq: int, payload: bytes) -> None:
+        received_at = time.perf_counter()
+        with QMutexLocker(self.mutex):
+            entry = self.pending.pop(seq, None)
+        if entry is None:
+            return
+        future, sent_command, sent_at = entry
+        if command not in (sent_command | REPLY, CMD_NACK):
+            settle(
+                future,
+                error=RuntimeError(
+                    f"Unexpected reply {command:#04x} to {sent_command:#04x}"
+                ),
+            )
+            return
+        if command == CMD_NACK:
+            code = payload[0] if payload else -1
+            settle(
+                future,
+                error=RuntimeError(f"Command {sent_command:#04x} rejected ({code})"),
+            )
+            return
+        self.round_trips.append(received_at - sent_at)
+        settle(future, Reply(command, seq, payload, sent_at, received_at))
+
+    def expire(self) -> None:
+        """
+        Fails the commands left unanswered for `reply_timeout`
+        """
+        now = time.perf_counter()
+        with QMutexLocker(self.mutex):
+            expired = [
+                seq
+                for seq, (_, _, sent_at) in self.pending.items()
+                if now - sent_at > self.reply_timeout
+            ]
+            entries = [self.pending.pop(seq) for seq in expired]
+        for future, command, _ in entries:
+            self.timeouts += 1
+            settle(future, error=TimeoutError(f"No reply to command {command:#04x}"))
+
+    def run(self) -> None:
+        self.running = True
+        while self.running:
+            try:
+                data = self.serial.read(max(self.serial.in_waiting, 1))
+            except serial.SerialException as e:
+                print(f"Serial read error: {e}")
+                break
+            for command, seq, payload in self.parser.feed(data):
+                self.dispatch(command, seq, payload)
+            self.expire()
+
+        # Nothing will answer the commands still pending
+        with QMutexLocker(self.mutex):
+            entries = list(self.pending.values())
+            self.pending.clear()
+        for future, command, _ in entries:
+            settle(future, error=ConnectionError("Serial link closed"))
+
+    def stop(self) -> None:
+        self.running = False
+
+    def close(self) -> None:
+        self.stop()
+        self.wait()
+        with QMutexLocker(self.mutex):
+            if self.serial is not None:
+                self.serial.close()
+                self.serial = None
+
+    def stats(self) -> dict[str, float]:
+        """
+        Returns the command round trip times in milliseconds
+        """
+        stats = {
+            "replies": len(self.round_trips),
+            "timeouts": self.timeouts,
+            "crc_errors": self.parser.crc_errors,
+        }
+        if len(self.round_trips) > 0:
+            times = np.array(self.round_trips) * 1000
+            stats["round_trip_mean_ms"] = float(times.mean())
+            stats["round_trip_p50_ms"] = float(np.percentile(times, 50))
+            stats["round_trip_p99_ms"] = float(np.percentile(times, 99))
+        return stats
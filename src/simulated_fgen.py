@@ -0,0 +1,327 @@
+import time
+
+import numpy as np
+import pyvisa
+from pyvisa.constants import StatusCode
+
+SIMULATED_RESOURCE = "USB0::0x0957::0x0407::SIM0000001::INSTR"
+
+# Long SCPI keywords the simulation accepts, by their short form
+SHORT_FORMS = {
+    "VOLTAGE": "VOLT",
+    "OFFSET": "OFFS",
+    "FREQUENCY": "FREQ",
+    "FUNCTION": "FUNC",
+    "OUTPUT": "OUTP",
+    "BURST": "BURS",
+    "PHASE": "PHAS",
+    "POLARITY": "POL",
+    "NCYCLES": "NCYC",
+    "TRIGGER": "TRIG",
+    "SOURCE": "SOUR",
+    "STATE": "STAT",
+    "FORMAT": "FORM",
+    "BORDER": "BORD",
+    "SYSTEM": "SYST",
+    "ERROR": "ERR",
+}
+
+# Maximum frequency of each function in Hz
+MAX_FREQUENCY = {
+    "SIN": 20e6,
+    "SQU": 20e6,
+    "RAMP": 200e3,
+    "PULS": 5e6,
+    "NOIS": 20e6,
+    "DC": 20e6,
+    "USER": 6e6,
+}
+
+NUMERIC = {"FREQ", "VOLT", "VOLT:OFFS", "BURS:PHAS", "BURS:NCYC"}
+
+
+def default_state() -> dict[str, str | float]:
+    """
+    Returns the settings of the 33220A after `*RST`
+    """
+    return {
+        "FUNC": "SIN",
+        "FREQ": 1e3,
+        "VOLT": 0.1,
+        "VOLT:UNIT": "VPP",
+        "VOLT:OFFS": 0.0,
+        "OUTP": "OFF",
+        "FUNC:USER": "EXP_RISE",
+        "FORM:BORD": "NORM",
+        "BURS:STAT": "OFF",
+        "BURS:MODE": "TRIG",
+        "BURS:NCYC": 1.0,
+        "BURS:PHAS": 0.0,
+        "BURS:GATE:POL": "NORM",
+        "TRIG:SOUR": "IMM",
+    }
+
+
+def normalize_header(header: str) -> str:
+    keywords = header.strip().lstrip(":").upper().split(":")
+    keywords = [SHORT_FORMS.get(k, k) for k in keywords]
+    # SOURce is the default root of the signal settings
+    if keywords[0] == "SOUR" and len(keywords) > 1:
+        keywords = keywords[1:]
+    return ":".join(keywords)
+
+
+class Simulated33220A:
+    """
+    Simulated Agilent 33220A for running and benchmarking the instrument code
+    without the generator or NI-VISA.
+
+    Implements the pyvisa resource calls `FunctionGenerator` makes and the SCPI
+    subset it sends, keeping the instrument state, the volatile arbitrary
+    waveform and the error queue. Every write or query takes
+    `command_latency`, plus `header_latency` of its slowest header and its
+    size divided by `usb_bandwidth`. With `sleep=False` this time is only
+    added to `modelled_time`.
+    """
+
+    model_name = "33220A 20MHz Function / Arbitrary Waveform Generator"
+
+    def __init__(
+        self,
+        resource_name: str = SIMULATED_RESOURCE,
+        command_latency: float = 1e-3,
+        header_latency: dict[str, float] | None = None,
+        usb_bandwidth: float = 1e6,
+        sleep: bool = True,
+    ) -> None:
+        self.resource_name = resource_name
+        self.command_latency = command_latency
+        # Extra seconds taken by slow settings, e.g. a function change
+        self.header_latency = {"FUNC": 20e-3, "*RST": 50e-3}
+        if header_latency is not None:
+            self.header_latency.update(header_latency)
+        self.usb_bandwidth = usb_bandwidth
+        self.sleep = sleep
+        self.timeout = 2000
+
+        self.state = default_state()
+        self.volatile: np.ndarray | None = None
+        self.errors: list[str] = []
+        # Responses waiting to be read, from queries in the last message
+        self.output: list[str] = []
+
+        self.modelled_time = 0.0
+        self.round_trips = 0
+
+    def transfer(self, headers: list[str], nbytes: int) -> None:
+        """
+        Models the USB round-trip of one message
+        """
+        self.round_trips += 1
+        extra = max((self.header_latency.get(h, 0.0) for h in headers), default=0.0)
+        duration = self.command_latency + extra + nbytes / self.usb_bandwidth
+        self.modelled_time += duration
+        if self.sleep:
+            time.sleep(duration)
+
+    def error(self, code: int, message: str) -> None:
+        self.errors.append(f'{code},"{message}"')
+
+    def set(self, header: str, argument: str) -> None:
+        if header not in self.state:
+            self.error(-113, "Undefined header")
+            return
+
+        if header in NUMERIC:
+            try:
+                value = float(argument)
+            except ValueError:
+                self.error(-104, "Data type error")
+                return
+            self.state[header] = self.clip(header, value)
+        else:
+            self.state[header] = argument.upper()
+
+        if header == "FUNC":
+            # Coupled settings are clipped to the range of the new function
+            self.state["FREQ"] = self.clip("FREQ", self.state["FREQ"])
+        elif header == "FUNC:USER" and self.volatile is None:
+            self.error(-221, "Settings conflict; VOLATILE is empty")
+
+    def clip(self, header: str, value: float) -> float:
+        if header == "FREQ":
+            low, high = 1e-6, MAX_FREQUENCY[self.state["FUNC"]]
+        elif header == "VOLT":
+            low, high = 10e-3, 10.0
+        elif header == "VOLT:OFFS":
+            low, high = -5.0, 5.0
+        else:
+            return value
+        if not low <= value <= high:
+            self.error(-222, "Data out of range")
+        return min(max(value, low), high)
+
+    def respond(self, header: str) -> str | None:
+        if header == "*IDN":
+            serial = self.resource_name.split("::")[3]
+            return f"Agilent Technologies,33220A,{serial},2.02-2.02-22-2"
+        if header == "*OPC":
+            return "1"
+        if header == "SYST:ERR":
+            return self.errors.pop(0) if self.errors else '+0,"No error"'
+        if header not in self.state:
+            self.error(-113, "Undefined header")
+            return None
+        value = self.state[header]
+        return f"{value:+.15E}" if isinstance(value, float) else value
+
+    def execute(self, command: str) -> str | None:
+        command = command.strip()
+        if not command:
+            return None
+        header, _, argument = command.partition(" ")
+        if header.endswith("?"):
+            return self.respond(normalize_header(header[:-1]))
+
+        header = normalize_header(header)
+        if header == "*RST":
+            self.state = default_state()
+        elif header == "*CLS":
+            self.errors.clear()
+        else:
+            self.set(header, argument.strip())
+        return None
+
+    def write(self, message: str) -> tuple[int, StatusCode]:
+        commands = message.strip().split(";")
+        headers = [normalize_header(c.strip().split(" ")[0]) for c in commands]
+        self.transfer(headers, len(message))
+        self.output = []
+        for command in commands:
+            response = self.execute(command)
+            if response is not None:
+                self.output.append(response)
+        return len(message), StatusCode.success
+
+    def read(self) -> str:
+        if not self.output:
+            # Reading without a pending response times out on the instrument
+            raise pyvisa.errors.VisaIOError(StatusCode.error_timeout)
+        response = ";".join(self.output)
+        self.output = []
+        return response + "\n"
+
+    def query(self, message: str) -> str:
+        self.write(message)
+        return self.read()
+
+    def write_binary_values(
+        self,
+        message: str,
+        values,
+        datatype: str = "f",
+        is_big_endian: bool = False,
+    ) -> tuple[int, StatusCode]:
+        """
+        Accepts `DATA:DAC VOLATILE, <block>` with int16 values
+        """
+        header = normalize_header(message.split(" ")[0])
+        values = np.asarray(values)
+        nbytes = len(message) + values.nbytes + 8
+        self.transfer([header], nbytes)
+
+        if header != "DATA:DAC" or datatype != "h":
+            self.error(-113, "Undefined header")
+        elif is_big_endian != (self.state["FORM:BORD"] == "NORM"):
+            # The instrument would read the bytes in the wrong order
+            self.volatile = values.astype(np.int16).byteswap()
+        elif np.abs(values).max(initial=0) > 8191:
+            self.error(-222, "Data out of range")
+        else:
+            self.volatile = values.astype(np.int16)
+        return nbytes, StatusCode.success
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> "Simulated33220A":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class SimulatedResourceManager:
+    """
+    Stand-in for `pyvisa.ResourceManager` listing a single simulated 33220A.
+    Opening it again returns the same instrument, so its state persists.
+    """
+
+    def __init__(self, **kwargs) -> None:
+        self.instrument = Simulated33220A(**kwargs)
+
+    def list_resources(self, query: str = "?*::INSTR") -> tuple[str, ...]:
+        return (self.instrument.resource_name,)
+
+    def open_resource(self, resource_name: str, **kwargs) -> Simulated33220A:
+        if resource_name != self.instrument.resource_name:
+            raise pyvisa.errors.VisaIOError(StatusCode.error_resource_not_found)
+        return self.instrument
+
+    def close(self) -> None:
+        pass
+
+
+if __name__ == "__main__":
+    # Benchmarks the function generator command paths against the simulation
+    from PySide6.QtCore import QCoreApplication
+
+    from function_generator import FunctionGenerator
+    from instrument_worker import InstrumentWorker
+
+    app = QCoreApplication([])
+    rm = SimulatedResourceManager()
+    instrument = rm.instrument
+    fgen = FunctionGenerator(rm)
+    fgen.select_instrument(rm, SIMULATED_RESOURCE)
+    # Clears the out of range error of the 0 V amplitude set on connection
+    instrument.write("*CLS")
+    ticks = np.linspace(0.1, 5.0, 200)
+
+    # What set_voltage used to send for every slider tick
+    start = instrument.modelled_time
+    for v in ticks:
+        instrument.write("VOLT:UNIT VPP")
+        instrument.write(f"VOLT {v}")
+        instrument.query("VOLT?")
+        instrument.query("VOLT:UNIT?")
+    legacy_time = instrument.modelled_time - start
+
+    start = instrument.modelled_time
+    for v in ticks:
+        fgen.set_voltage(v + 0.01, "vpp")
+    coalesced_time = instrument.modelled_time - start
+
+    worker = InstrumentWorker(fgen)
+    worker.start()
+    round_trips = instrument.round_trips
+    start = time.perf_counter()
+    submit_times = []
+    for v in ticks:
+        t = time.perf_counter()
+        worker.set_voltage(v, "vpp")
+        submit_times.append(time.perf_counter() - t)
+        # Dragging a slider emits a value every few milliseconds
+        time.sleep(0.0005)
+    worker.stop()
+    worker.wait()
+    assert instrument.state["VOLT"] == ticks[-1]
+    assert instrument.respond("SYST:ERR") == '+0,"No error"'
+
+    print(f"legacy: {legacy_time / len(ticks) * 1000:.2f} ms/tick")
+    print(f"coalesced: {coalesced_time / len(ticks) * 1000:.2f} ms/tick")
+    print(
+        f"worker: {instrument.round_trips - round_trips} writes for {len(ticks)} "
+        f"ticks, submit max {max(submit_times) * 1e6:.0f} us"
+    )
+    print(f"function generator: {fgen.stats()}")
@@ -10,11 +10,17 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
 from frame_analysis import frame_analysis
+from frame_timestamps import read_timestamps
+from segmented_video import new_recording_dir, open_video
+from analysis_recording import AnalysisRecorder
+from roi_recording import RoiRecorder
 
 
 class VideoReadThread(QThread):
     FrameUpdate = Signal(object)
     PIDcmds = Signal(object)
+    # Emitted with a reason when a tracked event should trigger a recording
+    TriggerEvent = Signal(str)
 
     def __init__ (
         self,
@@ -52,6 +58,23 @@ class VideoReadThread(QThread):
         self.bubble_counter_start = 1
         self.radii = []
         self.control_vals = []
+        self.out = None
+        # If `None`, no sparse ROI recording is running
+        self.roi_recorder = None
+        # Per-frame capture times of the opened video, if it has a sidecar
+        self.frame_times = None
+        # Bubbles currently above the trigger radius, so each crossing fires once
+        self.triggered_ids = set()
+        # `ClosedLoopMasker` projecting masks of the tracked bubbles, if any
+        self.masker = None
+        # `PwmActuator` streaming the PID output to the ESP32, if any
+        self.actuator = None
+        # `ControlLoop` running the PID at a fixed rate, if any
+        self.control_loop = None
+        # `InstrumentWorker` playing the PID duty cycle on the function generator
+        self.instrument_worker = None
+        # `LatencyTracer` stamping each frame on its way to the actuator, if any
+        self.tracer = None
 
     def run(self):
         while not(self.running):
@@ -59,12 +82,12 @@ class VideoReadThread(QThread):
                 self.running = True
             time.sleep(0.1)
             if self.settings["source"] == "camera":
-                frame, camera_fps, exposure, recording_state = self.camera_data
+                frame = self.camera_data[0]
                 self.FrameUpdate.emit(frame)
             
             if self.settings["pid_on"]:
                 if self.fgen.instrument:
-                    self.fgen.instrument.write('OUTP OFF')
+                    self.fgen.set_output(False)
 
                 if len(self.radii) > 0:
                     fig, ax = plt.subplots()
@@ -88,6 +111,9 @@ class VideoReadThread(QThread):
         display_time = 1.0 / self.display_fps
         cap = None
         frame_pos = 0
+        frame_time = None
+        prev_frame_time = None
+        frame_id = None
 
         with QMutexLocker(self.circles_mutex):
             self.circles.clear()
@@ -96,11 +122,14 @@ class VideoReadThread(QThread):
             self.selected_circles.clear()
           
         if self.settings["source"] == "video":
-            cap = cv.VideoCapture(self.path)
+            cap = open_video(self.path)
             if not cap.isOpened():
                 print("Could not open video file; check the path & codec support")
                 return
             cap.set(cv.CAP_PROP_POS_FRAMES, self.frame_start)
+            self.frame_times = read_timestamps(self.path)
+            if self.frame_times is None:
+                print("No timestamp sidecar found, using analysis rate for dt")
         
         while self.running:
             if video_iteration == 2:
@@ -127,24 +156,24 @@ class VideoReadThread(QThread):
                         self.circles.clear()
                     self.bubble_counter_start = 1
                     cap.set(cv.CAP_PROP_POS_FRAMES, self.frame_start)
+                    prev_frame_time = None
                     time.sleep(.01)
                     video_iteration += 1
                     frame_analysis_iteration += 1
                     continue
+                if self.tracer is not None:
+                    frame_id = self.tracer.new_frame()
                     
                 if frame_analysis_iteration == 1:
                     self.frame_start = cap.get(cv.CAP_PROP_POS_FRAMES)
                     h, w = frame.shape[:2]
 
-                    self.out = cv.VideoWriter(
-                        "filtered_output.mp4", 
-                        cv.VideoWriter.fourcc(*'mp4v'),
-                        30,
+                    self.out = AnalysisRecorder(
+                        new_recording_dir("analysis"),
+                        cap.get(cv.CAP_PROP_FPS) or 30,
                         (w, h),
-                        isColor=True,          
+                        is_color=frame.ndim == 3,
                     )
-                    if not self.out.isOpened():
-                        raise RuntimeError("Could not open VideoWriter for AVI output")
                     
                     # if self.settings["pid_on"] and self.fgen is not None:
                     #     print("creating bubble")
@@ -153,36 +182,45 @@ class VideoReadThread(QThread):
                     #     self.fgen.instrument.write('OUTP ON')
 
                 frame_pos = cap.get(cv.CAP_PROP_POS_FRAMES)
+                # CAP_PROP_POS_FRAMES points past the frame that was just read
+                frame_idx = int(frame_pos) - 1
+                if self.frame_times is not None and 0 <= frame_idx < len(self.frame_times):
+                    frame_time = float(self.frame_times[frame_idx])
+                else:
+                    frame_time = None
+                # Frames recorded without a capture time are stored as NaN
+                if frame_time is not None and np.isnan(frame_time):
+                    frame_time = None
                 
             # if the camera is the source, get the camera frame
             elif self.settings["source"] == "camera":
-                frame, camera_fps, exposure, recording_state = self.camera_data
+                frame, camera_fps, exposure, recording_state, capture_time, frame_id = self.camera_data
                 # don't change frame_start
 
                 if frame_analysis_iteration == 1:
                     self.frame_start = 1
                     h, w = frame.shape[:2]
-                    self.out = cv.VideoWriter(
-                        "filtered_output.mp4", 
-                        cv.VideoWriter.fourcc(*'mp4v'),
-                        30,
+                    self.out = AnalysisRecorder(
+                        new_recording_dir("analysis"),
+                        camera_fps or 30,
                         (w, h),
-                        isColor=True,          
+                        is_color=frame.ndim == 3,
                     )
-                    if not self.out.isOpened():
-                        raise RuntimeError("Could not open VideoWriter for AVI output")
                     
                     if self.settings["pid_on"]:
                         print("creating bubble")
-                        self.fgen.instrument.write('OUTP ON')
+                        self.fgen.set_output(True)
                         time.sleep(.2)
-                        self.fgen.instrument.write('OUTP ON')
+                        self.fgen.set_output(True, force=True)
 
 
                 frame_pos += 1
+                frame_time = capture_time
             else:
                 print("Source not found")
                 break
+            received_at = time.perf_counter()
+            self.trace(frame_id, "received")
 
             # none of these depend on the frame source
             current_tick = cv.getTickCount()
@@ -195,19 +233,45 @@ class VideoReadThread(QThread):
             last_tick = current_tick
             fps_tick = current_tick
 
+            # Prefer the real capture interval over the analysis rate so Kalman
+            # and PID dt match the recording
+            frame_dt = None
+            if frame_time is not None and prev_frame_time is not None:
+                if frame_time > prev_frame_time:
+                    frame_dt = frame_time - prev_frame_time
+                    fps = 1.0 / frame_dt
+            if frame_time is not None:
+                prev_frame_time = frame_time
+
 
             with QMutexLocker(self.settings_mutex):
                 local_settings = self.settings.copy()
             local_settings["video_iteration"] = video_iteration
 
             local_settings["fps"] = fps
+            # The control loop runs the PID itself, from the posted radii
+            if self.control_loop is not None:
+                local_settings["pid_on"] = False
 
             with QMutexLocker(self.circles_mutex):
                 local_circles = self.circles.copy()
             with QMutexLocker(self.selected_circles_mutex):
                 local_selected_circles = self.selected_circles.copy()
 
+            # A host time would not match the capture times of the other frames,
+            # so frames without one are recorded as NaN
+            record_time = frame_time if frame_time is not None else float("nan")
+            # frame_analysis draws onto the frame it is given, so the raw stream is
+            # written first and the annotations only go to the overlay sidecar
+            try:
+                record_idx = self.out.write_frame(frame, record_time)
+            except Exception as e:
+                record_idx = None
+                print(e)
+            raw_frame = frame.copy() if local_settings["roi_recording_on"] else None
+
             try:
+                self.trace(frame_id, "analysis_start")
                 updated_frame, updated_circles = frame_analysis(
                     frame,
                     local_settings,
@@ -217,10 +281,45 @@ class VideoReadThread(QThread):
                     self.frame_start,
                     self.bubble_counter_start
                 )
+                self.trace(frame_id, "analysis_end")
+
+                # Masks go out before any recording or display work on this frame
+                if self.masker is not None and local_settings["closed_loop_mask_on"]:
+                    self.masker.mode = local_settings["closed_loop_mask_mode"]
+                    self.masker.every = local_settings["closed_loop_mask_every"]
+                    self.masker.update(
+                        updated_circles, frame_pos, frame.shape, received_at
+                    )
+
+                if self.control_loop is not None:
+                    self.control_loop.mailbox.post(
+                        (
+                            record_time,
+                            received_at,
+                            {
+                                idx: circle.history[-1][3]
+                                for idx, circle in updated_circles.items()
+                                if len(circle.history) > 0
+                                and circle.history[-1][0] == frame_pos
+                            },
+                            frame_id,
+                        )
+                    )
                 
                 if local_settings["pid_on"] and len(updated_circles) > 0:
                     self.radii.append([updated_circles[1].history[-1][0], updated_circles[1].history[-1][-1]])
                     self.control_vals.append([updated_circles[1].history[-1][0], updated_circles[1].pid.control_signal])                   
+                    self.trace(frame_id, "pid_update")
+
+                    if self.actuator is not None:
+                        self.actuator.submit(updated_circles[1].pid.pwm_cycle, frame_id)
+
+                    # The instrument times the pulses, only duty changes are
+                    # uploaded, in the background
+                    if local_settings["fgen_arb_pid_on"] and self.instrument_worker:
+                        self.instrument_worker.set_pwm_cycle(
+                            updated_circles[1].pid.pwm_cycle, frame_id
+                        )
                    
                     # on_time, off_time = updated_circles[1].pid.pwm_cycle
                     # if frame_analysis_iteration % 2:
@@ -237,20 +336,23 @@ class VideoReadThread(QThread):
 
                     # # print(f"latency: {time_elapsed}")
 
-                if updated_frame.ndim == 2:      
-                    write_frame = cv.cvtColor(updated_frame, cv.COLOR_GRAY2BGR)
-                else:
-                    write_frame = updated_frame
-                try:
-                    self.out.write(write_frame)
-                    self.FrameUpdate.emit(write_frame)
-                except Exception as e:
-                    print(e)
+                if record_idx is not None:
+                    self.out.write_overlay(record_idx, updated_circles, frame_pos)
+                self.FrameUpdate.emit(updated_frame)
 
                 with QMutexLocker(self.circles_mutex):
                     self.circles.clear()
                     self.circles.update(updated_circles)
 
+                self.update_roi_recording(
+                    raw_frame, updated_circles, frame_pos, record_time
+                )
+
+                if local_settings["trigger_radius"] > 0:
+                    self.check_radius_trigger(
+                        updated_circles, frame_pos, local_settings["trigger_radius"]
+                    )
+
             except Exception as e:
                 print(f"Frame analysis failed: {e}")
                 traceback.print_exc()
@@ -259,7 +361,11 @@ class VideoReadThread(QThread):
             frame_analysis_iteration += 1
             proc_ticks = cv.getTickCount() - start_tick
             proc_secs = proc_ticks / tick_freq
-            time.sleep(max(display_time - proc_secs, 0))
+            # Replay recordings with their original frame timing when it is known
+            if self.settings["source"] == "video" and frame_dt is not None:
+                time.sleep(max(frame_dt - proc_secs, 0))
+            else:
+                time.sleep(max(display_time - proc_secs, 0))
 
         if cap:
             cap.release()
@@ -267,10 +373,17 @@ class VideoReadThread(QThread):
         if self.out:
             self.out.release()
 
+        if self.roi_recorder:
+            self.roi_recorder.release()
+
     @Slot(bool)
     def on_pause(self, do_pause):
         self.paused = do_pause
     
+    def trace(self, frame_id, stage):
+        if self.tracer is not None:
+            self.tracer.stamp(frame_id, stage)
+
     def update_camera_frame(self, data):
         with QMutexLocker(self.camera_data_mutex):
             self.camera_data = data
@@ -282,9 +395,36 @@ class VideoReadThread(QThread):
         if self.out:
             self.out.release()
 
-    def send_command(self, serial_code, cycle_time, on_time):
-        command = f"{int(cycle_time)} {int(on_time)}\n"
-        print(command)
-        serial_code.write(command.encode()) 
-    
-    def graph(self)
\ No newline at end of file
+    def update_roi_recording(self, raw_frame, circles, frame_pos, timestamp):
+        """
+        Stores crops of the bubbles tracked in this frame while ROI recording is on
+        """
+        if raw_frame is None:
+            if self.roi_recorder:
+                self.roi_recorder.release()
+                self.roi_recorder = None
+            return
+
+        if self.roi_recorder is None:
+            self.roi_recorder = RoiRecorder(new_recording_dir("roi"), raw_frame.shape)
+
+        tracks = [
+            (idx, circle.history[-1][1], circle.history[-1][2], circle.history[-1][3])
+            for idx, circle in circles.items()
+            if len(circle.history) > 0 and circle.history[-1][0] == frame_pos
+        ]
+        self.roi_recorder.write(raw_frame, int(frame_pos), timestamp, tracks)
+
+    def check_radius_trigger(self, circles, frame_pos, trigger_radius):
+        """
+        Emits `TriggerEvent` when a bubble grows past `trigger_radius`
+        """
+        for idx, circle in circles.items():
+            if len(circle.history) == 0 or circle.history[-1][0] != frame_pos:
+                continue
+            if circle.history[-1][3] >= trigger_radius:
+                if idx not in self.triggered_ids:
+                    self.triggered_ids.add(idx)
+                    self.TriggerEvent.emit("radius")
+            else:
+                self.triggered_ids.discard(idx)
@@ -7,13 +7,18 @@ class VideoWriteThread(QThread):
 
     @Slot(tuple)
     def save_frame(self, frame_out):
-        frame, out = frame_out
+        frame, out, capture_time = frame_out
         if out is not None and frame is not None:
             try:
-                out.write(frame)
+                out.write(frame, capture_time)
             except Exception as e:
                 print(f"Error reading frame from camera thread: {e}")
 
+    @Slot(object)
+    def release_writer(self, out):
+        if out is not None:
+            out.release()
+
     def stop(self):
         self.quit()
         self.wait()